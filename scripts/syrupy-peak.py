@@ -26,8 +26,30 @@ Reports maximum memory usage from Syrupy logs.
 
 import sys
 import os
+import datetime
+import mmap
+import struct
+import json
+import zlib
+import lzma
+import multiprocessing
+import hashlib
+import collections
+import ctypes
+import ctypes.util
+import select
+import time
+import re
+import math
+import io
+import itertools
 from optparse import OptionParser
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 _program_name = "Syrupy Memory Peak Reporter"
 _program_usage = '%prog [options] <log> [<log> [<log> [...]]]'
 _program_version = '%s Version 1.0' % _program_name
@@ -142,6 +164,7 @@ class SyrupyRecord(object):
         self.mem = None
         self.rss = None
         self.vsize = None
+        self.is_aggregate = False
         if text is not None:
             self.parse(text)
 
@@ -149,7 +172,11 @@ class SyrupyRecord(object):
         parts = text.split()
         if len(parts) < 8:
             raise SyrupyRecord.SyrupyRecordInsufficientFieldsError(text)
-        self.pid = int(parts[0])
+        if parts[0] == "TOTAL":
+            # combined usage of a group of processes, e.g., a process tree
+            self.is_aggregate = True
+        else:
+            self.pid = int(parts[0])
         self.date_text = parts[1]
         self.time_text = parts[2]
         self.elapsed_text = parts[3]
@@ -158,19 +185,687 @@ class SyrupyRecord(object):
         self.rss = int(parts[6])
         self.vsize = int(parts[7])
 
+# Binary sample log format, as written by `syrupy.py --log-format=binary`
+# (see `BinaryLogWriter` in `syrupy.py`, with which this must be kept in
+# sync).
+BINARY_LOG_MAGIC = b"SYRUPYB\x01"
+BINARY_LOG_VERSION = 2
+BINARY_LOG_HEADER = struct.Struct("<8sIIQQQII16x")
+BINARY_LOG_RECORD = struct.Struct("<iidddffqqiI")
+BINARY_LOG_AGGREGATE_FLAG = 1
+# field name: (array type code, offset within record)
+BINARY_LOG_FIELDS = [
+    ("pid", "i", 0),
+    ("ppid", "i", 4),
+    ("poll_time", "d", 8),
+    ("monotime", "d", 16),
+    ("elapsed", "d", 24),
+    ("cpu", "f", 32),
+    ("mem", "f", 36),
+    ("rss", "q", 40),
+    ("vsize", "q", 48),
+    ("command", "i", 56),
+    ("flags", "I", 60),
+]
+
+def is_binary_log(fpath):
+    with open(fpath, 'rb') as src:
+        return src.read(len(BINARY_LOG_MAGIC)) == BINARY_LOG_MAGIC
+
+def format_etime(seconds):
+    """
+    Formats a duration in seconds the way `ps` reports the 'etime'
+    field: "[[DD-]HH:]MM:SS".
+    """
+    seconds = max(int(seconds), 0)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    mins, secs = divmod(seconds, 60)
+    if days:
+        return "%d-%02d:%02d:%02d" % (days, hours, mins, secs)
+    elif hours:
+        return "%02d:%02d:%02d" % (hours, mins, secs)
+    else:
+        return "%02d:%02d" % (mins, secs)
+
+def parse_etime(etime):
+    """
+    Returns the number of seconds given by a duration in the format used
+    by `ps` for the 'etime' field, "[[DD-]HH:]MM:SS".
+    """
+    days, sep, rest = etime.rpartition("-")
+    seconds = 0
+    for part in rest.split(":"):
+        seconds = seconds * 60 + int(part)
+    if sep:
+        seconds += int(days) * 86400
+    return seconds
+
+def parse_log_datetime(date, time_of_day):
+    """
+    Returns the POSIX timestamp of the local date and time of a poll, as
+    given by the DATE and TIME columns of a Syrupy log.
+    """
+    poll_datetime = datetime.datetime.strptime(date + " " + time_of_day, "%Y-%m-%d %H:%M:%S")
+    return time.mktime(poll_datetime.timetuple())
+
+class BinarySyrupyLog(object):
+    """
+    Reads a binary Syrupy log through a read-only memory map. Columns are
+    accessed through `column()`, which returns a view of the mapped data
+    without copying it: a NumPy array if NumPy is available, or a
+    `memoryview` otherwise. The columns of `BINARY_LOG_FIELDS` are named
+    as given there, and the extra columns of the log (`extra_columns`)
+    by their headers in the text log (e.g., "USR").
+    """
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.src = open(fpath, 'rb')
+        size = os.fstat(self.src.fileno()).st_size
+        if size < BINARY_LOG_HEADER.size:
+            raise ValueError("Not a binary Syrupy log: '%s'" % fpath)
+        self.mm = mmap.mmap(self.src.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, num_records, strtab_offset, num_strings, num_extra, data_offset \
+                = BINARY_LOG_HEADER.unpack_from(self.mm, 0)
+        if magic != BINARY_LOG_MAGIC or version not in (1, BINARY_LOG_VERSION) \
+                or record_size != BINARY_LOG_RECORD.size + 8 * num_extra:
+            raise ValueError("Not a binary Syrupy log, or unsupported version: '%s'" % fpath)
+        # version 1 logs have no extra columns, and records follow the header
+        data_offset = max(data_offset, BINARY_LOG_HEADER.size)
+        self.extra_columns = []
+        offset = BINARY_LOG_HEADER.size
+        for idx in range(num_extra):
+            length, = struct.unpack_from("<I", self.mm, offset)
+            offset += 4
+            self.extra_columns.append(self.mm[offset:offset+length].decode("utf-8", "replace"))
+            offset += length
+        self.record_size = record_size
+        self.layout = BINARY_LOG_FIELDS + [(name, "d", BINARY_LOG_RECORD.size + 8 * idx)
+                for idx, name in enumerate(self.extra_columns)]
+        if strtab_offset == 0:
+            # not closed cleanly: recover what records there are
+            num_records = (size - data_offset) // record_size
+            self.commands = None
+        else:
+            self.commands = []
+            offset = strtab_offset
+            for idx in range(num_strings):
+                length, = struct.unpack_from("<I", self.mm, offset)
+                offset += 4
+                self.commands.append(self.mm[offset:offset+length].decode("utf-8", "replace"))
+                offset += length
+        self.num_records = num_records
+        self.data = memoryview(self.mm)[data_offset:data_offset + num_records * record_size]
+        if numpy is not None:
+            self.records = numpy.frombuffer(self.data, dtype=numpy.dtype({
+                    "names": [name for name, code, offset in self.layout],
+                    "formats": ["<" + code for name, code, offset in self.layout],
+                    "offsets": [offset for name, code, offset in self.layout],
+                    "itemsize": record_size}))
+        else:
+            self.records = None
+
+    def column(self, name):
+        if self.records is not None:
+            return self.records[name]
+        for field_name, code, offset in self.layout:
+            if field_name == name:
+                itemsize = struct.calcsize(code)
+                stride = self.record_size // itemsize
+                return self.data.cast(code)[offset // itemsize::stride]
+        raise KeyError(name)
+
+    def command(self, idx):
+        if self.commands is None or idx >= len(self.commands):
+            return "?"
+        return self.commands[idx]
+
+    def fields(self, idx):
+        return BINARY_LOG_RECORD.unpack_from(self.data, idx * self.record_size)
+
+    def extra_values(self, idx):
+        """
+        Returns the values of the extra columns of sample `idx`.
+        """
+        return struct.unpack_from("<%dd" % len(self.extra_columns),
+                self.data,
+                idx * self.record_size + BINARY_LOG_RECORD.size)
+
+    def record(self, idx):
+        """
+        Returns sample `idx` as a `SyrupyRecord`.
+        """
+        pid, ppid, poll_time, monotime, elapsed, cpu, mem, rss, vsize, command, flags = self.fields(idx)
+        sr = SyrupyRecord(filename=self.fpath)
+        poll_datetime = datetime.datetime.fromtimestamp(poll_time)
+        sr.is_aggregate = bool(flags & BINARY_LOG_AGGREGATE_FLAG)
+        if not sr.is_aggregate:
+            sr.pid = pid
+        sr.date_text = poll_datetime.strftime("%Y-%m-%d")
+        sr.time_text = poll_datetime.strftime("%H:%M:%S")
+        sr.datetime = poll_datetime
+        sr.elapsed_text = format_etime(elapsed)
+        sr.elapsed_time = elapsed
+        # stored in single precision; the text logs give one decimal place
+        sr.cpu = float("%.1f" % cpu)
+        sr.mem = float("%.1f" % mem)
+        sr.rss = rss
+        sr.vsize = vsize
+        return sr
+
+    def peak_indexes(self):
+        """
+        Returns the (sorted) indexes of the samples that `SyrupyPeaks`
+        needs to see to arrive at the same result as if it had seen all
+        of them: for each tracked quantity, the first sample with the
+        peak value and the last sample that ties with it.
+        """
+        flags = self.column("flags")
+        indexes = set()
+        for aggregate, attrs in ((False, ("mem", "rss", "vsize")), (True, ("cpu", "rss", "vsize"))):
+            if self.records is not None:
+                positions = numpy.nonzero((flags & BINARY_LOG_AGGREGATE_FLAG) == int(aggregate))[0]
+                if len(positions) == 0:
+                    continue
+                for attr in attrs:
+                    values = self.column(attr)[positions]
+                    if attr in ("cpu", "mem"):
+                        values = numpy.round(values.astype(numpy.float64), 1)
+                    ties = positions[values == values.max()]
+                    indexes.add(int(ties[0]))
+                    indexes.add(int(ties[-1]))
+            else:
+                positions = [idx for idx in range(self.num_records)
+                        if bool(flags[idx] & BINARY_LOG_AGGREGATE_FLAG) == aggregate]
+                if not positions:
+                    continue
+                for attr in attrs:
+                    column = self.column(attr)
+                    if attr in ("cpu", "mem"):
+                        values = [round(column[idx], 1) for idx in positions]
+                    else:
+                        values = [column[idx] for idx in positions]
+                    peak = max(values)
+                    ties = [idx for idx, value in zip(positions, values) if value == peak]
+                    indexes.add(ties[0])
+                    indexes.add(ties[-1])
+        return sorted(indexes)
+
+    def close(self):
+        self.records = None
+        self.data.release()
+        self.mm.close()
+        self.src.close()
+
+TEXT_LOG_COLUMNS = ["PID", "DATE", "TIME", "ELAPSED", "CPU", "MEM", "RSS", "VSIZE", "MONOTIME", "CMD"]
+# the columns of a text log that are stored in the fixed fields of the
+# records of a binary log (or, for "HOST", not at all), rather than as
+# extra columns
+BINARY_LOG_TEXT_COLUMNS = set(TEXT_LOG_COLUMNS + ["PPID", "HOST"])
+
+def format_extra_value(value):
+    """
+    Formats the value of an extra column of a binary log as in a text
+    log ("-" if not known).
+    """
+    if math.isnan(value):
+        return "-"
+    if value.is_integer():
+        return "%d" % value
+    return repr(value)
+
+def binary_to_text_log(blog, dest):
+    """
+    Writes the samples of binary log `blog` to `dest` as a text log, in
+    the (aligned) format written by Syrupy by default.
+    """
+    columns = TEXT_LOG_COLUMNS[:-1] + blog.extra_columns + TEXT_LOG_COLUMNS[-1:]
+    widths = [8, 11, 8, 11, 5, 5, 8, 8, 11] + [11] * len(blog.extra_columns) + [8]
+    dest.write("  ".join(col.rjust(w) for col, w in zip(columns, widths)) + "\n")
+    for idx in range(blog.num_records):
+        pid, ppid, poll_time, monotime, elapsed, cpu, mem, rss, vsize, command, flags = blog.fields(idx)
+        poll_datetime = datetime.datetime.fromtimestamp(poll_time)
+        values = [
+            "TOTAL" if flags & BINARY_LOG_AGGREGATE_FLAG else str(pid),
+            poll_datetime.strftime("%Y-%m-%d"),
+            poll_datetime.strftime("%H:%M:%S"),
+            format_etime(elapsed),
+            "%.1f" % cpu,
+            "%.1f" % mem,
+            str(rss),
+            str(vsize),
+            "%.3f" % monotime,
+        ]
+        values.extend(format_extra_value(value) for value in blog.extra_values(idx))
+        values.append(blog.command(command))
+        dest.write("  ".join(v.rjust(w) for v, w in zip(values, widths)) + "\n")
+
+def read_log_columns(logf):
+    """
+    Returns the names of the columns of text log `logf` (an open file),
+    as given by its header line, leaving `logf` positioned at the first
+    sample. Logs without a header line are assumed to have the default
+    columns.
+    """
+    header = logf.readline()
+    columns = header.split()
+    if not columns or columns[0] not in ("PID", "PPID"):
+        columns = TEXT_LOG_COLUMNS
+        logf.seek(0)
+    return columns
+
+def text_to_binary_log(logf, dest):
+    """
+    Writes the samples of text log `logf` (an open file) to `dest` (a file
+    opened in binary mode) as a binary log. The columns are identified
+    from the header line; logs without one are assumed to have the
+    default columns.
+    """
+    columns = read_log_columns(logf)
+    cmd_idx = columns.index("CMD") if "CMD" in columns else len(columns)
+    extra_columns = [col for col in columns[:cmd_idx] if col not in BINARY_LOG_TEXT_COLUMNS]
+    record = struct.Struct(BINARY_LOG_RECORD.format + "d" * len(extra_columns))
+    names = b"".join(struct.pack("<I", len(col.encode("utf-8"))) + col.encode("utf-8") for col in extra_columns)
+    data_offset = BINARY_LOG_HEADER.size + len(names)
+    strings = {}
+    num_records = 0
+    dest.write(BINARY_LOG_HEADER.pack(BINARY_LOG_MAGIC,
+            BINARY_LOG_VERSION,
+            record.size,
+            0,
+            0,
+            0,
+            len(extra_columns),
+            data_offset))
+    dest.write(names)
+    for line in logf:
+        parts = line.split(None, cmd_idx)
+        if len(parts) < cmd_idx:
+            continue
+        row = dict(zip(columns, parts))
+        command = parts[cmd_idx].strip() if len(parts) > cmd_idx else ""
+        command_idx = strings.get(command)
+        if command_idx is None:
+            command_idx = strings[command] = len(strings)
+        if row["PID"] == "TOTAL":
+            pid, ppid, flags = -1, -1, BINARY_LOG_AGGREGATE_FLAG
+        else:
+            pid, ppid, flags = int(row["PID"]), int(row.get("PPID", -1)), 0
+        dest.write(record.pack(pid,
+                ppid,
+                parse_log_datetime(row["DATE"], row["TIME"]),
+                float(row.get("MONOTIME", 0)),
+                parse_etime(row["ELAPSED"]),
+                float(row["CPU"]),
+                float(row["MEM"]),
+                int(row["RSS"]),
+                int(row["VSIZE"]),
+                command_idx,
+                flags,
+                *[float("nan") if row[col] == "-" else float(row[col]) for col in extra_columns]))
+        num_records += 1
+    strtab_offset = dest.tell()
+    for string in sorted(strings, key=strings.get):
+        data = string.encode("utf-8")
+        dest.write(struct.pack("<I", len(data)) + data)
+    dest.seek(0)
+    dest.write(BINARY_LOG_HEADER.pack(BINARY_LOG_MAGIC,
+            BINARY_LOG_VERSION,
+            record.size,
+            num_records,
+            strtab_offset,
+            len(strings),
+            len(extra_columns),
+            data_offset))
+
+# Delta-encoded raw process logs, as written by `syrupy.py
+# --raw-log-format=delta` (see `DeltaRawLogWriter` in `syrupy.py`, with
+# which this must be kept in sync).
+def raw_log_decompressor(magic):
+    """
+    Returns a decompressor for a member of a delta-encoded raw log that
+    starts with the bytes `magic`.
+    """
+    if magic.startswith(b"\x1f\x8b"):
+        return zlib.decompressobj(31)
+    elif magic.startswith(b"\xfd7zXZ\x00"):
+        return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+    else:
+        return zlib.decompressobj()
+
+def iter_raw_log_entries(src, chunk_size=1 << 16):
+    """
+    Yields the entries (dictionaries) of the delta-encoded raw log `src`
+    (a file opened in binary mode), from its current position on. A
+    member cut short (e.g., because Syrupy was killed) ends the log.
+    """
+    decompressor = None
+    pending = b""
+    buf = src.read(chunk_size)
+    while buf:
+        if decompressor is None:
+            decompressor = raw_log_decompressor(buf)
+        try:
+            pending += decompressor.decompress(buf)
+        except (zlib.error, lzma.LZMAError):
+            break
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield json.loads(line.decode("utf-8"))
+        if decompressor.eof:
+            buf = decompressor.unused_data
+            decompressor = None
+            pending = b""
+        else:
+            buf = b""
+        if not buf:
+            buf = src.read(chunk_size)
+
+def read_raw_log_index(fpath):
+    """
+    Returns the list of `(tick, offset)` tuples of the keyframes of the
+    delta-encoded raw log `fpath` given in its index, or an empty list if
+    it has none.
+    """
+    index_path = fpath + ".idx"
+    if not os.path.exists(index_path):
+        return []
+    keyframes = []
+    with open(index_path, 'r') as index:
+        for line in index:
+            parts = line.split()
+            if len(parts) == 2:
+                keyframes.append((int(parts[0]), int(parts[1])))
+    return keyframes
+
+def iter_raw_log_snapshots(fpath, start_tick=0):
+    """
+    Yields `(tick, rows)` tuples giving the full process table sampled at
+    each tick of the delta-encoded raw log `fpath`, from tick `start_tick`
+    on, decoding from the last keyframe before it.
+    """
+    offset = 0
+    for tick, keyframe_offset in read_raw_log_index(fpath):
+        if tick <= start_tick:
+            offset = keyframe_offset
+    with open(fpath, 'rb') as src:
+        src.seek(offset)
+        snapshot = None
+        for entry in iter_raw_log_entries(src):
+            if "k" in entry:
+                key_fields = entry["n"]
+                snapshot = entry["k"]
+            elif snapshot is None:
+                continue
+            else:
+                rows = dict((" ".join(row[:key_fields]), row) for row in snapshot)
+                for key in entry.get("r", []):
+                    del rows[key]
+                for key, changes in entry.get("c", {}).items():
+                    row = list(rows[key])
+                    for idx, value in changes:
+                        row[idx] = value
+                    rows[key] = row
+                snapshot = [rows[" ".join(row[:key_fields])] for row in snapshot
+                        if " ".join(row[:key_fields]) in rows]
+                for idx, row in entry.get("a", []):
+                    snapshot.insert(idx, row)
+            if entry["t"] >= start_tick:
+                yield entry["t"], snapshot
+
+def summary_path(logf_path):
+    """
+    Returns the path of the run summary written by Syrupy alongside the
+    log `logf_path`.
+    """
+    if logf_path.endswith(".ps.log") or logf_path.endswith(".ps.bin"):
+        return logf_path[:-len(".log")] + ".summary"
+    return logf_path + ".summary"
+
+def read_run_summary(fpath):
+    """
+    Returns a dictionary of the entries of the Syrupy run summary at
+    `fpath`, or an empty one if there is no such file.
+    """
+    summary = {}
+    if not os.path.exists(fpath):
+        return summary
+    with open(fpath, 'r') as src:
+        for line in src:
+            key, sep, value = line.partition(":")
+            if sep:
+                summary[key.strip()] = value.strip()
+    return summary
+
+def analyze_log(task):
+    """
+    Returns a tuple, `(peaks, num_processed, messages, end_offset)`,
+    giving the peaks (a `SyrupyPeaks` object) and the number of the
+    samples in part of a log, any messages about entries that were
+    skipped, and the offset at which reading stopped, for `task`, a tuple
+    `(logf_path, start, end, ignore_parse_errors, log_desc,
+    complete_lines_only)`. The part of the log is that made up of the
+    lines beginning at byte offsets from `start` up to (but not
+    including) `end` (or the end of the file, if `end` is None); binary
+    logs are always analyzed in full. If `complete_lines_only` is True, a
+    last line that is not terminated (as it is still being written) is
+    left for later. `log_desc` describes the log in messages. This is run
+    by the worker processes in parallel mode, with the results of all
+    parts merged in order (see `SyrupyPeaks.merge()`).
+    """
+    logf_path, start, end, ignore_parse_errors, log_desc, complete_lines_only = task
+    sp = SyrupyPeaks()
+    messages = []
+    if is_binary_log(logf_path):
+        blog = BinarySyrupyLog(logf_path)
+        for idx in blog.peak_indexes():
+            sp.update(blog.record(idx))
+        num_processed = blog.num_records
+        blog.close()
+        return sp, num_processed, messages, None
+    num_processed = 0
+    with open(logf_path, 'rb') as logf:
+        if start == 0:
+            logf.readline()
+        else:
+            # skip the remainder of the line under way at `start`, which
+            # belongs to the previous part
+            logf.seek(start - 1)
+            logf.readline()
+        entry_idx = 0
+        while end is None or logf.tell() < end:
+            entry_offset = logf.tell()
+            entry = logf.readline()
+            if not entry:
+                break
+            if complete_lines_only and not entry.endswith(b"\n"):
+                logf.seek(entry_offset)
+                break
+            entry_idx += 1
+            try:
+                sr = SyrupyRecord(text=entry.decode('utf-8', 'replace').replace('\n', ''), filename=logf_path)
+            except SyrupyRecord.SyrupyRecordInsufficientFieldsError:
+                if ignore_parse_errors:
+                    if start == 0:
+                        messages.append("Ignoring error parsing entry %d in %s\n" % (entry_idx, log_desc))
+                    else:
+                        messages.append("Ignoring error parsing entry at byte %d in %s\n" % (entry_offset, log_desc))
+                    continue
+                else:
+                    raise
+            sp.update(sr)
+            num_processed += 1
+        end_offset = logf.tell()
+    return sp, num_processed, messages, end_offset
+
+def split_log(logf_path, chunk_size, start=0):
+    """
+    Returns the `(start, end)` byte ranges into which text log
+    `logf_path` (from offset `start` on) is split for analysis in
+    parallel, each of about `chunk_size` bytes.
+    """
+    size = os.path.getsize(logf_path)
+    if chunk_size <= 0 or size - start <= chunk_size or is_binary_log(logf_path):
+        return [(start, None)]
+    starts = list(range(start, size, chunk_size))
+    return list(zip(starts, starts[1:] + [None]))
+
+def checkpoint_path(logf_path):
+    """
+    Returns the path of the checkpoint kept alongside the log `logf_path`
+    with '--checkpoint'.
+    """
+    return logf_path + ".checkpoint"
+
+def log_fingerprint(logf_path, length=4096):
+    """
+    Returns a digest of the first `length` bytes of the log `logf_path`,
+    which identifies the log even if its inode is reused.
+    """
+    with open(logf_path, 'rb') as logf:
+        return hashlib.sha1(logf.read(length)).hexdigest()
+
+def read_checkpoint(logf_path):
+    """
+    Returns a tuple, `(peaks, offset)`, giving the peaks (a `SyrupyPeaks`
+    object) found in the log `logf_path` up to byte `offset`, as saved in
+    its checkpoint by `write_checkpoint()`, or None if there is no
+    checkpoint, or the log is not the one analyzed then (it was rotated,
+    replaced or truncated since).
+    """
+    fpath = checkpoint_path(logf_path)
+    if not os.path.exists(fpath):
+        return None
+    try:
+        with open(fpath, 'r') as src:
+            checkpoint = json.load(src)
+    except ValueError:
+        return None
+    st = os.stat(logf_path)
+    if checkpoint.get("version") != 1 \
+            or checkpoint["dev"] != st.st_dev \
+            or checkpoint["ino"] != st.st_ino \
+            or st.st_size < checkpoint["size"] \
+            or st.st_mtime < checkpoint["mtime"] \
+            or log_fingerprint(logf_path, checkpoint["fingerprint_length"]) != checkpoint["fingerprint"]:
+        return None
+    return SyrupyPeaks.from_state(checkpoint["peaks"], logf_path), checkpoint["offset"]
+
+def write_checkpoint(logf_path, sp, offset):
+    """
+    Saves the peaks `sp` found in the log `logf_path` up to byte `offset`
+    to its checkpoint, together with what identifies the log: its device
+    and inode, size and modification time, and a digest of its start.
+    """
+    st = os.stat(logf_path)
+    fingerprint_length = min(offset, 4096)
+    checkpoint = {
+        "version": 1,
+        "dev": st.st_dev,
+        "ino": st.st_ino,
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "offset": offset,
+        "fingerprint_length": fingerprint_length,
+        "fingerprint": log_fingerprint(logf_path, fingerprint_length),
+        "peaks": sp.to_state(),
+    }
+    fpath = checkpoint_path(logf_path)
+    with open(fpath + ".tmp", 'w') as dest:
+        json.dump(checkpoint, dest)
+    os.replace(fpath + ".tmp", fpath)
+
 class SyrupyPeaks(object):
 
     def __init__(self, logf_path=None):
         self.logf_path = logf_path
+        if logf_path is not None:
+            self.summary = read_run_summary(summary_path(logf_path))
+        else:
+            self.summary = {}
         self.peak_mem = None
         self.peak_rss = None
         self.peak_vsize = None
+        self.peak_total_cpu = None
+        self.peak_total_rss = None
+        self.peak_total_vsize = None
+
+    # (record name, attribute name) pairs tracked for individual
+    # processes and for aggregates
+    process_peaks = [('peak_mem', 'mem'), ('peak_rss', 'rss'), ('peak_vsize', 'vsize')]
+    total_peaks = [('peak_total_cpu', 'cpu'), ('peak_total_rss', 'rss'), ('peak_total_vsize', 'vsize')]
 
     def update(self, syrec):
+        if syrec.is_aggregate:
+            self._check_and_update(syrec, 'peak_total_cpu', 'cpu')
+            self._check_and_update(syrec, 'peak_total_rss', 'rss')
+            self._check_and_update(syrec, 'peak_total_vsize', 'vsize')
+            return
         self._check_and_update(syrec, 'peak_mem', 'mem')
         self._check_and_update(syrec, 'peak_rss', 'rss')
         self._check_and_update(syrec, 'peak_vsize', 'vsize')
 
+    record_attrs = ['filename', 'pid', 'date_text', 'time_text', 'elapsed_text', 'elapsed_time',
+            'cpu', 'mem', 'rss', 'vsize', 'is_aggregate']
+
+    def to_state(self):
+        """
+        Returns the peaks (and their ties) as a JSON-serializable
+        dictionary, from which they can be restored with `from_state()`.
+        """
+        records = []
+        record_idxs = {}
+        def record_idx(syrec):
+            if id(syrec) not in record_idxs:
+                record_idxs[id(syrec)] = len(records)
+                records.append(dict((attr, getattr(syrec, attr)) for attr in self.record_attrs))
+            return record_idxs[id(syrec)]
+        peaks = {}
+        for current_record_name, attr_name in self.process_peaks + self.total_peaks:
+            syrec = getattr(self, current_record_name)
+            if syrec is not None:
+                tie = syrec.ties.get(attr_name)
+                peaks[current_record_name] = [record_idx(syrec), record_idx(tie) if tie else None]
+        return {"records": records, "peaks": peaks}
+
+    @classmethod
+    def from_state(cls, state, logf_path=None):
+        sp = cls(logf_path)
+        records = []
+        for values in state["records"]:
+            syrec = SyrupyRecord()
+            for attr in cls.record_attrs:
+                setattr(syrec, attr, values[attr])
+            syrec.ties = {}
+            records.append(syrec)
+        for current_record_name, attr_name in cls.process_peaks + cls.total_peaks:
+            if current_record_name in state["peaks"]:
+                syrec_idx, tie_idx = state["peaks"][current_record_name]
+                syrec = records[syrec_idx]
+                syrec.ties[attr_name] = records[tie_idx] if tie_idx is not None else []
+                setattr(sp, current_record_name, syrec)
+        return sp
+
+    def merge(self, other):
+        """
+        Updates the peaks with those of `other`, which must have been
+        found in records following all of those seen so far. The result
+        (including which of several records with the peak value is
+        reported, and the last one tying with it) is the same as if
+        `update()` had been called with all of the records seen by
+        `other`.
+        """
+        for current_record_name, attr_name in self.process_peaks + self.total_peaks:
+            candidate = getattr(other, current_record_name)
+            if candidate is None:
+                continue
+            tie = candidate.ties.get(attr_name)
+            self._check_and_update(candidate, current_record_name, attr_name)
+            if tie:
+                self._check_and_update(tie, current_record_name, attr_name)
+
     def _check_and_update(self, candidate, current_record_name, attr_name):
         if (getattr(self, current_record_name) is None) \
                 or getattr(candidate, attr_name) > getattr(getattr(self, current_record_name), attr_name):
@@ -182,6 +877,720 @@ class SyrupyPeaks(object):
             getattr(getattr(self, current_record_name), 'ties')[attr_name] = candidate
 
 
+class SyrupyStats(object):
+    """
+    Accumulates statistics of the combined resource usage of all the
+    processes sampled in a poll (excluding "TOTAL" rows, which repeat
+    it), over the polls of one or more logs: the distribution of RSS,
+    the time-weighted means of RSS and memory use (each poll standing
+    for the time until the next one), the CPU time used (integrated
+    over the polling intervals from the "USR" and "SYS" columns, or, for
+    older logs without them, estimated from the lifetime CPU utilization
+    and elapsed time given by `ps`), and the time
+    spent with RSS above `rss_threshold` (in kB), if given, and, for logs
+    with "USR" and "SYS" columns, the user and system CPU time and the
+    peak CPU utilization over a polling interval, and, for logs with a
+    "PSS" column, the peak and time-weighted mean of the combined PSS
+    (which, unlike RSS, counts memory shared between the processes only
+    once). Samples are
+    fed in chunks of columns (NumPy arrays) through `add_samples()`, so
+    that only a chunk at a time needs to be held in memory; this
+    requires NumPy.
+
+    RSS percentiles are found from a histogram with bins of logarithmic
+    width, and so are approximate, to within `RSS_BIN_RATIO`.
+    """
+
+    RSS_BIN_RATIO = 1.01
+    NUM_RSS_BINS = 4096
+
+    def __init__(self, rss_threshold=None):
+        self.rss_threshold = rss_threshold
+        self.rss_histogram = numpy.zeros(self.NUM_RSS_BINS, dtype=numpy.int64)
+        self.num_polls = 0
+        self.duration = 0.0
+        self.rss_time = 0.0
+        self.mem_time = 0.0
+        self.time_above_threshold = 0.0
+        self.cpu_seconds = 0.0
+        # for logs without interval CPU utilization: ps reports CPU
+        # utilization as the average over the lifetime of the process, so
+        # the CPU time used by a process is estimated from its latest
+        # sample: process identity: CPU time (s)
+        self.process_cpu_seconds = {}
+        # interval CPU utilization, from the "USR" and "SYS" columns: each
+        # poll gives the utilization over the interval since the poll
+        # before it
+        self.has_interval_cpu = False
+        self.user_cpu_seconds = 0.0
+        self.system_cpu_seconds = 0.0
+        self.peak_interval_cpu = None
+        self.last_poll_time = None
+        self.has_pss = False
+        self.pss_time = 0.0
+        self.pss_duration = 0.0
+        self.peak_pss = None
+        # the latest poll, which may continue in the next chunk and whose
+        # duration is not known until the poll after it is seen: (time,
+        # RSS, %mem, %usr, %sys, PSS)
+        self.pending_poll = None
+
+    def add_samples(self, poll_times, processes, elapsed, cpu, mem, rss, is_aggregate, usr_cpu=None, sys_cpu=None, pss=None):
+        """
+        Adds a chunk of samples, given as arrays of the same length: the
+        time of the poll (seconds, on any clock), the identity of the
+        process, the elapsed time of the process (seconds), its CPU and
+        memory utilization (%), its RSS (kB), and whether it is a "TOTAL"
+        row, and, if known, its user and system CPU utilization over the
+        polling interval (%, NaN where not known) and its PSS (kB, NaN
+        where not known).
+        """
+        keep = ~is_aggregate
+        poll_times = poll_times[keep]
+        processes = processes[keep]
+        if len(poll_times) == 0:
+            return
+        elapsed = elapsed[keep]
+        cpu = cpu[keep]
+        mem = mem[keep].astype(numpy.float64)
+        rss = rss[keep].astype(numpy.float64)
+        if usr_cpu is not None:
+            self.has_interval_cpu = True
+            usr_cpu = numpy.nan_to_num(usr_cpu[keep])
+            sys_cpu = numpy.nan_to_num(sys_cpu[keep])
+        else:
+            usr_cpu = sys_cpu = numpy.zeros(len(poll_times))
+        if pss is not None:
+            self.has_pss = True
+            pss = numpy.nan_to_num(pss[keep])
+        else:
+            pss = numpy.zeros(len(poll_times))
+
+        # samples of a poll are contiguous
+        starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(poll_times) != 0) + 1))
+        times = poll_times[starts]
+        poll_rss = numpy.add.reduceat(rss, starts)
+        poll_mem = numpy.add.reduceat(mem, starts)
+        poll_usr = numpy.add.reduceat(usr_cpu, starts)
+        poll_sys = numpy.add.reduceat(sys_cpu, starts)
+        poll_pss = numpy.add.reduceat(pss, starts)
+        if self.pending_poll is not None:
+            pending_time, pending_rss, pending_mem, pending_usr, pending_sys, pending_pss = self.pending_poll
+            if pending_time == times[0]:
+                poll_rss[0] += pending_rss
+                poll_mem[0] += pending_mem
+                poll_usr[0] += pending_usr
+                poll_sys[0] += pending_sys
+                poll_pss[0] += pending_pss
+            else:
+                times = numpy.concatenate(([pending_time], times))
+                poll_rss = numpy.concatenate(([pending_rss], poll_rss))
+                poll_mem = numpy.concatenate(([pending_mem], poll_mem))
+                poll_usr = numpy.concatenate(([pending_usr], poll_usr))
+                poll_sys = numpy.concatenate(([pending_sys], poll_sys))
+                poll_pss = numpy.concatenate(([pending_pss], poll_pss))
+        self.pending_poll = (times[-1], poll_rss[-1], poll_mem[-1], poll_usr[-1], poll_sys[-1], poll_pss[-1])
+        self.add_polls(poll_rss[:-1], poll_mem[:-1], numpy.maximum(numpy.diff(times), 0), poll_pss[:-1])
+        self.add_interval_cpu(times[:-1], poll_usr[:-1], poll_sys[:-1])
+
+        last_seen = len(processes) - 1 - numpy.unique(processes[::-1], return_index=True)[1]
+        for idx in last_seen:
+            self.process_cpu_seconds[processes[idx]] = float(cpu[idx]) * float(elapsed[idx]) / 100
+
+    def add_polls(self, poll_rss, poll_mem, durations, poll_pss=None):
+        bins = numpy.ceil(numpy.log(numpy.maximum(poll_rss, 1)) / numpy.log(self.RSS_BIN_RATIO))
+        bins = numpy.minimum(bins.astype(numpy.int64), self.NUM_RSS_BINS - 1)
+        self.rss_histogram += numpy.bincount(bins, minlength=self.NUM_RSS_BINS)
+        self.num_polls += len(poll_rss)
+        self.duration += float(durations.sum())
+        self.rss_time += float((poll_rss * durations).sum())
+        self.mem_time += float((poll_mem * durations).sum())
+        if self.rss_threshold is not None:
+            self.time_above_threshold += float(durations[poll_rss > self.rss_threshold].sum())
+        if self.has_pss and len(poll_pss) > 0:
+            self.pss_time += float((poll_pss * durations).sum())
+            self.pss_duration += float(durations.sum())
+            peak = float(poll_pss.max())
+            if self.peak_pss is None or peak > self.peak_pss:
+                self.peak_pss = peak
+
+    def add_interval_cpu(self, times, poll_usr, poll_sys):
+        """
+        Adds the combined user and system CPU utilization (%) of polls
+        taken at `times`, each over the interval since the poll before it
+        (the first poll of a log, whose interval is not known, only
+        counting towards the peak).
+        """
+        if not self.has_interval_cpu or len(times) == 0:
+            return
+        if self.last_poll_time is not None:
+            previous_times = numpy.concatenate(([self.last_poll_time], times[:-1]))
+            intervals = numpy.maximum(times - previous_times, 0)
+        else:
+            intervals = numpy.concatenate(([0], numpy.maximum(numpy.diff(times), 0)))
+        self.last_poll_time = times[-1]
+        self.user_cpu_seconds += float((poll_usr * intervals).sum()) / 100
+        self.system_cpu_seconds += float((poll_sys * intervals).sum()) / 100
+        peak = float((poll_usr + poll_sys).max())
+        if self.peak_interval_cpu is None or peak > self.peak_interval_cpu:
+            self.peak_interval_cpu = peak
+
+    def finish(self):
+        """
+        Adds the last poll seen, which, as there is no poll after it, is
+        given no duration, and the CPU time of the processes seen.
+        """
+        if self.pending_poll is not None:
+            pending_time, pending_rss, pending_mem, pending_usr, pending_sys, pending_pss = self.pending_poll
+            self.add_polls(numpy.array([pending_rss]), numpy.array([pending_mem]), numpy.zeros(1),
+                    numpy.array([pending_pss]))
+            self.add_interval_cpu(numpy.array([pending_time]), numpy.array([pending_usr]), numpy.array([pending_sys]))
+            self.pending_poll = None
+        if self.has_interval_cpu:
+            self.cpu_seconds += self.user_cpu_seconds + self.system_cpu_seconds
+        else:
+            self.cpu_seconds += sum(self.process_cpu_seconds.values())
+        self.process_cpu_seconds = {}
+
+    def merge(self, other):
+        """
+        Adds the statistics of `other`, which must have been finished,
+        and cover different processes.
+        """
+        self.rss_histogram += other.rss_histogram
+        self.num_polls += other.num_polls
+        self.duration += other.duration
+        self.rss_time += other.rss_time
+        self.mem_time += other.mem_time
+        self.time_above_threshold += other.time_above_threshold
+        self.cpu_seconds += other.cpu_seconds
+        if other.has_interval_cpu:
+            self.has_interval_cpu = True
+            self.user_cpu_seconds += other.user_cpu_seconds
+            self.system_cpu_seconds += other.system_cpu_seconds
+            if self.peak_interval_cpu is None or other.peak_interval_cpu > self.peak_interval_cpu:
+                self.peak_interval_cpu = other.peak_interval_cpu
+        if other.has_pss:
+            self.has_pss = True
+            self.pss_time += other.pss_time
+            self.pss_duration += other.pss_duration
+            if self.peak_pss is None or other.peak_pss > self.peak_pss:
+                self.peak_pss = other.peak_pss
+
+    def rss_percentile(self, q):
+        """
+        Returns (an upper bound within `RSS_BIN_RATIO` of) the RSS (kB)
+        of the combined usage in `q` percent of the polls.
+        """
+        if self.num_polls == 0:
+            return None
+        rank = max(int(numpy.ceil(q / 100.0 * self.num_polls)), 1)
+        idx = int(numpy.searchsorted(numpy.cumsum(self.rss_histogram), rank))
+        return self.RSS_BIN_RATIO ** idx if idx > 0 else 0
+
+    def mean_rss(self):
+        if self.duration == 0:
+            return None
+        return self.rss_time / self.duration
+
+    def mean_mem(self):
+        if self.duration == 0:
+            return None
+        return self.mem_time / self.duration
+
+    def mean_pss(self):
+        if self.pss_duration == 0:
+            return None
+        return self.pss_time / self.pss_duration
+
+# a value that is not known in a text log
+UNKNOWN_LOG_VALUE = re.compile(r"(?<!\S)-(?!\S)")
+
+def load_log_chunk(lines, num_fields, usecols, dtype):
+    """
+    Returns the columns `usecols` of the text log lines `lines` as a NumPy
+    structured array of type `dtype`, parsed by `numpy.loadtxt()` in one
+    go, with values that are not known ("-") as NaN. Lines with fewer than
+    `num_fields` fields (e.g., the last line of a log still being
+    written) are skipped.
+    """
+    text = "".join(lines)
+    if not text.strip():
+        return numpy.zeros(0, dtype=dtype)
+    try:
+        # the values not known are nearly always between spaces, and the
+        # second pass catches those that are next to each other
+        return numpy.loadtxt(io.StringIO(text.replace(" - ", " nan ").replace(" - ", " nan ")),
+                dtype=dtype,
+                usecols=usecols,
+                comments=None,
+                ndmin=1)
+    except ValueError:
+        pass
+    # only now are the lines checked one by one
+    text = "".join(line for line in UNKNOWN_LOG_VALUE.sub("nan", text).splitlines(True)
+            if len(line.split(None, num_fields)) >= num_fields)
+    if not text.strip():
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.loadtxt(io.StringIO(text), dtype=dtype, usecols=usecols, comments=None, ndmin=1)
+
+def compute_log_stats(task):
+    """
+    Returns the statistics (a `SyrupyStats` object) of the log given by
+    `task`, a tuple `(logf_path, rss_threshold, chunk_size)`, reading it
+    `chunk_size` samples at a time.
+    """
+    logf_path, rss_threshold, chunk_size = task
+    stats = SyrupyStats(rss_threshold)
+    if is_binary_log(logf_path):
+        blog = BinarySyrupyLog(logf_path)
+        has_interval_cpu = "USR" in blog.extra_columns and "SYS" in blog.extra_columns
+        has_pss = "PSS" in blog.extra_columns
+        for start in range(0, blog.num_records, chunk_size):
+            chunk = blog.records[start:start+chunk_size]
+            stats.add_samples(chunk["monotime"],
+                    chunk["pid"],
+                    chunk["elapsed"],
+                    chunk["cpu"],
+                    chunk["mem"],
+                    chunk["rss"],
+                    (chunk["flags"] & BINARY_LOG_AGGREGATE_FLAG) != 0,
+                    usr_cpu=chunk["USR"] if has_interval_cpu else None,
+                    sys_cpu=chunk["SYS"] if has_interval_cpu else None,
+                    pss=chunk["PSS"] if has_pss else None)
+        chunk = None
+        blog.close()
+        stats.finish()
+        return stats
+    with open(logf_path, 'r') as logf:
+        columns = read_log_columns(logf)
+        num_fields = columns.index("CMD") if "CMD" in columns else len(columns)
+        has_interval_cpu = "USR" in columns and "SYS" in columns
+        # widths of the text columns; all others are read as numbers
+        text_columns = [("PID", 16), ("ELAPSED", 16)]
+        if "HOST" in columns:
+            text_columns.append(("HOST", 64))
+        if "MONOTIME" not in columns:
+            # older logs: the wall clock time of the poll, to the second
+            text_columns.extend([("DATE", 10), ("TIME", 8)])
+        number_columns = ["CPU", "MEM", "RSS"]
+        if "MONOTIME" in columns:
+            number_columns.append("MONOTIME")
+        if has_interval_cpu:
+            number_columns.extend(["USR", "SYS"])
+        if "PSS" in columns:
+            number_columns.append("PSS")
+        dtype = numpy.dtype([(col, "U%d" % width) for col, width in text_columns]
+                + [(col, "f8") for col in number_columns])
+        usecols = [columns.index(col) for col in dtype.names]
+        while True:
+            lines = list(itertools.islice(logf, chunk_size))
+            if not lines:
+                break
+            chunk = load_log_chunk(lines, num_fields, usecols, dtype)
+            if len(chunk) == 0:
+                continue
+            pids = chunk["PID"]
+            if "HOST" in columns:
+                processes = numpy.char.add(numpy.char.add(chunk["HOST"], " "), pids)
+            else:
+                processes = pids
+            if "MONOTIME" in columns:
+                poll_times = chunk["MONOTIME"]
+            else:
+                # the samples of a poll share its date and time, which are
+                # converted once per poll rather than once per sample
+                stamps, stamp_idx = numpy.unique(numpy.char.add(numpy.char.add(chunk["DATE"], " "), chunk["TIME"]),
+                        return_inverse=True)
+                poll_times = numpy.array([parse_log_datetime(*stamp.split()) for stamp in stamps])[stamp_idx]
+            etimes, etime_idx = numpy.unique(chunk["ELAPSED"], return_inverse=True)
+            stats.add_samples(poll_times,
+                    processes,
+                    numpy.array([parse_etime(etime) for etime in etimes], dtype=numpy.float64)[etime_idx],
+                    chunk["CPU"],
+                    chunk["MEM"],
+                    chunk["RSS"],
+                    pids == "TOTAL",
+                    usr_cpu=chunk["USR"] if has_interval_cpu else None,
+                    sys_cpu=chunk["SYS"] if has_interval_cpu else None,
+                    pss=chunk["PSS"] if "PSS" in columns else None)
+    stats.finish()
+    return stats
+
+def thread_pool_name(name):
+    """
+    Returns the name of the pool to which a thread named `name` belongs,
+    taken to be its name without any trailing number after a separator
+    (e.g., "worker" for "worker-12", but "python3" for "python3").
+    """
+    return re.sub(r"[-_.:#/ ]+\d+$", "", name) or name
+
+def rank_threads(logf_paths):
+    """
+    Returns a tuple, `(threads, pools)`, of lists of dictionaries
+    describing the threads in the thread logs `logf_paths` (as written by
+    `syrupy.py --threads`), and the pools they make up (see
+    `thread_pool_name()`), ordered by the CPU time used while logged.
+    The CPU time of a thread is the increase in its cumulative CPU time
+    over the log, or, for a thread that started after the first poll of
+    the log, all its CPU time.
+    """
+    threads = collections.OrderedDict()
+    for logf_path in logf_paths:
+        with open(logf_path, 'r') as logf:
+            columns = logf.readline().split()
+            if "TID" not in columns:
+                raise ValueError("Not a thread log: '%s'" % logf_path)
+            num_fields = columns.index("NAME")
+            idx = dict((name, columns.index(name)) for name in columns[:num_fields])
+            first_monotime = None
+            for line in logf:
+                parts = line.rstrip("\n").split(None, num_fields)
+                if len(parts) <= num_fields:
+                    continue
+                monotime = float(parts[idx["MONOTIME"]])
+                if first_monotime is None:
+                    first_monotime = monotime
+                cpu_time = float(parts[idx["UTIME"]]) + float(parts[idx["STIME"]])
+                utilization = float(parts[idx["USR"]]) + float(parts[idx["SYS"]])
+                key = (logf_path, parts[idx["PID"]], parts[idx["TID"]])
+                thread = threads.get(key)
+                if thread is None:
+                    thread = threads[key] = {
+                        "Log": logf_path,
+                        "PID": parts[idx["PID"]],
+                        "TID": parts[idx["TID"]],
+                        "Name": parts[num_fields],
+                        "initial_cpu_time": cpu_time if monotime == first_monotime else 0.0,
+                        "cpu_time": cpu_time,
+                        "peak": utilization,
+                        "samples": 0,
+                    }
+                thread["Name"] = parts[num_fields]
+                thread["cpu_time"] = cpu_time
+                thread["peak"] = max(thread["peak"], utilization)
+                thread["samples"] += 1
+    pools = collections.OrderedDict()
+    for thread in threads.values():
+        thread["CPU (s)"] = thread["cpu_time"] - thread["initial_cpu_time"]
+        pool_key = (thread["Log"], thread["PID"], thread_pool_name(thread["Name"]))
+        pool = pools.get(pool_key)
+        if pool is None:
+            pool = pools[pool_key] = {
+                "Log": thread["Log"],
+                "PID": thread["PID"],
+                "Pool": pool_key[2],
+                "Threads": 0,
+                "CPU (s)": 0.0,
+                "Peak thread CPU (%)": 0.0,
+            }
+        pool["Threads"] += 1
+        pool["CPU (s)"] += thread["CPU (s)"]
+        pool["Peak thread CPU (%)"] = max(pool["Peak thread CPU (%)"], thread["peak"])
+    by_cpu_time = lambda d: -d["CPU (s)"]
+    return sorted(threads.values(), key=by_cpu_time), sorted(pools.values(), key=by_cpu_time)
+
+def parse_duration(text):
+    """
+    Returns the number of seconds given by `text`, a number optionally
+    followed by a unit: 's' (seconds, the default), 'm' (minutes) or 'h'
+    (hours).
+    """
+    units = {"s": 1, "m": 60, "h": 3600}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+class RollingMax(object):
+    """
+    Keeps track of the maximum of the values added over the last `window`
+    seconds, in constant amortized time per value, using a monotonic
+    deque: a value is dropped as soon as a larger one is added after it,
+    as it can then no longer be the maximum of any window, so that the
+    values held are in decreasing order and the first is the maximum.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.entries = collections.deque()
+
+    def add(self, t, value):
+        entries = self.entries
+        if entries and t < entries[-1][0]:
+            # the clock went backward (e.g., a new log after a reboot)
+            entries.clear()
+        while entries and entries[-1][1] < value:
+            entries.pop()
+        entries.append((t, value))
+        self.expire(t)
+
+    def expire(self, now):
+        entries = self.entries
+        while entries and entries[0][0] <= now - self.window:
+            entries.popleft()
+
+    def max(self):
+        if self.entries:
+            return self.entries[0][1]
+        return None
+
+class LogFollower(object):
+    """
+    Follows a text log as it is written, returning the samples added to
+    it since the last call on each call to `read_samples()`. If the log
+    is truncated, it is read again from the start; if it is replaced
+    (e.g., rotated), what remains of the old log is read first, then the
+    new one from the start. Besides the overall peaks, keeps track of the
+    peaks over the last `window` seconds (by the poll times in the log),
+    which `expire()` brings up to date when the log stops growing.
+    """
+
+    def __init__(self, fpath, window):
+        self.fpath = fpath
+        self.logf = None
+        self.ino = None
+        self.columns = None
+        self.pending = b""
+        self.peaks = SyrupyPeaks(fpath)
+        self.num_samples = 0
+        self.window_peaks = dict((name, RollingMax(window)) for name in
+                ("mem", "rss", "vsize", "total_cpu", "total_rss", "total_vsize"))
+        # the poll time of the latest sample, whether it is given by the
+        # monotonic clock of the host that wrote the log (rather than the
+        # wall clock), and when it was read (by our monotonic clock)
+        self.last_poll_time = None
+        self.is_monotime = False
+        self.last_read_time = None
+
+    def open(self):
+        try:
+            self.logf = open(self.fpath, 'rb')
+        except IOError:
+            self.logf = None
+            return
+        self.ino = os.fstat(self.logf.fileno()).st_ino
+        self.columns = None
+        self.pending = b""
+
+    def read_samples(self):
+        if self.logf is None:
+            self.open()
+            if self.logf is None:
+                return 0
+        try:
+            st = os.stat(self.fpath)
+        except OSError:
+            st = None
+        num_samples = 0
+        if st is not None and st.st_ino != self.ino:
+            num_samples += self.read_lines()
+            self.logf.close()
+            self.open()
+        elif st is not None and st.st_size < self.logf.tell():
+            self.logf.seek(0)
+            self.columns = None
+            self.pending = b""
+        if self.logf is not None:
+            num_samples += self.read_lines()
+        return num_samples
+
+    def read_lines(self):
+        data = self.pending + self.logf.read()
+        lines = data.split(b"\n")
+        self.pending = lines.pop()
+        num_samples = 0
+        for line in lines:
+            parts = line.decode('utf-8', 'replace').split()
+            if not parts:
+                continue
+            if self.columns is None:
+                if parts[0] in ("PID", "PPID"):
+                    self.columns = parts
+                    continue
+                self.columns = TEXT_LOG_COLUMNS
+            if self.add_sample(parts):
+                num_samples += 1
+        return num_samples
+
+    def add_sample(self, parts):
+        row = dict(zip(self.columns, parts))
+        try:
+            sr = SyrupyRecord(filename=self.fpath)
+            sr.is_aggregate = row["PID"] == "TOTAL"
+            if not sr.is_aggregate:
+                sr.pid = int(row["PID"])
+            sr.date_text = row["DATE"]
+            sr.time_text = row["TIME"]
+            sr.elapsed_text = row["ELAPSED"]
+            sr.cpu = float(row["CPU"])
+            sr.mem = float(row["MEM"])
+            sr.rss = int(row["RSS"])
+            sr.vsize = int(row["VSIZE"])
+            if "MONOTIME" in row:
+                t = float(row["MONOTIME"])
+            else:
+                t = parse_log_datetime(sr.date_text, sr.time_text)
+        except (KeyError, ValueError):
+            return False
+        self.last_poll_time = t
+        self.is_monotime = "MONOTIME" in row
+        self.last_read_time = time.monotonic()
+        self.peaks.update(sr)
+        self.num_samples += 1
+        if sr.is_aggregate:
+            self.window_peaks["total_cpu"].add(t, sr.cpu)
+            self.window_peaks["total_rss"].add(t, sr.rss)
+            self.window_peaks["total_vsize"].add(t, sr.vsize)
+        else:
+            self.window_peaks["mem"].add(t, sr.mem)
+            self.window_peaks["rss"].add(t, sr.rss)
+            self.window_peaks["vsize"].add(t, sr.vsize)
+        return True
+
+    def expire(self):
+        """
+        Drops the values that have fallen out of the window by now, even
+        if the log has not grown since: the current time is taken to be
+        the poll time of the latest sample plus the time since it was read
+        (or, for logs without "MONOTIME", the wall clock time). Returns
+        True if any of the peaks over the window changed.
+        """
+        if self.last_poll_time is None:
+            return False
+        if self.is_monotime:
+            now = self.last_poll_time + time.monotonic() - self.last_read_time
+        else:
+            now = time.time()
+        changed = False
+        for rolling_max in self.window_peaks.values():
+            peak = rolling_max.max()
+            rolling_max.expire(now)
+            if rolling_max.max() != peak:
+                changed = True
+        return changed
+
+class FileWatcher(object):
+    """
+    Waits for changes to files, using inotify (on the directories holding
+    them, so as to notice files being created, replaced or rotated) where
+    available, or for a fixed time otherwise.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = 0x00000800
+
+    def __init__(self, fpaths):
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            inotify_init1 = libc.inotify_init1
+            inotify_add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError):
+            return
+        fd = inotify_init1(self.IN_NONBLOCK)
+        if fd < 0:
+            return
+        mask = self.IN_MODIFY | self.IN_MOVED_TO | self.IN_CREATE
+        for dpath in set(os.path.dirname(os.path.abspath(fpath)) for fpath in fpaths):
+            if inotify_add_watch(fd, dpath.encode(sys.getfilesystemencoding()), mask) < 0:
+                os.close(fd)
+                return
+        self.fd = fd
+
+    def wait(self, timeout):
+        """
+        Returns after `timeout` seconds, or as soon as a change is seen, if
+        changes can be watched for.
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        readable, writable, exceptional = select.select([self.fd], [], [], timeout)
+        if readable:
+            # the events themselves are not needed: all the files are
+            # checked after any change
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except OSError:
+                pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def follow_logs(logf_paths, window, refresh_interval):
+    """
+    Follows the logs `logf_paths` as they are written, reporting their
+    peaks, overall and over the last `window` seconds, after any change
+    (but at most every `refresh_interval` seconds), until interrupted.
+    """
+    followers = [LogFollower(logf_path, window) for logf_path in logf_paths]
+    watcher = FileWatcher(logf_paths)
+    window_text = ("%gs" % window) if window < 60 else ("%gm" % (window / 60))
+    clear_screen = sys.stdout.isatty()
+    gb = lambda kb: "-" if kb is None else "%0.4f" % (float(kb) / (1024 * 1024))
+    last_refresh = None
+    changed = True
+    try:
+        while True:
+            for follower in followers:
+                if follower.read_samples():
+                    changed = True
+                if follower.expire():
+                    changed = True
+            now = time.time()
+            if changed and (last_refresh is None or now - last_refresh >= refresh_interval):
+                cols = ["Log", "Samples", "Mem (%)", "RSS (GB)", "VM (GB)",
+                        "Mem %s (%%)" % window_text, "RSS %s (GB)" % window_text, "VM %s (GB)" % window_text]
+                has_totals = any(f.peaks.peak_total_rss is not None for f in followers)
+                if has_totals:
+                    cols.extend(["Total CPU (%)", "Total RSS (GB)", "Total VM (GB)",
+                        "Total CPU %s (%%)" % window_text, "Total RSS %s (GB)" % window_text,
+                        "Total VM %s (GB)" % window_text])
+                records = []
+                for follower in followers:
+                    sp = follower.peaks
+                    wp = follower.window_peaks
+                    values = [
+                        follower.fpath,
+                        follower.num_samples,
+                        sp.peak_mem.mem if sp.peak_mem is not None else "-",
+                        gb(sp.peak_rss.rss if sp.peak_rss is not None else None),
+                        gb(sp.peak_vsize.vsize if sp.peak_vsize is not None else None),
+                        wp["mem"].max() if wp["mem"].max() is not None else "-",
+                        gb(wp["rss"].max()),
+                        gb(wp["vsize"].max()),
+                    ]
+                    if has_totals:
+                        values.extend([
+                            sp.peak_total_cpu.cpu if sp.peak_total_cpu is not None else "-",
+                            gb(sp.peak_total_rss.rss if sp.peak_total_rss is not None else None),
+                            gb(sp.peak_total_vsize.vsize if sp.peak_total_vsize is not None else None),
+                            wp["total_cpu"].max() if wp["total_cpu"].max() is not None else "-",
+                            gb(wp["total_rss"].max()),
+                            gb(wp["total_vsize"].max()),
+                        ])
+                    records.append(dict(zip(cols, values)))
+                if clear_screen:
+                    sys.stdout.write("\x1b[H\x1b[2J")
+                sys.stdout.write(format_dict_table(rows=records, column_names=cols))
+                sys.stdout.write('\n')
+                sys.stdout.flush()
+                last_refresh = now
+                changed = False
+            if changed:
+                watcher.wait(max(refresh_interval - (now - last_refresh), 0))
+            else:
+                watcher.wait(refresh_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
 def main():
     parser = OptionParser(usage=_program_usage,
             add_help_option=True,
@@ -212,19 +1621,200 @@ def main():
             default=False,
             help='suppress progress messages')
 
+    parser.add_option('--convert',
+            action='store',
+            dest='convert',
+            default=None,
+            metavar='OUTPUT',
+            help='instead of analyzing the (single) given log, convert it from binary to ' \
+                +'text format or from text to binary format, and write the result to OUTPUT')
+
+    parser.add_option('--decode-raw',
+            action='store_true',
+            dest='decode_raw',
+            default=False,
+            help='instead of analyzing the (single) given log, decode it as a delta-encoded raw ' \
+                +'process log (as written with "--raw-log-format=delta") and write the process ' \
+                +'table sampled at every poll to standard output')
+
+    parser.add_option('--tick',
+            action='store',
+            dest='tick',
+            type=int,
+            default=None,
+            metavar='#',
+            help='with "--decode-raw", only write the process table sampled at poll number # ' \
+                +'(counting from 0)')
+
+    parser.add_option('-j', '--jobs',
+            action='store',
+            dest='jobs',
+            type=int,
+            default=1,
+            metavar='#',
+            help='number of processes analyzing logs in parallel (default=%default; 0 for one ' \
+                +'per CPU)')
+
+    parser.add_option('--chunk-size',
+            action='store',
+            dest='chunk_size',
+            type=float,
+            default=64,
+            metavar='MB',
+            help='with more than one job, split text logs larger than this many megabytes into ' \
+                +'parts analyzed in parallel (default=%default)')
+
+    parser.add_option('--checkpoint',
+            action='store_true',
+            dest='checkpoint',
+            default=False,
+            help='save the peaks found in each text log to a checkpoint file alongside it ' \
+                +"('<LOG>.checkpoint'), and, if there is one already, only analyze what has been " \
+                +'added to the log since; for logs that are still being written')
+
+    parser.add_option('-f', '--follow',
+            action='store_true',
+            dest='follow',
+            default=False,
+            help='follow the given text logs as they are written (even if rotated or ' \
+                +'truncated), continuously reporting their peaks, overall and over a recent ' \
+                +'window of time, until interrupted')
+
+    parser.add_option('--window',
+            action='store',
+            dest='window',
+            default='60s',
+            metavar='DURATION',
+            help='with "--follow", the window of time over which recent peaks are reported, ' \
+                +"in seconds, or minutes or hours with an 'm' or 'h' suffix (default=%default)")
+
+    parser.add_option('--refresh',
+            action='store',
+            dest='refresh',
+            type=float,
+            default=1.0,
+            metavar='#.##',
+            help='with "--follow", the minimum number of seconds between reports (default=%default)')
+
+    parser.add_option('--stats',
+            action='store_true',
+            dest='stats',
+            default=False,
+            help='also report statistics of the combined usage of the processes in each log, ' \
+                +'and across all logs: RSS percentiles, time-weighted means of RSS and memory use, ' \
+                +'and CPU time (requires NumPy)')
+
+    parser.add_option('--rss-threshold',
+            action='store',
+            dest='rss_threshold',
+            type=float,
+            default=None,
+            metavar='MB',
+            help='with "--stats", also report the time spent with the combined RSS above MB megabytes')
+
+    parser.add_option('--threads',
+            action='store_true',
+            dest='threads',
+            default=False,
+            help='instead of reporting peaks, rank the threads in the given thread logs ' \
+                +'(as written with "syrupy.py --threads"), and the pools they make up (threads ' \
+                +'named alike but for a number), by the CPU time they used')
+
+    parser.add_option('--top',
+            action='store',
+            dest='top',
+            type=int,
+            default=20,
+            metavar='#',
+            help='with "--threads", the number of threads and pools to report (default=%default; ' \
+                +'0 for all)')
+
     opts, args = parser.parse_args()
 
     if len(args) == 0:
         sys.exit("Path to Syrupy log files to be analyzed needs to be specifed.")
 
+    if opts.threads:
+        logf_paths = [os.path.expanduser(os.path.expandvars(a)) for a in args]
+        for logf_path in logf_paths:
+            if not os.path.exists(logf_path):
+                sys.exit("Log file not found: '%s'" % logf_path)
+        try:
+            threads, pools = rank_threads(logf_paths)
+        except ValueError as e:
+            sys.exit(str(e))
+        num_top = opts.top if opts.top > 0 else None
+        for thread in threads:
+            thread["CPU (s)"] = "%0.2f" % thread["CPU (s)"]
+            thread["Peak CPU (%)"] = "%0.1f" % thread["peak"]
+        for pool in pools:
+            pool["CPU (s)"] = "%0.2f" % pool["CPU (s)"]
+            pool["Peak thread CPU (%)"] = "%0.1f" % pool["Peak thread CPU (%)"]
+        cols = ["PID", "TID", "Name", "CPU (s)", "Peak CPU (%)"]
+        pool_cols = ["PID", "Pool", "Threads", "CPU (s)", "Peak thread CPU (%)"]
+        if len(logf_paths) > 1:
+            cols.insert(0, "Log")
+            pool_cols.insert(0, "Log")
+        sys.stdout.write(format_dict_table(rows=threads[:num_top], column_names=cols))
+        sys.stdout.write('\n')
+        sys.stdout.write(format_dict_table(rows=pools[:num_top], column_names=pool_cols))
+        sys.stdout.write('\n')
+        sys.exit(0)
+
+    if opts.decode_raw:
+        if len(args) != 1:
+            sys.exit("Exactly one raw log file can be decoded at a time.")
+        logf_path = os.path.expanduser(os.path.expandvars(args[0]))
+        if not os.path.exists(logf_path):
+            sys.exit("Log file not found: '%s'" % logf_path)
+        start_tick = opts.tick if opts.tick is not None else 0
+        for tick, rows in iter_raw_log_snapshots(logf_path, start_tick):
+            for row in rows:
+                sys.stdout.write(" ".join(row) + "\n")
+            if opts.tick is not None:
+                break
+        else:
+            if opts.tick is not None:
+                sys.exit("Poll %d not found in raw log: '%s'" % (opts.tick, logf_path))
+        sys.exit(0)
+
+    if opts.convert is not None:
+        if len(args) != 1:
+            sys.exit("Exactly one log file can be converted at a time.")
+        logf_path = os.path.expanduser(os.path.expandvars(args[0]))
+        if not os.path.exists(logf_path):
+            sys.exit("Log file not found: '%s'" % logf_path)
+        if is_binary_log(logf_path):
+            blog = BinarySyrupyLog(logf_path)
+            with open(opts.convert, 'w') as dest:
+                binary_to_text_log(blog, dest)
+            blog.close()
+        else:
+            with open(logf_path, 'r') as logf:
+                with open(opts.convert, 'wb') as dest:
+                    text_to_binary_log(logf, dest)
+        sys.exit(0)
+
+    if opts.follow:
+        try:
+            window = parse_duration(opts.window)
+        except ValueError:
+            sys.exit("Invalid window: '%s'" % opts.window)
+        follow_logs([os.path.expanduser(os.path.expandvars(a)) for a in args],
+                window,
+                opts.refresh)
+        sys.exit(0)
+
+    if opts.stats and numpy is None:
+        sys.exit("NumPy is required for '--stats'.")
+
     if opts.ignore_all_errors:
         opts.ignore_parse_errors = True
         opts.ignore_missing_errors = True
 
     logf_paths = [ os.path.expanduser(os.path.expandvars(a)) for a in args ]
-    overall_sp = SyrupyPeaks()
-    log_sp = []
-    num_processed = 0
+    tasks = []
+    checkpoints = {}
     for file_idx, logf_path in enumerate(logf_paths):
         if not os.path.exists(logf_path):
             if opts.ignore_missing_errors:
@@ -234,27 +1824,88 @@ def main():
             else:
                 sys.exit("Log file %d of %d not found: '%s'"
                             % (file_idx+1, len(logf_paths), logf_path))
-        if not opts.quiet:
-            sys.stderr.write("Processing log file %d of %d: '%s'\n"
+        log_desc = "log file %d of %d ('%s')" % (file_idx+1, len(logf_paths), logf_path)
+        start = 0
+        if opts.checkpoint and not is_binary_log(logf_path):
+            checkpoint = read_checkpoint(logf_path)
+            if checkpoint is not None:
+                checkpoints[file_idx], start = checkpoint
+                if not opts.quiet:
+                    sys.stderr.write("Resuming log file %d of %d at byte %d: '%s'\n"
+                            % (file_idx+1, len(logf_paths), start, logf_path))
+            elif os.path.exists(checkpoint_path(logf_path)) and not opts.quiet:
+                sys.stderr.write("Log file %d of %d has changed since its checkpoint, reanalyzing: '%s'\n"
                             % (file_idx+1, len(logf_paths), logf_path))
-        logf = open(logf_path, 'rU')
-        sp = SyrupyPeaks(logf_path)
-        log_sp.append(sp)
-        logf.readline()
-        for entry_idx, entry in enumerate(logf):
-            try:
-                sr = SyrupyRecord(text=entry.replace('\n', ''), filename=logf_path)
-            except SyrupyRecord.SyrupyRecordInsufficientFieldsError:
-                if opts.ignore_parse_errors:
-                    sys.stderr.write("Ignoring error parsing entry %d in log file %d of %d ('%s')\n"
-                            % (entry_idx+1, file_idx+1, len(logf_paths), logf_path))
-                else:
-                    raise
-            sp.update(sr)
-            overall_sp.update(sr)
-            ++num_processed
+        if opts.jobs == 1:
+            ranges = [(start, None)]
+        else:
+            ranges = split_log(logf_path, int(opts.chunk_size * 1024 * 1024), start)
+        for part_idx, (start, end) in enumerate(ranges):
+            tasks.append((file_idx, part_idx, (logf_path,
+                    start,
+                    end,
+                    opts.ignore_parse_errors,
+                    log_desc,
+                    opts.checkpoint)))
+
+    if opts.jobs == 1:
+        pool = None
+        results = map(analyze_log, [task for file_idx, part_idx, task in tasks])
+    else:
+        pool = multiprocessing.Pool(opts.jobs if opts.jobs > 0 else None)
+        results = pool.imap(analyze_log, [task for file_idx, part_idx, task in tasks])
+
+    # the parts are merged in the order of the logs and of the parts
+    # within each log, so as to get the same result as if all the
+    # records had been gone through one after the other
+    overall_sp = SyrupyPeaks()
+    log_sp = []
+    num_processed = 0
+    for (file_idx, part_idx, task), result in zip(tasks, results):
+        partial_sp, partial_num_processed, messages, end_offset = result
+        logf_path = task[0]
+        if part_idx == 0:
+            if not opts.quiet:
+                sys.stderr.write("Processing log file %d of %d: '%s'\n"
+                            % (file_idx+1, len(logf_paths), logf_path))
+            sp = SyrupyPeaks(logf_path)
+            log_sp.append(sp)
+            if file_idx in checkpoints:
+                sp.merge(checkpoints[file_idx])
+                overall_sp.merge(checkpoints[file_idx])
+        for message in messages:
+            sys.stderr.write(message)
+        sp.merge(partial_sp)
+        overall_sp.merge(partial_sp)
+        num_processed += partial_num_processed
+        if opts.checkpoint and end_offset is not None and task[2] is None:
+            write_checkpoint(logf_path, sp, end_offset)
+
+    if opts.stats:
+        rss_threshold = opts.rss_threshold * 1024 if opts.rss_threshold is not None else None
+        stats_tasks = [(sp.logf_path, rss_threshold, 1 << 16) for sp in log_sp]
+        if pool is None:
+            log_stats = list(map(compute_log_stats, stats_tasks))
+        else:
+            log_stats = pool.map(compute_log_stats, stats_tasks)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     cols = ["Log", "Mem (%)", "RSS (GB)", "VM (GB)"]
+    has_totals = overall_sp.peak_total_rss is not None
+    if has_totals:
+        cols.extend(["Total CPU (%)", "Total RSS (GB)", "Total VM (GB)"])
+    # true peaks from the run summaries, as opposed to sampled peaks
+    summary_cols = [
+        ("Max RSS (GB)", "ru_maxrss_kb"),
+        ("HWM RSS (GB)", "vm_hwm_kb"),
+        ("HWM VM (GB)", "vm_peak_kb"),
+    ]
+    summary_cols = [(col, key) for col, key in summary_cols
+            if any(key in sp.summary for sp in log_sp)]
+    cols.extend(col for col, key in summary_cols)
     records = []
     for sp in log_sp:
         d = {
@@ -263,10 +1914,66 @@ def main():
             "RSS (GB)": "%0.4f" % (float(sp.peak_rss.rss) / (1024 * 1024)),
             "VM (GB)" : "%0.4f" % (float(sp.peak_vsize.vsize) / (1024 * 1024))
         }
+        if has_totals:
+            if sp.peak_total_rss is not None:
+                d["Total CPU (%)"] = sp.peak_total_cpu.cpu
+                d["Total RSS (GB)"] = "%0.4f" % (float(sp.peak_total_rss.rss) / (1024 * 1024))
+                d["Total VM (GB)"] = "%0.4f" % (float(sp.peak_total_vsize.vsize) / (1024 * 1024))
+            else:
+                d["Total CPU (%)"] = "-"
+                d["Total RSS (GB)"] = "-"
+                d["Total VM (GB)"] = "-"
+        for col, key in summary_cols:
+            if key in sp.summary:
+                d[col] = "%0.4f" % (float(sp.summary[key]) / (1024 * 1024))
+            else:
+                d[col] = "-"
         records.append(d)
     sys.stdout.write(format_dict_table(rows=records, column_names=cols))
     sys.stdout.write('\n')
 
+    if opts.stats:
+        cols = ["Log", "RSS p50 (GB)", "RSS p95 (GB)", "RSS p99 (GB)", "Mean RSS (GB)", "Mean Mem (%)", "CPU (s)"]
+        if opts.rss_threshold is not None:
+            threshold_col = "Time > %s MB (s)" % ("%g" % opts.rss_threshold)
+            cols.append(threshold_col)
+        overall_stats = SyrupyStats()
+        rows = []
+        for sp, stats in zip(log_sp, log_stats):
+            overall_stats.merge(stats)
+            rows.append((sp.logf_path, stats))
+        if len(log_stats) > 1:
+            rows.append(("(all logs)", overall_stats))
+        if overall_stats.has_interval_cpu:
+            cols.extend(["User CPU (s)", "Sys CPU (s)", "Peak CPU (%)"])
+        if overall_stats.has_pss:
+            cols.extend(["Peak PSS (GB)", "Mean PSS (GB)"])
+        records = []
+        gb = lambda kb: "-" if kb is None else "%0.4f" % (float(kb) / (1024 * 1024))
+        for name, stats in rows:
+            d = {
+                "Log": name,
+                "RSS p50 (GB)": gb(stats.rss_percentile(50)),
+                "RSS p95 (GB)": gb(stats.rss_percentile(95)),
+                "RSS p99 (GB)": gb(stats.rss_percentile(99)),
+                "Mean RSS (GB)": gb(stats.mean_rss()),
+                "Mean Mem (%)": "-" if stats.mean_mem() is None else "%0.1f" % stats.mean_mem(),
+                "CPU (s)": "%0.1f" % stats.cpu_seconds,
+            }
+            if opts.rss_threshold is not None:
+                d[threshold_col] = "%0.1f" % stats.time_above_threshold
+            if stats.has_interval_cpu:
+                d["User CPU (s)"] = "%0.1f" % stats.user_cpu_seconds
+                d["Sys CPU (s)"] = "%0.1f" % stats.system_cpu_seconds
+                d["Peak CPU (%)"] = "%0.1f" % stats.peak_interval_cpu
+            else:
+                d["User CPU (s)"] = d["Sys CPU (s)"] = d["Peak CPU (%)"] = "-"
+            d["Peak PSS (GB)"] = gb(stats.peak_pss)
+            d["Mean PSS (GB)"] = gb(stats.mean_pss())
+            records.append(d)
+        sys.stdout.write(format_dict_table(rows=records, column_names=cols))
+        sys.stdout.write('\n')
+
 if __name__ == '__main__':
     main()
 
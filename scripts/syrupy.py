@@ -31,9 +31,29 @@ import re
 import time
 import sys
 import os
+import errno
 import datetime
 import textwrap
 import locale
+import shlex
+import asyncio
+import signal
+import struct
+import operator
+import json
+import zlib
+import lzma
+import threading
+import queue
+import atexit
+import array
+import bisect
+import contextlib
+import resource
+import math
+import tempfile
+import shutil
+import heapq
 
 ON_POSIX = 'posix' in sys.builtin_module_names
 ENCODING = locale.getdefaultlocale()[1]
@@ -48,6 +68,14 @@ PS_FIELDS = [
     'vsz',
 ]
 
+# The stages of a poll timed for the self-metrics (see `SelfMetrics`):
+# starting the sampling process (if any), reading the process table,
+# parsing it into records and writing the logs
+SAMPLE_STAGES = ["spawn", "read", "parse", "write"]
+
+ETIME_COL = PS_FIELDS.index('etime')
+CPU_COL = PS_FIELDS.index('%cpu')
+MEM_COL = PS_FIELDS.index('%mem')
 RSS_COL = PS_FIELDS.index('rss')
 VSZ_COL = PS_FIELDS.index('vsz')
 
@@ -97,6 +125,103 @@ PS_FIELD_HELP = [
     process is currently using (in kiloBytes). This includes the amount
     in RAM (the resident set size) as well as the amount in swap."""
     ],
+    ["MONOTIME",
+    """
+    The reading of the system's monotonic clock, in seconds, at the time
+    the process was polled. Unlike DATE and TIME, this is never adjusted,
+    so the differences between readings give the true intervals between
+    polls."""
+    ],
+    ["USR",
+    """
+    Only when the process table is read from '/proc' (see '--sampler'):
+    the user CPU utilization of the process over the polling interval
+    that ended when it was polled, i.e., the user CPU time it used since
+    the previous poll divided by the time between the polls, expressed
+    as a percentage (which may exceed 100 for a process with several
+    busy threads). When the process is first polled, the utilization
+    since it started is given instead."""
+    ],
+    ["SYS",
+    """
+    Only when the process table is read from '/proc': the system
+    (kernel) CPU utilization of the process over the polling interval,
+    as for USR."""
+    ],
+    ["READ",
+    """
+    Only with '--metrics=io': the rate at which the process read data
+    from storage over the polling interval, in kiloBytes per second (as
+    counted by 'read_bytes' in '/proc/<pid>/io', which is only readable
+    for processes of the same user; otherwise "-")."""
+    ],
+    ["WRITE",
+    """
+    Only with '--metrics=io': the rate at which the process wrote data
+    to storage over the polling interval, in kiloBytes per second."""
+    ],
+    ["MINFLT",
+    """
+    Only with '--metrics=faults': the rate of minor page faults (those
+    served without reading from disk) over the polling interval, per
+    second."""
+    ],
+    ["MAJFLT",
+    """
+    Only with '--metrics=faults': the rate of major page faults (those
+    that required reading a page from disk or swap) over the polling
+    interval, per second."""
+    ],
+    ["VCSW",
+    """
+    Only with '--metrics=ctxsw': the rate of voluntary context switches
+    (the process waiting, e.g., for I/O or a lock) over the polling
+    interval, per second. As given by '/proc/<pid>/status', this only
+    counts the main thread of the process."""
+    ],
+    ["NVCSW",
+    """
+    Only with '--metrics=ctxsw': the rate of involuntary context
+    switches (the process being preempted) over the polling interval,
+    per second, of the main thread of the process."""
+    ],
+    ["THREADS",
+    """
+    Only with '--metrics=threads': the number of threads of the process
+    when it was polled."""
+    ],
+    ["FDS",
+    """
+    Only with '--metrics=fds': the number of file descriptors the
+    process had open when it was polled."""
+    ],
+    ["PSS",
+    """
+    Only with '--metrics=pss': Proportional Set Size -- the resident
+    memory of the process (in kiloBytes), with each page shared with
+    other processes counted in proportion to the number of processes
+    sharing it, so that, unlike RSS, the PSS of a group of processes
+    adds up to the memory they use. Read from '/proc/<pid>/smaps_rollup'
+    only every '--smaps-interval' seconds."""
+    ],
+    ["USS",
+    """
+    Only with '--metrics=pss': Unique Set Size -- the resident memory
+    of the process (in kiloBytes) that is not shared with any other
+    process, i.e., that would be freed if it exited."""
+    ],
+    ["SWAP",
+    """
+    Only with '--metrics=pss': the proportional share of the process in
+    the swapped-out memory (in kiloBytes), counted as for PSS."""
+    ],
+    ["INTERVAL",
+    """
+    Only with '--burst-interval': the polling interval, in seconds, in
+    effect when the process was polled, i.e., the regular interval, the
+    burst interval, or an intermediate interval while returning from a
+    burst to the regular one."""
+    ],
     ["CMD",
      """
 	 Running process path and command line arguments."""
@@ -124,108 +249,2166 @@ def pretty_timestamp(t=None, style=0):
     else:
         return time.strftime("%Y%m%d%H%M%S", t)
 
+def format_etime(seconds):
+    """
+    Formats a duration in seconds the way `ps` reports the 'etime'
+    field: "[[DD-]HH:]MM:SS".
+    """
+    seconds = max(int(seconds), 0)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    mins, secs = divmod(seconds, 60)
+    if days:
+        return "%d-%02d:%02d:%02d" % (days, hours, mins, secs)
+    elif hours:
+        return "%02d:%02d:%02d" % (hours, mins, secs)
+    else:
+        return "%02d:%02d" % (mins, secs)
+
+def format_permille(value):
+    """
+    Formats a per-mille quantity as a percentage the way `ps` does for
+    the '%cpu' and '%mem' fields: one decimal place below 100%, whole
+    numbers above.
+    """
+    value = max(int(value), 0)
+    if value >= 1000:
+        return "%d" % (value // 10)
+    return "%d.%d" % (value // 10, value % 10)
+
+class PsSampler(object):
+    """
+    Samples the process table by running `ps -A`, locally or, if `ssh_id`
+    is given, on a remote host through `ssh`. This works on any POSIX
+    system, but forks a shell and `ps` on every call.
+    """
+
+    name = "ps"
+
+    def __init__(self, ssh_id=None, ssh_command="ssh {host}", debug_level=0):
+        self.ssh_id = ssh_id
+        self.debug_level = debug_level
+        self.timings = {"spawn": 0.0, "read": 0.0, "parse": 0.0}
+        ps_args = [ '-o %s=""' % s for s in PS_FIELDS + ["command"]]
+        self.ps_invocation = "ps -A %s" % (" ".join(ps_args))
+        if ssh_id is not None:
+            self.ps_invocation = ssh_command.format(host=ssh_id) + " " + self.ps_invocation
+
+    def sample(self, raw=False):
+        """
+        Returns a tuple, `(rows, raw_text)`, where `rows` is a list of
+        lists of field values (as strings, in the order given by
+        `PS_FIELDS` followed by the command) and `raw_text` is the
+        unprocessed `ps` output. The time taken by each stage of the
+        sample (see `SAMPLE_STAGES`; for `ps`, "read" includes the time
+        `ps` takes to run) is stored in `timings`.
+        """
+        if self.debug_level >= 3:
+            sys.stderr.write("\n" + self.ps_invocation + "\n")
+        start = time.perf_counter()
+        ps = subprocess.Popen(self.ps_invocation,
+            shell=True,
+            stdout=subprocess.PIPE)
+        spawned = time.perf_counter()
+        stdout, stderr = communicate(ps)
+        stdout = stdout.strip()
+        read = time.perf_counter()
+        if self.debug_level >= 9:
+            sys.stderr.write(stdout + "\n")
+        rows = self.parse(stdout)
+        self.timings = {"spawn": spawned - start, "read": read - spawned, "parse": time.perf_counter() - read}
+        return rows, stdout
+
+    def close(self):
+        pass
+
+    def parse(self, text):
+        # we are relying on all the fields but the last (the command +
+        # args) NOT to contain any space; we'll use this fact to parse
+        # out columns
+        non_command_cols = len(PS_FIELDS)
+        rows = []
+        for row in text.split("\n"):
+            if not row:
+                continue
+            fields = re.split("\s+", row.strip(), non_command_cols)
+            if self.debug_level >= 5:
+                sys.stderr.write(str(fields) + "\n")
+            if len(fields) != non_command_cols + 1:
+                sys.stderr.write("SYRUPY: Skipping sample: found only %d columns: %s\n" % (len(fields), fields))
+                continue
+            rows.append(fields)
+        return rows
+
+# Run on the remote host by `RemoteSampler`: every line received on
+# standard input triggers one call of the command given as the first
+# argument, the output of which is written back to standard output as a
+# frame: a "SYRUPY-FRAME <length>" header line followed by <length>
+# bytes of data.
+REMOTE_AGENT_SOURCE = """\
+import subprocess, sys
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+while sys.stdin.readline():
+    data = subprocess.Popen(sys.argv[1], shell=True, stdout=subprocess.PIPE).communicate()[0].strip()
+    out.write(('SYRUPY-FRAME %d\\n' % len(data)).encode('ascii'))
+    out.write(data)
+    out.flush()
+"""
+
+class RemoteSampler(PsSampler):
+    """
+    Samples the process table of a remote host through a single,
+    long-lived SSH session, instead of connecting anew for every sample
+    as `PsSampler` does. A small agent program (`REMOTE_AGENT_SOURCE`) is
+    started on the remote host, which calls `ps` on request and sends
+    back the results as length-prefixed frames. If the session fails,
+    it is re-established, up to `max_retries` times in a row.
+
+    `ssh_command` is the command used to open the session, with "{host}"
+    standing for `ssh_id`; the agent invocation is appended to it as a
+    single argument. Substituting, e.g., "sh -c" runs the agent locally.
+    """
+
+    name = "agent"
+
+    def __init__(self,
+            ssh_id,
+            ssh_command="ssh {host}",
+            remote_python="python3",
+            max_retries=3,
+            debug_level=0):
+        PsSampler.__init__(self, debug_level=debug_level)
+        self.ssh_id = ssh_id
+        self.max_retries = max_retries
+        self.session_invocation = shlex.split(ssh_command.format(host=ssh_id))
+        self.session_invocation.append("%s -c %s %s" % (remote_python,
+                shlex.quote(REMOTE_AGENT_SOURCE),
+                shlex.quote(self.ps_invocation)))
+        self.session = None
+
+    def connect(self):
+        if self.debug_level >= 3:
+            sys.stderr.write("\n" + " ".join(self.session_invocation) + "\n")
+        self.session = subprocess.Popen(self.session_invocation,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+
+    def close(self):
+        if self.session is not None:
+            try:
+                self.session.stdin.close()
+            except (IOError, OSError):
+                pass
+            if self.session.poll() is None:
+                self.session.terminate()
+            self.session.wait()
+            self.session.stdout.close()
+            self.session = None
+
+    def request_frame(self):
+        self.session.stdin.write(b"\n")
+        self.session.stdin.flush()
+        header = self.session.stdout.readline().split()
+        if len(header) != 2 or header[0] != b"SYRUPY-FRAME":
+            raise IOError("Unexpected response from remote sampling agent: %s" % header)
+        size = int(header[1])
+        data = self.session.stdout.read(size)
+        if len(data) != size:
+            raise IOError("Remote sampling agent session closed unexpectedly")
+        return data
+
+    def sample(self, raw=False):
+        attempt = 0
+        start = time.perf_counter()
+        spawned = start
+        while True:
+            try:
+                if self.session is None:
+                    self.connect()
+                    spawned = time.perf_counter()
+                data = self.request_frame()
+                break
+            except (IOError, OSError, ValueError) as e:
+                self.close()
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise IOError("Failed to sample remote host '%s': %s" % (self.ssh_id, e))
+                sys.stderr.write("SYRUPY: Remote sampling session failed (%s); reconnecting\n" % e)
+                time.sleep(min(2 ** (attempt - 1), 10))
+        read = time.perf_counter()
+        stdout = data.decode(ENCODING)
+        if self.debug_level >= 9:
+            sys.stderr.write(stdout + "\n")
+        rows = self.parse(stdout)
+        self.timings = {"spawn": spawned - start, "read": read - spawned, "parse": time.perf_counter() - read}
+        return rows, stdout
+
+class AsyncRemoteSampler(RemoteSampler):
+    """
+    The asyncio counterpart of `RemoteSampler`, used to sample many hosts
+    concurrently (see `profile_fleet()`). Its `sample()` and `close()`
+    methods are coroutines. Each session runs in its own process group,
+    so that it can be torn down completely (e.g., when it has timed out)
+    without waiting on anything it may have left running.
+    """
+
+    name = "agent-async"
+
+    async def connect(self):
+        if self.debug_level >= 3:
+            sys.stderr.write("\n" + " ".join(self.session_invocation) + "\n")
+        self.session = await asyncio.create_subprocess_exec(*self.session_invocation,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                start_new_session=True)
+
+    async def close(self):
+        if self.session is not None:
+            session = self.session
+            self.session = None
+            try:
+                os.killpg(session.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            await session.wait()
+
+    async def request_frame(self):
+        self.session.stdin.write(b"\n")
+        await self.session.stdin.drain()
+        header = (await self.session.stdout.readline()).split()
+        if len(header) != 2 or header[0] != b"SYRUPY-FRAME":
+            raise IOError("Unexpected response from remote sampling agent: %s" % header)
+        try:
+            return await self.session.stdout.readexactly(int(header[1]))
+        except asyncio.IncompleteReadError:
+            raise IOError("Remote sampling agent session closed unexpectedly")
+
+    async def sample(self, raw=False):
+        attempt = 0
+        start = time.perf_counter()
+        spawned = start
+        while True:
+            try:
+                if self.session is None:
+                    await self.connect()
+                    spawned = time.perf_counter()
+                data = await self.request_frame()
+                break
+            except (IOError, OSError, ValueError) as e:
+                await self.close()
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise IOError("Failed to sample remote host '%s': %s" % (self.ssh_id, e))
+                sys.stderr.write("SYRUPY: Remote sampling session with '%s' failed (%s); reconnecting\n"
+                        % (self.ssh_id, e))
+                await asyncio.sleep(min(2 ** (attempt - 1), 10))
+        read = time.perf_counter()
+        stdout = data.decode(ENCODING)
+        if self.debug_level >= 9:
+            sys.stderr.write(stdout + "\n")
+        rows = self.parse(stdout)
+        self.timings = {"spawn": spawned - start, "read": read - spawned, "parse": time.perf_counter() - read}
+        return rows, stdout
+
+# `ps` shows control characters in command lines as '?'
+CONTROL_CHARACTERS = bytes.maketrans(bytes(range(1, 32)) + b"\x7f", b"?" * 32)
+
+class ProcSampler(object):
+    """
+    Samples the process table by reading `/proc/<pid>/stat`,
+    `/proc/<pid>/statm` and `/proc/<pid>/cmdline` directly (Linux only),
+    producing the same fields as `ps` without forking anything. The
+    cumulative CPU times of the processes sampled last are kept in
+    `cpu_times`, as a dictionary of PID: `(start time (clock ticks since
+    boot), user CPU time (s), system CPU time (s), elapsed time (s))`
+    (see `CpuIntervalTracker`).
+    """
+
+    name = "proc"
+
+    def __init__(self, proc_root="/proc", debug_level=0):
+        self.proc_root = proc_root
+        self.debug_level = debug_level
+        self.timings = {"spawn": 0.0, "read": 0.0, "parse": 0.0}
+        self.cpu_times = {}
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.page_kb = os.sysconf("SC_PAGE_SIZE") // 1024
+        self.mem_total_kb = None
+        with open(os.path.join(proc_root, "meminfo"), "rb") as src:
+            for line in src:
+                if line.startswith(b"MemTotal:"):
+                    self.mem_total_kb = int(line.split()[1])
+                    break
+
+    def sample(self, raw=False):
+        """
+        Returns a tuple, `(rows, raw_text)`, as `PsSampler.sample()`
+        does. `raw_text` is rendered in `ps` layout only if `raw` is True,
+        and is None otherwise.
+        """
+        start = time.perf_counter()
+        parse_seconds = 0.0
+        self.cpu_times = {}
+        uptime = self.read_uptime()
+        rows = []
+        for entry in os.listdir(self.proc_root):
+            if not entry.isdigit():
+                continue
+            contents = self.read_process_files(entry)
+            if contents is None:
+                continue
+            parse_start = time.perf_counter()
+            fields = self.parse_process(entry, *contents, uptime=uptime)
+            parse_seconds += time.perf_counter() - parse_start
+            if fields is not None:
+                rows.append(fields)
+        if self.debug_level >= 5:
+            for fields in rows:
+                sys.stderr.write(str(fields) + "\n")
+        raw_text = None
+        if raw:
+            parse_start = time.perf_counter()
+            raw_text = format_ps_rows(rows)
+            parse_seconds += time.perf_counter() - parse_start
+        self.timings = {"spawn": 0.0, "read": time.perf_counter() - start - parse_seconds, "parse": parse_seconds}
+        return rows, raw_text
+
+    def close(self):
+        pass
+
+    def read_uptime(self):
+        with open(os.path.join(self.proc_root, "uptime"), "rb") as src:
+            return float(src.read().split()[0])
+
+    def read_process(self, pid, uptime):
+        """
+        Returns the `ps`-equivalent fields of process `pid`, or None if
+        the process has gone away in the meantime.
+        """
+        contents = self.read_process_files(pid)
+        if contents is None:
+            return None
+        return self.parse_process(pid, *contents, uptime=uptime)
+
+    def read_process_files(self, pid):
+        """
+        Returns a tuple, `(stat, statm, cmdline)`, giving the contents of
+        the files describing process `pid`, or None if the process has
+        gone away in the meantime.
+        """
+        pid_dir = os.path.join(self.proc_root, pid)
+        try:
+            with open(os.path.join(pid_dir, "stat"), "rb") as src:
+                stat = src.read()
+            with open(os.path.join(pid_dir, "statm"), "rb") as src:
+                statm = src.read()
+            with open(os.path.join(pid_dir, "cmdline"), "rb") as src:
+                cmdline = src.read()
+        except (IOError, OSError):
+            return None
+        return stat, statm, cmdline
+
+    def parse_process(self, pid, stat, statm, cmdline, uptime):
+        # the command name in 'stat' is parenthesized and may itself
+        # contain spaces or parentheses, so we split after the last ')'
+        comm_end = stat.rfind(b")")
+        comm = stat[stat.find(b"(")+1:comm_end].decode(ENCODING, "replace")
+        stat_fields = stat[comm_end+2:].split()
+        statm_fields = statm.split()
+        if len(stat_fields) < 22 or len(statm_fields) < 2:
+            return None
+        ppid = stat_fields[1].decode()
+        utime_ticks = int(stat_fields[11])
+        stime_ticks = int(stat_fields[12])
+        cpu_ticks = utime_ticks + stime_ticks
+        start_ticks = int(stat_fields[19])
+        elapsed = uptime - (float(start_ticks) / self.clock_ticks)
+        self.cpu_times[pid] = (start_ticks,
+                float(utime_ticks) / self.clock_ticks,
+                float(stime_ticks) / self.clock_ticks,
+                elapsed)
+        vsz = int(statm_fields[0]) * self.page_kb
+        rss = int(statm_fields[1]) * self.page_kb
+        if elapsed > 0:
+            pcpu = (cpu_ticks * 1000.0 / self.clock_ticks) / elapsed
+        else:
+            pcpu = 0
+        if self.mem_total_kb:
+            pmem = rss * 1000.0 / self.mem_total_kb
+        else:
+            pmem = 0
+        if cmdline:
+            command = cmdline.rstrip(b"\0").replace(b"\0", b" ").translate(CONTROL_CHARACTERS)
+            command = command.decode(ENCODING, "replace")
+        else:
+            command = "[%s]" % comm
+            if stat_fields[0] == b"Z":
+                command += " <defunct>"
+        return [pid,
+                ppid,
+                format_etime(elapsed),
+                format_permille(pcpu),
+                format_permille(pmem),
+                str(rss),
+                str(vsz),
+                command]
+
+def pread_all(fd, chunk_size=4096):
+    """
+    Reads the entire contents of the file open on descriptor `fd` from
+    the beginning, without moving the file offset.
+    """
+    data = os.pread(fd, chunk_size, 0)
+    if len(data) < chunk_size:
+        return data
+    chunks = [data]
+    offset = len(data)
+    while True:
+        data = os.pread(fd, chunk_size, offset)
+        if not data:
+            break
+        chunks.append(data)
+        offset += len(data)
+    return b"".join(chunks)
+
+class ProcPidSampler(ProcSampler):
+    """
+    Samples only the processes with the given PIDs, instead of scanning
+    the whole process table. The `/proc/<pid>/stat`, `statm` and
+    `cmdline` files of each process are opened once and kept open, and
+    simply re-read on every call, so that the cost of sampling does not
+    depend on the number of processes on the host. A process that has
+    exited (and been reaped) is dropped for good: its descriptors refer
+    to the original process, so a later process that reuses the PID is
+    never picked up by mistake.
+    """
+
+    name = "proc-pid"
+
+    def __init__(self, pids, proc_root="/proc", debug_level=0):
+        ProcSampler.__init__(self, proc_root=proc_root, debug_level=debug_level)
+        self.uptime_fd = os.open(os.path.join(proc_root, "uptime"), os.O_RDONLY)
+        self.pid_fds = {}
+        for pid in pids:
+            pid = str(pid)
+            fds = []
+            try:
+                for fname in ("stat", "statm", "cmdline"):
+                    fds.append(os.open(os.path.join(proc_root, pid, fname), os.O_RDONLY))
+            except (IOError, OSError):
+                for fd in fds:
+                    os.close(fd)
+                continue
+            self.pid_fds[pid] = fds
+
+    def sample(self, raw=False):
+        start = time.perf_counter()
+        parse_seconds = 0.0
+        self.cpu_times = {}
+        uptime = self.read_uptime()
+        rows = []
+        for pid in list(self.pid_fds):
+            stat_fd, statm_fd, cmdline_fd = self.pid_fds[pid]
+            try:
+                stat = pread_all(stat_fd)
+                statm = pread_all(statm_fd)
+                cmdline = pread_all(cmdline_fd)
+            except (IOError, OSError):
+                self.release(pid)
+                continue
+            parse_start = time.perf_counter()
+            fields = self.parse_process(pid, stat, statm, cmdline, uptime)
+            parse_seconds += time.perf_counter() - parse_start
+            if fields is not None:
+                rows.append(fields)
+        raw_text = None
+        if raw:
+            parse_start = time.perf_counter()
+            raw_text = format_ps_rows(rows)
+            parse_seconds += time.perf_counter() - parse_start
+        self.timings = {"spawn": 0.0, "read": time.perf_counter() - start - parse_seconds, "parse": parse_seconds}
+        return rows, raw_text
+
+    def read_uptime(self):
+        return float(pread_all(self.uptime_fd).split()[0])
+
+    def release(self, pid):
+        for fd in self.pid_fds.pop(pid):
+            os.close(fd)
+
+    def close(self):
+        for pid in list(self.pid_fds):
+            self.release(pid)
+        if self.uptime_fd is not None:
+            os.close(self.uptime_fd)
+            self.uptime_fd = None
+
+SAMPLERS = ["auto", "proc", "ps", "agent"]
+
+def create_sampler(name="auto",
+        ssh_id=None,
+        ssh_command="ssh {host}",
+        pids=None,
+        debug_level=0):
+    """
+    Returns a process table sampler backend: "proc" reads the Linux
+    `/proc` filesystem directly, "ps" calls `ps` (locally or, if `ssh_id`
+    is given, through a new SSH connection every time), and "agent" calls
+    `ps` on remote host `ssh_id` through a persistent SSH session. "auto"
+    selects "agent" when sampling a remote host, and otherwise "proc" when
+    it is available and "ps" if not. If `pids` is given, the "proc"
+    backend reads only the files of those processes (see
+    `ProcPidSampler`).
+    """
+    if name == "auto":
+        if ssh_id is not None:
+            name = "agent"
+        elif os.path.exists("/proc/self/statm"):
+            name = "proc"
+        else:
+            name = "ps"
+    if name == "proc":
+        if ssh_id is not None:
+            raise ValueError("The 'proc' sampler cannot be used to sample a remote host")
+        if pids is not None:
+            return ProcPidSampler(pids, debug_level=debug_level)
+        return ProcSampler(debug_level=debug_level)
+    elif name == "ps":
+        return PsSampler(ssh_id=ssh_id, ssh_command=ssh_command, debug_level=debug_level)
+    elif name == "agent":
+        if ssh_id is None:
+            raise ValueError("The 'agent' sampler requires a remote host ('--ssh')")
+        return RemoteSampler(ssh_id, ssh_command=ssh_command, debug_level=debug_level)
+    else:
+        raise ValueError("Unrecognized sampler: '%s'" % name)
+
+class ProcessTree(object):
+    """
+    Tracks the tree of processes descended from the process with PID
+    `root_pid`, using the PID and PPID fields of the sampled rows. The
+    parent-to-children index is kept across samples and only patched for
+    processes that have appeared, disappeared or been re-parented since
+    the previous sample, rather than being rebuilt every time.
+    """
+
+    def __init__(self, root_pid):
+        self.root_pid = str(root_pid)
+        self.parents = {}
+        self.children = {}
+
+    def update(self, rows):
+        current = {}
+        for fields in rows:
+            current[fields[0]] = fields[1]
+        for pid in [p for p in self.parents if p not in current]:
+            self.children.get(self.parents.pop(pid), set()).discard(pid)
+            if not self.children.get(pid, True):
+                del self.children[pid]
+        for pid, ppid in current.items():
+            old_ppid = self.parents.get(pid)
+            if old_ppid != ppid:
+                if old_ppid is not None:
+                    self.children[old_ppid].discard(pid)
+                self.parents[pid] = ppid
+                self.children.setdefault(ppid, set()).add(pid)
+
+    def members(self):
+        """
+        Returns the set of PIDs of the root process (if it is still
+        running) and all its descendants.
+        """
+        members = set()
+        if self.root_pid in self.parents:
+            members.add(self.root_pid)
+        to_visit = [self.root_pid]
+        while to_visit:
+            for child in self.children.get(to_visit.pop(), ()):
+                if child not in members:
+                    members.add(child)
+                    to_visit.append(child)
+        return members
+
+class CpuIntervalTracker(object):
+    """
+    Computes the CPU utilization of processes over each polling interval,
+    rather than over their whole lifetime (as the "CPU" column does, and
+    which hardly moves for a long-running process), from the cumulative
+    user and system CPU times read by the sampler (see
+    `ProcSampler.cpu_times`). The times of the previous poll are kept,
+    keyed by PID, and a process is matched to them only if its start time
+    is the same, so that a process that reuses the PID of one that has
+    gone away is never charged with the difference. For a process that
+    was not seen in the previous poll, the utilization since it started
+    is given instead.
+    """
+
+    def __init__(self):
+        self.previous_times = {}
+        self.previous_monotime = None
+
+    def update(self, records, cpu_times, poll_monotime):
+        """
+        Stores the user and system CPU utilization (%) of each of
+        `records` under "usr" and "sys" (or "-" where not known), given
+        the `cpu_times` of the current poll, taken at `poll_monotime`.
+        """
+        if self.previous_monotime is not None:
+            interval = poll_monotime - self.previous_monotime
+        else:
+            interval = 0
+        for sample in records:
+            current = cpu_times.get(sample.pid)
+            if current is None:
+                sample['usr'] = sample['sys'] = "-"
+                continue
+            start, utime, stime, elapsed = current
+            previous = self.previous_times.get(sample.pid)
+            if previous is not None and previous[0] == start and interval > 0:
+                utime -= previous[1]
+                stime -= previous[2]
+                elapsed = interval
+            if elapsed > 0:
+                sample['usr'] = "%.1f" % (max(utime, 0) * 100.0 / elapsed)
+                sample['sys'] = "%.1f" % (max(stime, 0) * 100.0 / elapsed)
+            else:
+                sample['usr'] = sample['sys'] = "0.0"
+        self.previous_times = cpu_times
+        self.previous_monotime = poll_monotime
+
+# Additional metrics that can be sampled for the polled processes (see
+# `MetricsTracker`): the file under `/proc/<pid>` they are read from
+# ("fd" being the directory of open file descriptors), and the columns
+# they add, as `(field name, header, key, scale)` tuples, where `key` is
+# the name of the value in the file (or its position, for "stat"; or a
+# tuple of names, for the sum of the values), and `scale`, for a
+# cumulative count, the divisor giving its rate per second (for a value
+# that is not cumulative, `scale` is None)
+PROCESS_METRICS = {
+    "io": ("io", [("read_kbps", "READ", "read_bytes", 1024.0),
+                  ("write_kbps", "WRITE", "write_bytes", 1024.0)]),
+    "faults": ("stat", [("minflt", "MINFLT", 7, 1.0),
+                        ("majflt", "MAJFLT", 9, 1.0)]),
+    "ctxsw": ("status", [("vcsw", "VCSW", "voluntary_ctxt_switches", 1.0),
+                         ("nvcsw", "NVCSW", "nonvoluntary_ctxt_switches", 1.0)]),
+    "threads": ("status", [("threads", "THREADS", "Threads", None)]),
+    "fds": ("fd", [("fds", "FDS", None, None)]),
+    "pss": ("smaps_rollup", [("pss", "PSS", "Pss", None),
+                             ("uss", "USS", ("Private_Clean", "Private_Dirty"), None),
+                             ("swap_pss", "SWAP", "SwapPss", None)]),
+}
+
+# Sources that are expensive to read (the kernel walks all the memory
+# mappings of the process), and so are only read every `slow_interval`
+# seconds (see `MetricsTracker`)
+SLOW_METRIC_SOURCES = ["smaps_rollup"]
+
+class MetricsTracker(object):
+    """
+    Adds the `PROCESS_METRICS` named in `metrics` to the samples of the
+    polled processes, reading only the files under `/proc/<pid>` that
+    they need, and only for the polled processes (Linux only). Cumulative
+    counts are turned into rates over the polling interval, from the
+    counts of the previous poll; as for `CpuIntervalTracker`, a process
+    is only matched to its previous counts if it has the same start time
+    (where the sampler gives it), and for a process that was not seen in
+    the previous poll, the rate since it started is given instead.
+    Values that cannot be read (e.g., the I/O counts of a process
+    belonging to another user) are given as "-". The
+    `SLOW_METRIC_SOURCES` are only read every `slow_interval` seconds
+    (and when a process is first polled), their values being repeated in
+    between.
+    """
+
+    def __init__(self, metrics, proc_root="/proc", slow_interval=10.0):
+        self.proc_root = proc_root
+        self.slow_interval = slow_interval
+        self.sources = []
+        self.slow_sources = []
+        self.fields = []
+        for name in metrics:
+            source, fields = PROCESS_METRICS[name]
+            sources = self.slow_sources if source in SLOW_METRIC_SOURCES else self.sources
+            if source not in sources:
+                sources.append(source)
+            for field in fields:
+                self.fields.append((source,) + field)
+        self.previous_counts = {}
+        self.previous_monotime = None
+        self.has_smaps_rollup = True
+        # the contents of the slow sources as last read: PID: (start time,
+        # contents)
+        self.slow_contents = {}
+        self.slow_monotime = None
+
+    def columns(self):
+        """
+        Returns the `(field name, header)` tuples of the columns added.
+        """
+        return [(field_name, header) for source, field_name, header, key, scale in self.fields]
+
+    def read(self, pid, sources):
+        """
+        Returns a dictionary of the contents of each of the source files
+        `sources` of process `pid`, by source, leaving out those that
+        cannot be read.
+        """
+        contents = {}
+        pid_dir = os.path.join(self.proc_root, pid)
+        for source in sources:
+            try:
+                if source == "fd":
+                    contents[source] = len(os.listdir(os.path.join(pid_dir, "fd")))
+                    continue
+                if source == "smaps_rollup" and not self.has_smaps_rollup:
+                    fname = "smaps"
+                else:
+                    fname = source
+                with open(os.path.join(pid_dir, fname), "rb") as src:
+                    data = src.read()
+            except (IOError, OSError) as exc:
+                if source == "smaps_rollup" and self.has_smaps_rollup \
+                        and exc.errno == errno.ENOENT \
+                        and os.path.exists(os.path.join(pid_dir, "stat")):
+                    # the process is still there, but the kernel (before
+                    # 4.14) only gives the values of each mapping, which
+                    # we add up instead from now on
+                    self.has_smaps_rollup = False
+                    contents.update(self.read(pid, [source]))
+                continue
+            if source == "stat":
+                contents[source] = data[data.rfind(b")")+2:].split()
+            elif source == "smaps_rollup":
+                values = {}
+                for line in data.split(b"\n"):
+                    parts = line.split()
+                    if len(parts) == 3 and parts[0].endswith(b":") and parts[2] == b"kB":
+                        key = parts[0][:-1].decode()
+                        values[key] = values.get(key, 0) + int(parts[1])
+                contents[source] = values
+            else:
+                values = {}
+                for line in data.split(b"\n"):
+                    key, sep, value = line.partition(b":")
+                    if sep:
+                        values[key.decode()] = value.strip()
+                contents[source] = values
+        return contents
+
+    def update(self, records, cpu_times, poll_monotime):
+        """
+        Stores the metrics of each of `records` under their field names,
+        given the `cpu_times` of the current poll (see
+        `ProcSampler.cpu_times`; may be None), taken at `poll_monotime`.
+        """
+        values = self.measure([sample.fields for sample in records], cpu_times, poll_monotime)
+        for sample in records:
+            for field_name, value in values[sample.pid].items():
+                sample[field_name] = value
+
+    def measure(self, rows, cpu_times, poll_monotime):
+        """
+        Returns a dictionary of PID: {field name: value} giving the
+        metrics of the processes of the sampled `rows`, as for `update()`.
+        """
+        if self.previous_monotime is not None:
+            interval = poll_monotime - self.previous_monotime
+        else:
+            interval = 0
+        refresh_slow = self.slow_monotime is None \
+                or poll_monotime - self.slow_monotime >= self.slow_interval - interval / 2
+        if refresh_slow:
+            self.slow_monotime = poll_monotime
+        counts = {}
+        slow_contents = {}
+        values = {}
+        for fields in rows:
+            pid = fields[0]
+            contents = self.read(pid, self.sources)
+            if cpu_times is not None and pid in cpu_times:
+                start, utime, stime, elapsed = cpu_times[pid]
+            else:
+                start, elapsed = None, parse_etime(fields[ETIME_COL])
+            if self.slow_sources:
+                cached = self.slow_contents.get(pid)
+                if refresh_slow or cached is None or cached[0] != start:
+                    cached = (start, self.read(pid, self.slow_sources))
+                slow_contents[pid] = cached
+                contents.update(cached[1])
+            previous = self.previous_counts.get(pid)
+            if previous is not None and previous[0] != start:
+                previous = None
+            current = {}
+            process_values = values[pid] = {}
+            for source, field_name, header, key, scale in self.fields:
+                try:
+                    if source == "fd":
+                        value = contents[source]
+                    elif isinstance(key, tuple):
+                        value = sum(contents[source][k] for k in key)
+                    elif source == "smaps_rollup":
+                        value = contents[source][key]
+                    else:
+                        value = int(contents[source][key].split()[0])
+                except (KeyError, IndexError, ValueError):
+                    process_values[field_name] = "-"
+                    continue
+                if scale is None:
+                    process_values[field_name] = str(value)
+                    continue
+                current[field_name] = value
+                if previous is not None and field_name in previous[1] \
+                        and interval > 0 and value >= previous[1][field_name]:
+                    rate = (value - previous[1][field_name]) / interval
+                elif elapsed > 0:
+                    rate = value / float(elapsed)
+                else:
+                    rate = 0.0
+                process_values[field_name] = "%.1f" % (rate / scale)
+            counts[pid] = (start, current)
+        self.previous_counts = counts
+        self.slow_contents = slow_contents
+        self.previous_monotime = poll_monotime
+        return values
+
+# Columns of the thread log (see `ThreadTracker`, `write_thread_samples()`)
+THREAD_LOG_COLUMNS = ["PID", "TID", "DATE", "TIME", "MONOTIME", "USR", "SYS", "UTIME", "STIME", "NAME"]
+
+class ThreadTracker(object):
+    """
+    Samples the threads of the polled processes, by reading
+    `/proc/<pid>/task/<tid>/stat` (Linux only): the name of each thread,
+    its cumulative user and system CPU times, and its user and system CPU
+    utilization over the polling interval (as `CpuIntervalTracker` does
+    for processes). The threads of each process are listed on every poll,
+    but the stat file of a thread is only opened when it first appears,
+    kept open while it runs, and closed once it has exited.
+    """
+
+    def __init__(self, proc_root="/proc"):
+        self.proc_root = proc_root
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.uptime_fd = os.open(os.path.join(proc_root, "uptime"), os.O_RDONLY)
+        # (PID, TID): descriptor of the open stat file
+        self.task_fds = {}
+        # (PID, TID): (start time (clock ticks since boot), user CPU time
+        # (s), system CPU time (s))
+        self.previous_times = {}
+        self.previous_monotime = None
+        self.num_started = 0
+        self.num_exited = 0
+
+    def update(self, pids, poll_monotime):
+        """
+        Returns a list of `(pid, tid, name, usr, sys, utime, stime)`
+        tuples describing the threads of the processes with PIDs `pids`,
+        sampled at `poll_monotime`, the values being formatted as in the
+        thread log.
+        """
+        if self.previous_monotime is not None:
+            interval = poll_monotime - self.previous_monotime
+        else:
+            interval = 0
+        uptime = float(pread_all(self.uptime_fd).split()[0])
+        threads = []
+        current = {}
+        for pid in pids:
+            try:
+                tids = os.listdir(os.path.join(self.proc_root, pid, "task"))
+            except (IOError, OSError):
+                continue
+            for tid in tids:
+                key = (pid, tid)
+                fd = self.task_fds.get(key)
+                if fd is None:
+                    try:
+                        fd = os.open(os.path.join(self.proc_root, pid, "task", tid, "stat"), os.O_RDONLY)
+                    except (IOError, OSError):
+                        continue
+                    self.task_fds[key] = fd
+                    self.num_started += 1
+                try:
+                    stat = pread_all(fd)
+                except (IOError, OSError):
+                    continue
+                comm_end = stat.rfind(b")")
+                name = stat[stat.find(b"(")+1:comm_end].translate(CONTROL_CHARACTERS).decode(ENCODING, "replace")
+                stat_fields = stat[comm_end+2:].split()
+                if len(stat_fields) < 22:
+                    continue
+                start = int(stat_fields[19])
+                utime = float(stat_fields[11]) / self.clock_ticks
+                stime = float(stat_fields[12]) / self.clock_ticks
+                current[key] = (start, utime, stime)
+                previous = self.previous_times.get(key)
+                if previous is not None and previous[0] == start and interval > 0:
+                    elapsed = interval
+                    usr = utime - previous[1]
+                    sys_time = stime - previous[2]
+                else:
+                    elapsed = uptime - float(start) / self.clock_ticks
+                    usr = utime
+                    sys_time = stime
+                if elapsed > 0:
+                    usr_text = "%.1f" % (max(usr, 0) * 100.0 / elapsed)
+                    sys_text = "%.1f" % (max(sys_time, 0) * 100.0 / elapsed)
+                else:
+                    usr_text = sys_text = "0.0"
+                threads.append((pid, tid, name, usr_text, sys_text, "%.2f" % utime, "%.2f" % stime))
+        # threads that have exited (or whose process is no longer polled)
+        for key in [k for k in self.task_fds if k not in current]:
+            os.close(self.task_fds.pop(key))
+            self.num_exited += 1
+        self.previous_times = current
+        self.previous_monotime = poll_monotime
+        return threads
+
+    def close(self):
+        for key in list(self.task_fds):
+            os.close(self.task_fds.pop(key))
+        if self.uptime_fd is not None:
+            os.close(self.uptime_fd)
+            self.uptime_fd = None
+
+def write_thread_samples(dest, threads, tick, separator="  "):
+    """
+    Writes the samples of `threads` (see `ThreadTracker.update()`), taken
+    at `tick` (a `PollTick`), to `dest`, one line each, in the columns
+    given by `THREAD_LOG_COLUMNS`.
+    """
+    for pid, tid, name, usr, sys_text, utime, stime in threads:
+        dest.write(separator.join([pid,
+                tid,
+                tick.values[1],
+                tick.values[2],
+                tick.values[3],
+                usr,
+                sys_text,
+                utime,
+                stime,
+                name]) + "\n")
+
+class PeakTracker(object):
+    """
+    Tracks the true peak memory usage of polled processes, independently
+    of how often they are polled, by reading the high-water marks kept by
+    the kernel ("VmHWM", the peak resident set size, and "VmPeak", the
+    peak virtual memory size) from `/proc/<pid>/status` (Linux only). The
+    status file of each process is kept open between polls, and the marks
+    of processes that have gone away are retained. If the process was
+    executed by Syrupy, its maximum resident set size as reported by the
+    kernel when it is reaped is recorded as well (see `record_rusage()`),
+    together with its wall-clock run time, from when it was spawned (see
+    `record_spawn()`) to when it was reaped.
+    """
+
+    def __init__(self, proc_root="/proc"):
+        self.proc_root = proc_root
+        self.status_fds = {}
+        self.vm_hwm = {}
+        self.vm_peak = {}
+        self.exit_status = None
+        self.ru_maxrss = None
+        self.ru_utime = None
+        self.ru_stime = None
+        self.spawn_time = None
+        self.spawn_maxrss = None
+        self.wall_seconds = None
+
+    def update(self, pids):
+        for pid in pids:
+            if pid not in self.status_fds:
+                try:
+                    self.status_fds[pid] = os.open(os.path.join(self.proc_root, pid, "status"), os.O_RDONLY)
+                except (IOError, OSError):
+                    continue
+            try:
+                status = pread_all(self.status_fds[pid])
+            except (IOError, OSError):
+                os.close(self.status_fds.pop(pid))
+                continue
+            for line in status.split(b"\n"):
+                if line.startswith(b"VmHWM:"):
+                    self.vm_hwm[pid] = max(self.vm_hwm.get(pid, 0), int(line.split()[1]))
+                elif line.startswith(b"VmPeak:"):
+                    self.vm_peak[pid] = max(self.vm_peak.get(pid, 0), int(line.split()[1]))
+        for pid in [p for p in self.status_fds if p not in pids]:
+            os.close(self.status_fds.pop(pid))
+
+    def record_spawn(self):
+        """
+        Records the time at which the process executed by Syrupy is
+        spawned, and the peak RSS of Syrupy itself by then, which the
+        maximum RSS of the process inherits from the forked copy of Syrupy
+        that executed it.
+        """
+        self.spawn_time = time.monotonic()
+        self.spawn_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            self.spawn_maxrss //= 1024
+
+    def record_rusage(self, status, rusage):
+        """
+        Records the exit status and resource usage of a reaped process, as
+        returned by `os.wait4()`.
+        """
+        if self.spawn_time is not None:
+            self.wall_seconds = time.monotonic() - self.spawn_time
+        self.exit_status = os.waitstatus_to_exitcode(status)
+        if sys.platform == "darwin":
+            self.ru_maxrss = rusage.ru_maxrss // 1024
+        else:
+            self.ru_maxrss = rusage.ru_maxrss
+        self.ru_utime = rusage.ru_utime
+        self.ru_stime = rusage.ru_stime
+
+    def peak_rss(self):
+        """
+        Returns the peak RSS (kB) of the polled processes: the highest of
+        their high-water marks and, if it exceeds the RSS that the process
+        executed by Syrupy inherited on being forked (and so must be its
+        own), its maximum RSS as reported on reaping, which covers any
+        peak reached after the last poll. If the process exited before any
+        high-water mark could be read, its maximum RSS is returned
+        regardless, as an upper bound, or None if that is not known either.
+        """
+        peaks = list(self.vm_hwm.values())
+        if self.ru_maxrss is not None \
+                and (self.spawn_maxrss is None or self.ru_maxrss > self.spawn_maxrss or not peaks):
+            peaks.append(self.ru_maxrss)
+        return max(peaks) if peaks else None
+
+    def close(self):
+        for pid in list(self.status_fds):
+            os.close(self.status_fds.pop(pid))
+
+    def summary(self):
+        """
+        Returns a list of `(key, value)` tuples describing the peaks, to be
+        written to the run summary.
+        """
+        summary = []
+        if self.vm_hwm:
+            summary.append(("vm_hwm_kb", max(self.vm_hwm.values())))
+        if self.vm_peak:
+            summary.append(("vm_peak_kb", max(self.vm_peak.values())))
+        if self.ru_maxrss is not None:
+            summary.append(("exit_status", self.exit_status))
+            summary.append(("ru_maxrss_kb", self.ru_maxrss))
+            summary.append(("ru_utime_s", "%.3f" % self.ru_utime))
+            summary.append(("ru_stime_s", "%.3f" % self.ru_stime))
+        return summary
+
+def write_run_summary(dest, entries):
+    """
+    Writes the `(key, value)` tuples in `entries` to `dest`, one per line,
+    as "key: value".
+    """
+    for key, value in entries:
+        dest.write("%s: %s\n" % (key, " ".join(str(value).split("\n"))))
+
+def parse_etime(etime):
+    """
+    Returns the number of seconds given by a duration in the format used
+    by `ps` for the 'etime' field, "[[DD-]HH:]MM:SS".
+    """
+    days, sep, rest = etime.rpartition("-")
+    seconds = 0
+    for part in rest.split(":"):
+        seconds = seconds * 60 + int(part)
+    if sep:
+        seconds += int(days) * 86400
+    return seconds
+
+# Binary sample log format (see `BinaryLogWriter`); this must be kept in
+# sync with `syrupy-peak.py`, which reads (and writes) it as well.
+BINARY_LOG_MAGIC = b"SYRUPYB\x01"
+BINARY_LOG_VERSION = 2
+# magic, version, record size, number of records, string table offset,
+# number of strings, number of extra columns, offset of the first record
+# (version 1 logs have no extra columns, and these are 0)
+BINARY_LOG_HEADER = struct.Struct("<8sIIQQQII16x")
+# pid, ppid, poll time (seconds since the epoch), poll monotonic time,
+# elapsed seconds, %cpu, %mem, rss (kB), vsize (kB), command string index,
+# flags; followed by the value of each extra column, as a double (NaN if
+# not known)
+BINARY_LOG_RECORD = struct.Struct("<iidddffqqiI")
+BINARY_LOG_AGGREGATE_FLAG = 1
+
+def binary_log_value(text):
+    """
+    Returns the value of an extra column of the text log, `text`, as
+    stored in a binary log: a float, NaN if the value is not known ("-").
+    """
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return float("nan")
+
+class BinaryLogWriter(object):
+    """
+    Writes samples to `dest` (a file opened in binary mode) as a compact
+    binary log instead of text: a fixed-size header, followed by one
+    fixed-size record of typed fields (`BINARY_LOG_RECORD`) per sample,
+    followed, once the log is closed, by a table of the distinct command
+    strings, which the records refer to by index. The header gives the
+    number of records and the position of the string table; until the
+    log is closed, these are 0 (a reader can still recover the records
+    of a log that was not closed cleanly from the size of the file).
+
+    The values of the columns that the text log has in addition to those
+    of `BINARY_LOG_RECORD` (e.g., "USR", "PSS" or "INTERVAL") are appended
+    to each record. These columns are given by `set_columns()`, which
+    writes the header and their names, between the header and the first
+    record.
+    """
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.num_records = 0
+        self.strings = {}
+        self.extra_names = None
+        self.record_struct = None
+        self.data_offset = None
+
+    def set_columns(self, extra_columns):
+        """
+        Starts the log, with the additional columns `extra_columns`, a
+        list of `(field name, header)` tuples (see `output_format()`).
+        Has no effect if the log has already been started.
+        """
+        if self.record_struct is not None:
+            return
+        self.extra_names = [name for name, header in extra_columns]
+        self.record_struct = struct.Struct(BINARY_LOG_RECORD.format + "d" * len(extra_columns))
+        names = b"".join(struct.pack("<I", len(header.encode("utf-8"))) + header.encode("utf-8")
+                for name, header in extra_columns)
+        self.data_offset = BINARY_LOG_HEADER.size + len(names)
+        self.write_header()
+        self.dest.write(names)
+
+    def write_header(self, strtab_offset=0, num_strings=0):
+        self.dest.write(BINARY_LOG_HEADER.pack(BINARY_LOG_MAGIC,
+                BINARY_LOG_VERSION,
+                self.record_struct.size,
+                self.num_records,
+                strtab_offset,
+                num_strings,
+                len(self.extra_names),
+                self.data_offset))
+
+    def write_records(self, records):
+        if self.record_struct is None:
+            self.set_columns([])
+        pack = self.record_struct.pack
+        extra_names = self.extra_names
+        chunks = []
+        for sample in records:
+            fields = sample.fields
+            command = fields[-1]
+            command_idx = self.strings.get(command)
+            if command_idx is None:
+                command_idx = self.strings[command] = len(self.strings)
+            if sample.pid == "TOTAL":
+                pid, ppid, flags = -1, -1, BINARY_LOG_AGGREGATE_FLAG
+            else:
+                pid, ppid, flags = int(sample.pid), int(fields[1]), 0
+            chunks.append(pack(pid,
+                    ppid,
+                    sample.tick.timestamp,
+                    sample.tick.monotime,
+                    parse_etime(fields[ETIME_COL]),
+                    sample.cpu,
+                    sample.mem,
+                    sample.rss,
+                    sample.vsz,
+                    command_idx,
+                    flags,
+                    *[binary_log_value(sample[name]) for name in extra_names]))
+        self.dest.write(b"".join(chunks))
+        self.num_records += len(chunks)
+
+    def flush(self):
+        self.dest.flush()
+
+    def close(self):
+        if self.record_struct is None:
+            self.set_columns([])
+        strtab_offset = self.dest.tell()
+        strings = sorted(self.strings, key=self.strings.get)
+        for string in strings:
+            data = string.encode("utf-8")
+            self.dest.write(struct.pack("<I", len(data)) + data)
+        self.dest.seek(0)
+        self.write_header(strtab_offset, len(strings))
+        self.dest.close()
+
+# Compression formats of delta-encoded raw logs: the file name extension
+# and a function returning a new compressor object for each
+RAW_LOG_COMPRESSION = {
+    "gzip": (".gz", lambda: zlib.compressobj(9, zlib.DEFLATED, 31)),
+    "zlib": (".zz", lambda: zlib.compressobj(9)),
+    "lzma": (".xz", lambda: lzma.LZMACompressor(lzma.FORMAT_XZ)),
+}
+
+class DeltaRawLogWriter(object):
+    """
+    Writes the raw process table samples to `dest` (a file opened in
+    binary mode) as deltas against the previous sample instead of in
+    full. Each sample ("tick") is written as one line of JSON: either a
+    keyframe, `{"t": TICK, "n": KEY_FIELDS, "k": ROWS}`, giving all rows
+    of the sample, or
+    a delta, `{"t": TICK, "a": [[POSITION, ROW], ...], "r": [KEY, ...],
+    "c": {KEY: [[FIELD, VALUE], ...], ...}}`, giving the rows added (and
+    their positions in the sample), the keys of the rows removed, and the
+    fields that changed in the remaining rows. A row is identified by a
+    key made up of its first `key_fields` fields (i.e., the PID, or the
+    host and PID in fleet mode).
+
+    A keyframe is written every `keyframe_interval` ticks (and whenever
+    the rows cannot be described as a delta, e.g. because their order
+    changed). Each keyframe starts a new, independently compressed,
+    member of the file (a gzip member, zlib stream or xz stream,
+    depending on `compression`), and its tick and offset in the file is
+    written to `index` (a text file), so that a reader can start decoding
+    at the keyframe preceding any given tick.
+    """
+
+    def __init__(self,
+            dest,
+            index=None,
+            compression="gzip",
+            keyframe_interval=100,
+            key_fields=1):
+        self.dest = dest
+        self.index = index
+        self.new_compressor = RAW_LOG_COMPRESSION[compression][1]
+        self.compressor = None
+        self.keyframe_interval = keyframe_interval
+        self.key_fields = key_fields
+        self.ticks = 0
+        self.previous = {}
+        self.previous_keys = []
+
+    def write_rows(self, rows):
+        keys = [" ".join(row[:self.key_fields]) for row in rows]
+        current = dict(zip(keys, rows))
+        entry = None
+        if self.ticks % self.keyframe_interval != 0 and len(current) == len(rows):
+            entry = self.delta(keys, current)
+        if entry is None:
+            self.start_member()
+            entry = {"t": self.ticks, "n": self.key_fields, "k": rows}
+        else:
+            entry["t"] = self.ticks
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        self.dest.write(self.compressor.compress(line.encode("utf-8")))
+        self.previous = current
+        self.previous_keys = keys
+        self.ticks += 1
+
+    def delta(self, keys, current):
+        """
+        Returns the delta from the previous rows to the rows given by
+        `keys` and `current`, or None if there is no such delta.
+        """
+        kept = [key for key in keys if key in self.previous]
+        if kept != [key for key in self.previous_keys if key in current]:
+            return None
+        entry = {}
+        added = [[idx, current[key]] for idx, key in enumerate(keys) if key not in self.previous]
+        if added:
+            entry["a"] = added
+        removed = [key for key in self.previous_keys if key not in current]
+        if removed:
+            entry["r"] = removed
+        changed = {}
+        for key in kept:
+            old, new = self.previous[key], current[key]
+            if old != new:
+                if len(old) != len(new):
+                    return None
+                changed[key] = [[idx, value] for idx, (old_value, value) in enumerate(zip(old, new))
+                        if old_value != value]
+        if changed:
+            entry["c"] = changed
+        return entry
+
+    def start_member(self):
+        if self.compressor is not None:
+            self.dest.write(self.compressor.flush())
+        self.compressor = self.new_compressor()
+        if self.index is not None:
+            self.index.write("%d %d\n" % (self.ticks, self.dest.tell()))
+            self.index.flush()
+
+    def flush(self):
+        # xz streams cannot be flushed short of ending them, so with
+        # 'lzma' compression the data only reaches the file a member at a
+        # time
+        if self.compressor is not None and not isinstance(self.compressor, lzma.LZMACompressor):
+            self.dest.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.dest.flush()
+
+    def close(self):
+        if self.compressor is not None:
+            self.dest.write(self.compressor.flush())
+            self.compressor = None
+        self.dest.close()
+        if self.index is not None:
+            self.index.close()
+
+class BackgroundWriter(object):
+    """
+    Writes to `dest` (a file) from a background thread, so that slow
+    writes (e.g., to a file system mounted over the network) do not delay
+    sampling. Data passed to `write()` is queued, up to `queue_size`
+    writes, and written in batches. The file is flushed (and synced to
+    disk) once written data has been waiting for `flush_interval` seconds
+    or `flush_size` bytes have been written since the last flush, so that
+    data reaches the file within `flush_interval` seconds of being
+    written, while `flush()` itself does nothing.
+
+    If the queue is full, `write()` waits for room or, if
+    `drop_when_full` is True (which is only safe for a log made up of
+    lines written whole), drops the data, counting it in `dropped`.
+    `close()` (which is also called on exit) writes all the queued data
+    and closes `dest`, reporting the number of writes dropped, if any.
+    Errors in the background thread are raised by the next call of
+    `write()` or `close()`.
+    """
+
+    # queued to make the background thread finish
+    _finish = object()
+
+    def __init__(self,
+            dest,
+            flush_interval=2.0,
+            flush_size=256 * 1024,
+            queue_size=10000,
+            drop_when_full=False):
+        self.dest = dest
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.drop_when_full = drop_when_full
+        self.queue = queue.Queue(queue_size)
+        self.writes = 0
+        self.dropped = 0
+        self.error = None
+        self.closed = False
+        try:
+            # kept up to date by `write()` for `tell()`, for files opened
+            # in binary mode
+            self.position = dest.tell()
+        except (IOError, ValueError):
+            self.position = None
+        self.thread = threading.Thread(target=self.run, name="syrupy-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    @property
+    def name(self):
+        return getattr(self.dest, "name", "?")
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.writes += 1
+        if self.drop_when_full:
+            try:
+                self.queue.put_nowait(data)
+            except queue.Full:
+                self.dropped += 1
+                return
+        else:
+            self.queue.put(data)
+        if self.position is not None:
+            self.position += len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset):
+        # writes already queued go where they were meant to
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+        self.dest.seek(offset)
+        self.position = offset
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(self._finish)
+        self.thread.join()
+        if self.dropped:
+            sys.stderr.write("SYRUPY: Write queue full: dropped %d of %d writes to '%s'\n"
+                    % (self.dropped, self.writes, self.name))
+        if self.dest is sys.stdout:
+            self.dest.flush()
+        else:
+            self.dest.close()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        unflushed = 0
+        flush_deadline = None
+        finished = False
+        while not finished:
+            if flush_deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, flush_deadline - time.monotonic())
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch and batch[-1] is self._finish:
+                finished = True
+                batch.pop()
+            try:
+                if batch and self.error is None:
+                    data = batch[0][:0].join(batch)
+                    self.dest.write(data)
+                    unflushed += len(data)
+                    if flush_deadline is None:
+                        flush_deadline = time.monotonic() + self.flush_interval
+                if unflushed and (finished
+                        or unflushed >= self.flush_size
+                        or time.monotonic() >= flush_deadline):
+                    self.dest.flush()
+                    try:
+                        os.fsync(self.dest.fileno())
+                    except (IOError, ValueError):
+                        # not a file on disk (e.g., a pipe or terminal)
+                        pass
+                    unflushed = 0
+                    flush_deadline = None
+            except (IOError, ValueError) as e:
+                # the remaining writes are discarded, so that the
+                # sampling loop is not held up; the error is raised by its
+                # next write
+                self.error = e
+                unflushed = 0
+                flush_deadline = None
+            for _ in range(len(batch) + (1 if finished else 0)):
+                self.queue.task_done()
+
+def aggregate_records(records, command):
+    """
+    Returns a record giving the combined resource usage of `records`,
+    identified by "TOTAL" in place of the PID and `command` in place of
+    the command.
+    """
+    total = Sample(["TOTAL",
+            "-",
+            records[0].fields[ETIME_COL],
+            "%.1f" % sum(r.cpu for r in records),
+            "%.1f" % sum(r.mem for r in records),
+            str(sum(r.rss for r in records)),
+            str(sum(r.vsz for r in records)),
+            command], records[0].tick)
+    # the additional values (interval CPU utilization, metrics) are summed
+    for key in records[0].extra or ():
+        texts = [r[key] for r in records if r[key] != "-"]
+        if not texts:
+            total[key] = "-"
+        elif any('.' in text for text in texts):
+            total[key] = "%.1f" % sum(float(text) for text in texts)
+        else:
+            total[key] = str(sum(int(text) for text in texts))
+    return total
+
+def format_ps_rows(rows):
+    """
+    Renders sampled rows in the space-separated layout of `ps` output.
+    """
+    return "\n".join(" ".join(fields) for fields in rows)
+
+class SelfMetrics(object):
+    """
+    Measures the overhead of Syrupy itself on every poll: the time taken
+    by each stage of the poll (see `SAMPLE_STAGES`), how late the poll
+    started relative to its deadline (the jitter), the number of ticks
+    missed before it, and the RSS and CPU time of Syrupy's own process.
+    If `dest` is given, the measurements of each poll are written to it,
+    one line per poll; `summary()` and `report()` summarize the polls
+    made so far.
+    """
+
+    columns = ["TICK", "MONOTIME"] \
+            + ["%s_MS" % stage.upper() for stage in SAMPLE_STAGES] \
+            + ["POLL_MS", "JITTER_MS", "MISSED", "RSS", "CPU_S"]
+
+    def __init__(self, dest=None, separator="  ", headers=True):
+        self.dest = dest
+        self.separator = separator
+        self.ticks = 0
+        self.stage_seconds = dict.fromkeys(SAMPLE_STAGES, 0.0)
+        self.poll_seconds = 0.0
+        self.max_poll_seconds = 0.0
+        self.jitter_seconds = 0.0
+        self.max_jitter_seconds = 0.0
+        self.missed_ticks = 0
+        self.peak_rss = 0
+        self.start = time.monotonic()
+        self.start_cpu_time = time.process_time()
+        self.poll_start = None
+        self.jitter = 0.0
+        self.page_kb = os.sysconf("SC_PAGE_SIZE") // 1024
+        try:
+            self.statm_fd = os.open("/proc/self/statm", os.O_RDONLY)
+        except (IOError, OSError):
+            self.statm_fd = None
+        if dest is not None and headers:
+            dest.write(separator.join(self.columns) + "\n")
+
+    def own_rss(self):
+        if self.statm_fd is not None:
+            return int(pread_all(self.statm_fd).split()[1]) * self.page_kb
+        # without /proc, only the peak is available
+        ru_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            return ru_maxrss // 1024
+        return ru_maxrss
+
+    def begin_poll(self, scheduler):
+        self.poll_start = time.monotonic()
+        self.jitter = max(self.poll_start - scheduler.next_deadline, 0.0)
+
+    def end_poll(self, timings, scheduler):
+        poll_seconds = time.monotonic() - self.poll_start
+        missed = scheduler.missed_ticks - self.missed_ticks
+        self.missed_ticks = scheduler.missed_ticks
+        rss = self.own_rss()
+        cpu_time = time.process_time() - self.start_cpu_time
+        self.ticks += 1
+        for stage in SAMPLE_STAGES:
+            self.stage_seconds[stage] += timings.get(stage, 0.0)
+        self.poll_seconds += poll_seconds
+        self.max_poll_seconds = max(self.max_poll_seconds, poll_seconds)
+        self.jitter_seconds += self.jitter
+        self.max_jitter_seconds = max(self.max_jitter_seconds, self.jitter)
+        self.peak_rss = max(self.peak_rss, rss)
+        if self.dest is not None:
+            self.dest.write(self.separator.join(["%d" % self.ticks, "%.3f" % self.poll_start]
+                    + ["%.3f" % (timings.get(stage, 0.0) * 1000) for stage in SAMPLE_STAGES]
+                    + ["%.3f" % (poll_seconds * 1000),
+                       "%.3f" % (self.jitter * 1000),
+                       "%d" % missed,
+                       "%d" % rss,
+                       "%.3f" % cpu_time]) + "\n")
+
+    def close(self):
+        if self.statm_fd is not None:
+            os.close(self.statm_fd)
+            self.statm_fd = None
+
+    def summary(self):
+        """
+        Returns a list of `(key, value)` tuples summarizing the overhead,
+        to be written to the run summary.
+        """
+        if not self.ticks:
+            return []
+        cpu_time = time.process_time() - self.start_cpu_time
+        elapsed = time.monotonic() - self.start
+        summary = [("self_polls", self.ticks),
+                ("self_poll_ms_mean", "%.3f" % (self.poll_seconds * 1000 / self.ticks)),
+                ("self_poll_ms_max", "%.3f" % (self.max_poll_seconds * 1000))]
+        for stage in SAMPLE_STAGES:
+            summary.append(("self_%s_ms_mean" % stage, "%.3f" % (self.stage_seconds[stage] * 1000 / self.ticks)))
+        summary.extend([("self_jitter_ms_mean", "%.3f" % (self.jitter_seconds * 1000 / self.ticks)),
+                ("self_jitter_ms_max", "%.3f" % (self.max_jitter_seconds * 1000)),
+                ("self_missed_ticks", self.missed_ticks),
+                ("self_rss_peak_kb", self.peak_rss),
+                ("self_cpu_s", "%.3f" % cpu_time),
+                ("self_cpu_percent", "%.2f" % (cpu_time * 100 / elapsed if elapsed > 0 else 0))])
+        return summary
+
+    def report(self):
+        """
+        Returns the lines of the end-of-run report on the overhead.
+        """
+        if not self.ticks:
+            return []
+        summary = dict(self.summary())
+        return ["SYRUPY: Overhead per poll: %s ms mean, %s ms max (%s)" % (summary["self_poll_ms_mean"],
+                        summary["self_poll_ms_max"],
+                        ", ".join("%s %s ms" % (stage, summary["self_%s_ms_mean" % stage])
+                                for stage in SAMPLE_STAGES)),
+                "SYRUPY: Poll jitter: %s ms mean, %s ms max" % (summary["self_jitter_ms_mean"],
+                        summary["self_jitter_ms_max"]),
+                "SYRUPY: Syrupy CPU time: %s s (%s%%); peak RSS: %s kB" % (summary["self_cpu_s"],
+                        summary["self_cpu_percent"],
+                        summary["self_rss_peak_kb"])]
+
+class FixedRateScheduler(object):
+    """
+    Paces polls at a fixed rate of one every `interval` seconds, by
+    waiting until absolute deadlines on the monotonic clock rather than
+    sleeping for `interval` seconds after each poll, so that the time
+    taken by the polls themselves does not make the rate drift. If a poll
+    overruns one or more deadlines, these ticks are skipped (and counted
+    in `missed_ticks`) instead of being made up with polls in quick
+    succession. The wait for the next deadline can be cut short, to poll
+    right away, by setting `wakeup`.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.start = time.monotonic()
+        self.next_deadline = self.start
+        self.ticks = 0
+        self.missed_ticks = 0
+        self.wakeup = threading.Event()
+
+    def delay(self):
+        """
+        Advances to the next deadline, and returns the number of seconds
+        to wait until it is reached.
+        """
+        self.ticks += 1
+        self.next_deadline += self.interval
+        now = time.monotonic()
+        if now > self.next_deadline:
+            missed = int((now - self.next_deadline) // self.interval) + 1
+            self.missed_ticks += missed
+            self.next_deadline += missed * self.interval
+        return self.next_deadline - now
+
+    def wait(self):
+        if self.wakeup.wait(self.delay()):
+            # the deadline was not reached, so it still stands
+            self.wakeup.clear()
+            self.ticks -= 1
+            self.next_deadline -= self.interval
+
+    def observe(self, records):
+        """
+        Called with the records of each poll, before waiting for the
+        next one.
+        """
+        pass
+
+class AdaptiveScheduler(FixedRateScheduler):
+    """
+    A `FixedRateScheduler` that normally polls every `interval` seconds,
+    but switches to polling every `burst_interval` seconds as soon as the
+    RSS of any polled process changes by more than a fraction
+    `rss_threshold` of its previous value, or its CPU utilization changes
+    by more than `cpu_threshold` percentage points, between consecutive
+    polls. The CPU utilization compared is that over the polling interval
+    (see `CpuIntervalTracker`), as the lifetime average given by the
+    "CPU" column hardly moves for a process that has been running for a
+    while; only samplers that do not read CPU times (`ps`) fall back to
+    the lifetime average. Once the values settle again, the interval is
+    doubled with each poll until it is back to `interval`.
+    """
+
+    def __init__(self,
+            interval,
+            burst_interval,
+            rss_threshold=0.05,
+            cpu_threshold=10.0):
+        FixedRateScheduler.__init__(self, interval)
+        self.base_interval = interval
+        self.burst_interval = burst_interval
+        self.rss_threshold = rss_threshold
+        self.cpu_threshold = cpu_threshold
+        self.previous = {}
+
+    def observe(self, records):
+        changed = False
+        current = {}
+        for sample in records:
+            rss = sample.rss
+            extra = sample.extra or {}
+            if extra.get('usr', "-") != "-":
+                cpu = float(extra['usr']) + float(extra['sys'])
+            else:
+                cpu = sample.cpu
+            current[sample.pid] = (rss, cpu)
+            if sample.pid in self.previous:
+                prev_rss, prev_cpu = self.previous[sample.pid]
+                if abs(rss - prev_rss) > self.rss_threshold * prev_rss \
+                        or abs(cpu - prev_cpu) > self.cpu_threshold:
+                    changed = True
+        self.previous = current
+        if changed:
+            self.interval = self.burst_interval
+        else:
+            self.interval = min(self.interval * 2, self.base_interval)
+
 def poll_process(pid=None,
         command_pattern=None,
         ssh_id=None,
         has_ssh=False,
         ignore_self=True,
         raw_ps_log=None,
+        sampler=None,
+        process_tree=None,
+        matcher=None,
+        timings=None,
         debug_level=0):
     """
-    Calls ps, and extracts rows where command matches given command
-    filter. If no filter is given, all rows are extracted.
+    Samples the process table using `sampler` (by default, calls ps),
+    and extracts rows where command matches given command filter (or
+    that are selected by `matcher`, if given; see `ProcessMatcher`). If
+    no filter is given, all rows are extracted. If `process_tree` is
+    given, it is updated with the sample, and the rows of all processes
+    in the tree are extracted instead of just the row of `pid`. If
+    `timings` (a dictionary) is given, the time taken by each stage of
+    the poll (see `SAMPLE_STAGES`) is stored in it.
     """
 
-    # count up all the fields so far
-    # we are relying on all these fields NOT to contain
-    # any space; we'll use this fact to parse out columns
-    non_command_cols = len(PS_FIELDS)
+    if sampler is None:
+        sampler = PsSampler(ssh_id=ssh_id if has_ssh else None,
+                debug_level=debug_level)
 
-    # add the command fields = command + args
-    # this field will probably have spaces: we'll take this
-    # into account
-    ps_fields = PS_FIELDS + ["command"]
+    poll_time = datetime.datetime.now()
+    poll_monotime = time.monotonic()
+    if isinstance(raw_ps_log, DeltaRawLogWriter):
+        rows, raw_text = sampler.sample()
+        write_start = time.perf_counter()
+        raw_ps_log.write_rows(rows)
+    else:
+        rows, raw_text = sampler.sample(raw=raw_ps_log is not None)
+        write_start = time.perf_counter()
+        if raw_ps_log is not None:
+            raw_ps_log.write(raw_text + "\n")
+    write_end = time.perf_counter()
 
-    ps_args = [ '-o %s=""' % s for s in ps_fields]
-    ps_invocation = "ps -A %s" % (" ".join(ps_args))
-    
-    if has_ssh:
-        ssh_val = "ssh {0} ".format(ssh_id)
-        ps_invocation = ssh_val + ps_invocation
+    if process_tree is not None:
+        process_tree.update(rows)
+        tree_pids = process_tree.members()
+    else:
+        tree_pids = None
 
-    if debug_level >= 3:
-        sys.stderr.write("\n" + ps_invocation + "\n")
+    records = select_records(rows,
+            poll_time,
+            poll_monotime,
+            pid=pid,
+            command_pattern=command_pattern,
+            ignore_self=ignore_self,
+            tree_pids=tree_pids,
+            matcher=matcher,
+            debug_level=debug_level)
+    if timings is not None:
+        timings.update(getattr(sampler, "timings", {}))
+        timings["write"] = write_end - write_start
+        timings["parse"] = timings.get("parse", 0.0) + time.perf_counter() - write_end
+    return records
 
-    ps = subprocess.Popen(ps_invocation,
-        shell=True,
-        stdout=subprocess.PIPE)
-    poll_time = datetime.datetime.now()
-    stdout, stderr = communicate(ps)
-    stdout = stdout.strip()
+class ProcessMatcher(object):
+    """
+    Selects the processes to poll from the sampled rows: those with any of
+    the PIDs in `pids` and/or with a command matching any of the regular
+    expressions in `command_patterns` (if both are given, a process must
+    meet both conditions).
+
+    The patterns are compiled once, and whether the command of a process
+    matches is remembered for as long as the process keeps being seen,
+    so that only the commands of new processes are tested on each poll.
+    A process is identified by its PID together with its start time, so
+    that a reused PID is tested afresh; as the start time is worked out
+    from the elapsed time reported to the second, processes with the same
+    PID starting within `START_TIME_TOLERANCE` seconds of each other are
+    taken to be the same.
+    """
+
+    START_TIME_TOLERANCE = 1.5
+
+    def __init__(self, pids=None, command_patterns=None):
+        if pids is not None and not isinstance(pids, (list, tuple, set)):
+            pids = [pids]
+        if command_patterns is not None and not isinstance(command_patterns, (list, tuple)):
+            command_patterns = [command_patterns]
+        if pids is not None:
+            self.pids = set(str(int(pid)) for pid in pids)
+        else:
+            self.pids = None
+        if command_patterns is not None:
+            self.command_patterns = [re.compile(pattern) for pattern in command_patterns]
+        else:
+            self.command_patterns = None
+        # PID: (start time, whether the command matches)
+        self.matches = {}
+
+    def select(self, rows, poll_monotime):
+        """
+        Returns the rows selected from `rows`, sampled at `poll_monotime`
+        (a reading of the monotonic clock).
+        """
+        if self.command_patterns is None:
+            if self.pids is None:
+                return rows
+            return [fields for fields in rows if fields[0] in self.pids]
+        selected = []
+        matches = {}
+        for fields in rows:
+            pid = fields[0]
+            if self.pids is not None and pid not in self.pids:
+                continue
+            try:
+                start_time = poll_monotime - parse_etime(fields[ETIME_COL])
+            except ValueError:
+                start_time = None
+            match = self.matches.get(pid)
+            if match is None \
+                    or start_time is None \
+                    or match[0] is None \
+                    or abs(match[0] - start_time) > self.START_TIME_TOLERANCE:
+                command = fields[-1]
+                match = (start_time, any(pattern.search(command) for pattern in self.command_patterns))
+            matches[pid] = match
+            if match[1]:
+                selected.append(fields)
+        # processes no longer seen are forgotten
+        self.matches = matches
+        return selected
+
+# Metrics by which top processes can be ranked (see `TopSelector`): the
+# column of the sampled rows giving each, and its type, or, for metrics
+# that are not sampled with the process table, None and the
+# `PROCESS_METRICS` they are taken from, as `(metric, field names)` (the
+# value being the sum of the fields)
+TOP_METRICS = {
+    "vsz": (VSZ_COL, int),
+    "rss": (RSS_COL, int),
+    "cpu": (CPU_COL, float),
+    "mem": (MEM_COL, float),
+    "pss": (None, ("pss", ["pss"])),
+    "io": (None, ("io", ["read_kbps", "write_kbps"])),
+}
+
+class TopSelector(object):
+    """
+    Selects the `num_top` processes ranking highest by `metric` (one of
+    `TOP_METRICS`) from the sampled rows (among those selected by
+    `matcher`, if given, and other than the process with PID
+    `exclude_pid`, if given), in order of rank. The top processes are
+    found by partial selection (`heapq.nlargest()`), without sorting all
+    of the rows, and no more than the selected rows are parsed beyond the
+    ranking metric.
+
+    To keep processes with similar values from flapping in and out of the
+    top set on every poll, a process already in the set keeps its place
+    for as long as its value is within a fraction `hysteresis` of the
+    value it would need to rank among the top `num_top`, and a newcomer
+    only takes one of the places left. After each call of `select()`,
+    the changes to the set are given by `events`: a list of
+    `(event, rank, row)` tuples, where `event` is "ENTER" for a process
+    that entered the set, "LEAVE" for one that dropped out of it and
+    "EXIT" for one that has gone away (in which case `row` is the last
+    one sampled), and `rank` is its rank in (or, on leaving, last rank
+    in) the set.
+
+    Metrics that are not sampled with the process table ("pss" and "io")
+    are measured for every candidate process on each poll, by a
+    `MetricsTracker` of its own (so that the I/O rate is taken over the
+    polling interval, for each process and start time, and PSS read only
+    every `smaps_interval` seconds), using the CPU times kept by
+    `sampler`, if given, to tell processes apart (see `ProcSampler`).
+    Processes whose value cannot be read rank last.
+    """
+
+    def __init__(self,
+            num_top,
+            metric="vsz",
+            hysteresis=0.0,
+            matcher=None,
+            exclude_pid=None,
+            sampler=None,
+            smaps_interval=10.0):
+        self.num_top = num_top
+        self.metric = metric
+        self.metric_col, self.metric_type = TOP_METRICS[metric]
+        if self.metric_col is None:
+            process_metric, self.metric_fields = self.metric_type
+            self.metrics_tracker = MetricsTracker([process_metric], slow_interval=smaps_interval)
+        else:
+            self.metrics_tracker = None
+        self.sampler = sampler
+        self.hysteresis = hysteresis
+        self.matcher = matcher
+        self.exclude_pid = exclude_pid
+        # PID: value of the metric, for metrics that are not sampled with
+        # the process table, on this poll and the one before
+        self.values = {}
+        self.previous_values = {}
+        # PID: (rank, row)
+        self.members = {}
+        self.events = []
+
+    def value(self, row):
+        if self.metrics_tracker is not None:
+            return self.values.get(row[0], -1.0)
+        return self.metric_type(row[self.metric_col])
 
-    if debug_level >= 9:
-        sys.stderr.write(stdout + "\n")
+    def value_text(self, row):
+        """
+        Returns the value of the ranking metric for `row` as logged, or
+        "-" if it is not known.
+        """
+        if self.metrics_tracker is not None:
+            value = self.values.get(row[0], self.previous_values.get(row[0]))
+            return "-" if value is None else "%.1f" % value
+        return row[self.metric_col]
+
+    def measure(self, rows, poll_monotime):
+        self.previous_values = self.values
+        self.values = {}
+        measured = self.metrics_tracker.measure(rows,
+                getattr(self.sampler, "cpu_times", None),
+                poll_monotime)
+        for pid, values in measured.items():
+            parts = [values[field] for field in self.metric_fields if values[field] != "-"]
+            if parts:
+                self.values[pid] = sum(float(part) for part in parts)
+
+    def select(self, rows, poll_monotime):
+        """
+        Returns the rows of the top processes selected from `rows`,
+        sampled at `poll_monotime` (a reading of the monotonic clock).
+        """
+        if self.matcher is not None:
+            rows = self.matcher.select(rows, poll_monotime)
+        if self.exclude_pid is not None:
+            rows = [row for row in rows if row[0] != self.exclude_pid]
+        if self.metrics_tracker is not None:
+            self.measure(rows, poll_monotime)
+        ranked = heapq.nlargest(self.num_top, rows, key=self.value)
+        alive = {}
+        if self.members:
+            for row in rows:
+                if row[0] in self.members:
+                    alive[row[0]] = row
+        if self.hysteresis > 0 and alive and len(ranked) == self.num_top:
+            cutoff = self.value(ranked[-1])
+            staying = [row for row in alive.values() if self.value(row) * (1 + self.hysteresis) >= cutoff]
+            staying = heapq.nlargest(self.num_top, staying, key=self.value)
+            staying_pids = set(row[0] for row in staying)
+            newcomers = [row for row in ranked if row[0] not in staying_pids]
+            selected = staying + newcomers[:self.num_top - len(staying)]
+            selected.sort(key=self.value, reverse=True)
+        else:
+            selected = ranked
+        members = {}
+        events = []
+        for rank, row in enumerate(selected, 1):
+            members[row[0]] = (rank, row)
+            if row[0] not in self.members:
+                events.append(("ENTER", rank, row))
+        for pid, (rank, row) in self.members.items():
+            if pid not in members:
+                if pid in alive:
+                    events.append(("LEAVE", rank, alive[pid]))
+                else:
+                    events.append(("EXIT", rank, row))
+        self.members = members
+        self.events = events
+        return selected
 
-    if raw_ps_log is not None:
-        raw_ps_log.write(stdout + "\n")
+def top_events_header(metric, with_host=False):
+    """
+    Returns the column headers of the log of events of the top set (see
+    `write_top_events()`), with a "HOST" column if `with_host` is True.
+    """
+    header = ["DATE", "TIME", "MONOTIME", "EVENT", "RANK", "PID", metric.upper(), "COMMAND"]
+    if with_host:
+        header.insert(header.index("PID"), "HOST")
+    return header
+
+def write_top_events(dest, events, tick, value_text, separator="  ", host=None):
+    """
+    Writes `events` (see `TopSelector`), which took place at `tick` (a
+    `PollTick`), to `dest`, one line each, giving the value of the
+    ranking metric (as given for each row by `value_text`; see
+    `TopSelector.value_text()`), and the name of the host on which they
+    took place, if `host` is given.
+    """
+    for event, rank, row in events:
+        values = [tick.values[1],
+                tick.values[2],
+                tick.values[3],
+                event,
+                str(rank),
+                row[0],
+                value_text(row),
+                row[-1]]
+        if host is not None:
+            values.insert(5, host)
+        dest.write(separator.join(values) + "\n")
+
+class PollTick(object):
+    """
+    The time of a poll, given by `poll_time` (a datetime) and
+    `poll_monotime` (a reading of the monotonic clock), formatted once
+    for all the samples taken in the poll. Values that are the same for
+    all the samples of a poll, but not always present (such as the
+    polling interval), are kept in `extra`.
+    """
+
+    __slots__ = ('timestamp', 'monotime', 'values', 'extra')
+
+    # the names under which the formatted values are looked up
+    field_names = ['poll_datetime', 'poll_date', 'poll_time', 'poll_monotime']
+
+    def __init__(self, poll_time, poll_monotime):
+        self.timestamp = time.mktime(poll_time.timetuple()) + poll_time.microsecond / 1e6
+        self.monotime = poll_monotime
+        poll_datetime = poll_time.isoformat(' ')
+        self.values = [poll_datetime, poll_datetime[:10], poll_datetime[11:19], "%.3f" % poll_monotime]
+        self.extra = {}
+
+class Sample(object):
+    """
+    The sampled resource usage of a process: `fields`, the row of field
+    values (as strings, in the order given by `PS_FIELDS` followed by the
+    command) as sampled, with the numeric fields that Syrupy works with
+    parsed once, and `tick`, the `PollTick` of the poll. The fields can
+    also be looked up by name, as in a dictionary (e.g., `sample['rss']`
+    gives the RSS as sampled, "poll_date" the date of the poll), and
+    additional values can be stored under other names.
+    """
+
+    __slots__ = ('fields', 'tick', 'pid', 'cpu', 'mem', 'rss', 'vsz', 'extra')
+
+    field_index = dict((name, idx) for idx, name in enumerate(PS_FIELDS + ["command"]))
+    tick_index = dict((name, idx) for idx, name in enumerate(PollTick.field_names))
+
+    def __init__(self, fields, tick):
+        self.fields = fields
+        self.tick = tick
+        self.pid = fields[0]
+        self.cpu = float(fields[CPU_COL])
+        self.mem = float(fields[MEM_COL])
+        self.rss = int(fields[RSS_COL])
+        self.vsz = int(fields[VSZ_COL])
+        self.extra = None
+
+    def __getitem__(self, key):
+        idx = self.field_index.get(key)
+        if idx is not None:
+            return self.fields[idx]
+        idx = self.tick_index.get(key)
+        if idx is not None:
+            return self.tick.values[idx]
+        if key == 'poll_timestamp':
+            return self.tick.timestamp
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        return self.tick.extra[key]
+
+    def __setitem__(self, key, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __repr__(self):
+        values = dict(zip(PS_FIELDS + ["command"], self.fields))
+        values.update(zip(PollTick.field_names, self.tick.values))
+        values.update(self.tick.extra)
+        values.update(self.extra or {})
+        return repr(values)
+
+class SampleFormatter(object):
+    """
+    Renders samples as rows of output, as given by `result_fields` (see
+    `output_format()`) joined by `separator`. The template is compiled
+    once, into a positional format and the positions of the values it
+    takes, so that a row is rendered with a single formatting operation.
+    """
 
+    def __init__(self, result_fields, separator):
+        specs = []
+        positions = []
+        self.extra_names = []
+        num_fields = len(Sample.field_index)
+        num_tick_values = len(Sample.tick_index)
+        for result_field in result_fields:
+            match = re.match(r"%\((.+)\)(-?\d*)s$", result_field)
+            name, width = match.group(1), match.group(2)
+            specs.append("%" + width + "s")
+            if name in Sample.field_index:
+                positions.append(Sample.field_index[name])
+            elif name in Sample.tick_index:
+                positions.append(num_fields + Sample.tick_index[name])
+            else:
+                if name not in self.extra_names:
+                    self.extra_names.append(name)
+                positions.append(num_fields + num_tick_values + self.extra_names.index(name))
+        self.template = separator.join(specs)
+        if len(positions) == 1:
+            # itemgetter() of a single position gives the value, not a tuple
+            position = positions[0]
+            self.values_getter = lambda values: (values[position],)
+        else:
+            self.values_getter = operator.itemgetter(*positions)
+
+    def format(self, sample):
+        values = sample.fields + sample.tick.values
+        if self.extra_names:
+            values.extend([sample[name] for name in self.extra_names])
+        return self.template % self.values_getter(values)
+
+def select_records(rows,
+        poll_time,
+        poll_monotime,
+        pid=None,
+        command_pattern=None,
+        ignore_self=True,
+        tree_pids=None,
+        matcher=None,
+        tick=None,
+        debug_level=0):
+    """
+    Returns records (`Sample` objects) of the sampled `rows` where the PID
+    matches `pid` (or, if `tree_pids` is given, is in `tree_pids`) and
+    the command matches `command_pattern`, stamped with `poll_time` (a
+    datetime) and `poll_monotime` (a reading of the monotonic clock), or
+    with `tick` (a `PollTick`), if given. If neither filter is given, all
+    rows are extracted. If `matcher` is given, it selects the rows
+    instead of `pid` and `command_pattern` (see `ProcessMatcher`).
+    """
+    if matcher is None:
+        if tree_pids is not None:
+            pid = None
+        if pid is not None or command_pattern is not None:
+            matcher = ProcessMatcher(pid, command_pattern)
+    if matcher is not None:
+        rows = matcher.select(rows, poll_monotime)
+    if tick is None:
+        tick = PollTick(poll_time, poll_monotime)
     records = []
-    for row in stdout.split("\n"):
-        if not row:
-            continue
-        fields = re.split("\s+", row.strip(), non_command_cols)
-        if debug_level >= 5:
-            sys.stderr.write(str(fields) + "\n")
-        if len(fields) != 8:
-            #raise ValueError("Expecting 8 columns in output, but found %d: %s" % (len(fields), fields))
-            sys.stderr.write("SYRUPY: Skipping sample: found only %d columns: %s" % (len(fields), fields))
-            continue
-        if (not ignore_self or int(fields[0]) != os.getpid())  \
-                and (pid is None or int(fields[0]) == int(pid)) \
-                and (command_pattern is None or re.search(command_pattern, fields[-1])):
-            pinfo = {}
-            for idx, field in enumerate(fields):
-                pinfo[ps_fields[idx]] = field
-            pinfo['poll_datetime'] = poll_time.isoformat(' ')
-            pinfo['poll_date'] = poll_time.strftime("%Y-%m-%d")
-            pinfo['poll_time'] = poll_time.strftime("%H:%M:%S")
-            records.append(pinfo)
+    own_pid = str(os.getpid())
+    for fields in rows:
+        if (not ignore_self or fields[0] != own_pid)  \
+                and (tree_pids is None or fields[0] in tree_pids):
+            sample = Sample(fields, tick)
+            records.append(sample)
             if debug_level >= 4:
-                sys.stderr.write(str(pinfo) + "\n")
+                sys.stderr.write(repr(sample) + "\n")
     return records
 
-def profile_process(pid=None,
-        command_pattern=None,
-        top_mem=None,
-        syrupy_output=None,
-        raw_ps_log=None,
-        poll_interval=1,
-        ssh_id=None,
-        has_ssh=False,
-        quit_poll_func=None,
-        quit_if_none=False,
-        quit_at_time=None,
+def output_format(align=False,
         show_command=False,
-        output_separator="  ",
-        align=False,
-        headers=True,
-        flush_output=False,
+        extra_columns=None,
         debug_level=0):
     """
-    Will poll process with PID `pid` or with COMMAND matching
-    `command_pattern` every `poll_interval` seconds, writing system
-    resource usage to `syrupy_output`. Will quit if `quit_poll_func` is not
-    None and when called ("quit_poll_func()") returns True. I f process
-    with PID does not exist, will quit waiting if `quit_if_none` is
-    True, otherwise will continue until time given by `quit_at_time` if
-    `quit_at_time` is not None. If `quit_at_time` is None and the PID
-    does not exist and if `quit_if_none` is False, then will poll
-    continuously until interupted by user.
+    Returns a tuple, `(result_fields, col_headers)`, giving the format
+    template and the header of each output column. `extra_columns` is a
+    list of `(field name, header)` tuples for additional columns, which
+    are placed just before the command.
     """
-
-    if pid is None and command_pattern is None and top_mem is None:
-        raise Exception("Must provide PID, command pattern or memory top")
-
     if align:
         ncolw = 5
         mcolw = 8
@@ -233,9 +2416,6 @@ def profile_process(pid=None,
         right_align_narrow = "%d" % ncolw
         right_align = "%d" % mcolw
         right_align_wide = "%d" % wcolw
-        left_align_narrow = "-%d" % ncolw
-        left_align = "-%d" % mcolw
-        left_align_wide = "-%d" % wcolw
     else:
         ncolw = 0
         mcolw = 0
@@ -243,9 +2423,6 @@ def profile_process(pid=None,
         right_align_narrow = ""
         right_align = ""
         right_align_wide = ""
-        left_align_narrow = ""
-        left_align = ""
-        left_align_wide = ""
 
     result_fields = [
         "%%(pid)%ss" % right_align,
@@ -256,15 +2433,9 @@ def profile_process(pid=None,
         "%%(%%mem)%ss" % right_align_narrow,
         "%%(rss)%ss" % right_align,
         "%%(vsz)%ss" % right_align,
-        "%%(command)%ss" % right_align,
+        "%%(poll_monotime)%ss" % right_align_wide,
     ]
 
-    if debug_level >= 1:
-        result_fields.insert(0, "%%(ppid)%ss" % right_align)
-
-    if show_command:
-        result_fields.append("%(command)s")
-
     col_headers = [
         "PID".rjust(mcolw),
         "DATE".rjust(wcolw),
@@ -274,14 +2445,362 @@ def profile_process(pid=None,
         "MEM".rjust(ncolw),
         "RSS".rjust(mcolw),
         "VSIZE".rjust(mcolw),
-        "CMD".rjust(mcolw),
+        "MONOTIME".rjust(wcolw),
     ]
 
-    if debug_level >=1:
-        col_headers.insert(0, "PPID".rjust(mcolw))
+    for field_name, header in extra_columns or []:
+        result_fields.append("%%(%s)%ss" % (field_name, right_align_wide))
+        col_headers.append(header.rjust(wcolw))
+
+    result_fields.append("%%(command)%ss" % right_align)
+    col_headers.append("CMD".rjust(mcolw))
+
+    if debug_level >= 1:
+        result_fields.insert(0, "%%(ppid)%ss" % right_align)
+        col_headers.insert(0, "PPID".rjust(mcolw))
+
+    if show_command:
+        result_fields.append("%(command)s")
+        col_headers.append("COMMAND")
+
+    return result_fields, col_headers
+
+def profile_process(pid=None,
+        command_pattern=None,
+        top_mem=None,
+        top_metric="vsz",
+        top_hysteresis=0.0,
+        top_events_output=None,
+        syrupy_output=None,
+        raw_ps_log=None,
+        poll_interval=1,
+        ssh_id=None,
+        has_ssh=False,
+        quit_poll_func=None,
+        quit_if_none=False,
+        quit_at_time=None,
+        show_command=False,
+        output_separator="  ",
+        align=False,
+        headers=True,
+        flush_output=False,
+        sampler=None,
+        track_tree=False,
+        scheduler=None,
+        peak_tracker=None,
+        binary_output=None,
+        records_func=None,
+        ignore_self=True,
+        self_metrics=None,
+        metrics=None,
+        smaps_interval=10.0,
+        group_total=False,
+        thread_output=None,
+        debug_level=0):
+    """
+    Will poll process with PID `pid` or with COMMAND matching
+    `command_pattern` (either of which may also be a list, to poll any of
+    the given PIDs or processes matching any of the given patterns)
+    every `poll_interval` seconds, writing system
+    resource usage to `syrupy_output`. Will quit if `quit_poll_func` is not
+    None and when called ("quit_poll_func()") returns True. I f process
+    with PID does not exist, will quit waiting if `quit_if_none` is
+    True, otherwise will continue until time given by `quit_at_time` if
+    `quit_at_time` is not None. If `quit_at_time` is None and the PID
+    does not exist and if `quit_if_none` is False, then will poll
+    continuously until interupted by user. The process table is sampled
+    using `sampler`, which, if not given, is selected automatically (see
+    `create_sampler()`). If `track_tree` is True, then all descendants of
+    process `pid` are polled as well, and their combined usage is
+    reported in an additional "TOTAL" row on each poll. Polls are paced
+    by `scheduler`, which, if not given, is a `FixedRateScheduler` with
+    an interval of `poll_interval`; this is returned once polling stops.
+    If `peak_tracker` is given, it is updated with the PIDs of the polled
+    processes after each poll (see `PeakTracker`). If `binary_output` is
+    given, the results are written to it as well (see `BinaryLogWriter`).
+    If `records_func` is given, it is called with the records of the
+    polled processes after each poll (see `select_records()`). Unless
+    `ignore_self` is False, the process running Syrupy is never polled.
+    If `self_metrics` is given, it measures the overhead of each poll
+    (see `SelfMetrics`). If `top_mem` is given, only the `top_mem`
+    processes ranking highest by `top_metric` (with hysteresis
+    `top_hysteresis`; "pss" being read every `smaps_interval` seconds)
+    are polled (see `TopSelector`), and the processes
+    entering and leaving this set are logged to `top_events_output`, if
+    given. If the sampler keeps the cumulative CPU times of the processes
+    (see `ProcSampler`), their user and system CPU utilization over each
+    polling interval is reported as well (see `CpuIntervalTracker`). The
+    `PROCESS_METRICS` named in `metrics`, if given, are reported as well
+    (see `MetricsTracker`), those read from `smaps_rollup` every
+    `smaps_interval` seconds. If `group_total` is True, the combined
+    usage of all the polled processes is reported in an additional
+    "TOTAL" row on each poll, as with `track_tree`. If `thread_output` is
+    given, the threads of the polled processes are sampled as well, and
+    written to it (see `ThreadTracker`).
+    """
+
+    if pid is None and command_pattern is None and top_mem is None:
+        raise Exception("Must provide PID, command pattern or memory top")
+
+    if pid is not None and not isinstance(pid, (list, tuple)):
+        pids = [pid]
+    else:
+        pids = pid
+
+    if track_tree:
+        if pids is None or len(pids) != 1:
+            raise Exception("Must provide a single PID to track process tree")
+        process_tree = ProcessTree(pids[0])
+        pids = None
+    else:
+        process_tree = None
+
+    if pids is not None or command_pattern is not None:
+        matcher = ProcessMatcher(pids, command_pattern)
+    else:
+        matcher = None
+    own_sampler = sampler is None
+    if own_sampler:
+        sampler = create_sampler(ssh_id=ssh_id if has_ssh else None,
+                pids=pids,
+                debug_level=debug_level)
+
+    if top_mem is not None:
+        top_selector = TopSelector(top_mem,
+                metric=top_metric,
+                hysteresis=top_hysteresis,
+                matcher=matcher,
+                exclude_pid=str(os.getpid()) if ignore_self else None,
+                sampler=sampler,
+                smaps_interval=smaps_interval)
+        matcher = top_selector
+        if top_events_output is not None and headers:
+            top_events_output.write(output_separator.join(top_events_header(top_metric)) + "\n")
+    else:
+        top_selector = None
+
+    if scheduler is None:
+        scheduler = FixedRateScheduler(poll_interval)
+
+    extra_columns = []
+    if getattr(sampler, "cpu_times", None) is not None:
+        cpu_tracker = CpuIntervalTracker()
+        extra_columns.append(("usr", "USR"))
+        extra_columns.append(("sys", "SYS"))
+    else:
+        cpu_tracker = None
+    if metrics:
+        metrics_tracker = MetricsTracker(metrics, slow_interval=smaps_interval)
+        extra_columns.extend(metrics_tracker.columns())
+    else:
+        metrics_tracker = None
+    if isinstance(scheduler, AdaptiveScheduler):
+        extra_columns.append(("poll_interval", "INTERVAL"))
+    if thread_output is not None:
+        thread_tracker = ThreadTracker()
+        if headers:
+            thread_output.write(output_separator.join(THREAD_LOG_COLUMNS) + "\n")
+    else:
+        thread_tracker = None
+
+    result_fields, col_headers = output_format(align=align,
+            show_command=show_command,
+            extra_columns=extra_columns,
+            debug_level=debug_level)
+    formatter = SampleFormatter(result_fields, output_separator)
+
+    if headers:
+        if syrupy_output is not None:
+            syrupy_output.write(output_separator.join(col_headers) + "\n")
+            if flush_output:
+                syrupy_output.flush()
+    if binary_output is not None:
+        binary_output.set_columns(extra_columns)
+
+    quit = False
+    while not quit:
+        if self_metrics is not None:
+            self_metrics.begin_poll(scheduler)
+            timings = {}
+        else:
+            timings = None
+        pinfoset = poll_process(pid=pid,
+                                command_pattern=command_pattern,
+                                ssh_id=ssh_id,
+                                has_ssh=has_ssh,
+                                raw_ps_log=raw_ps_log,
+                                sampler=sampler,
+                                process_tree=process_tree,
+                                matcher=matcher,
+                                ignore_self=ignore_self,
+                                timings=timings,
+                                debug_level=debug_level)
+
+        if debug_level > 4:
+            sys.stderr.write(str(pinfoset) + "\n")
+        write_start = time.perf_counter()
+        if raw_ps_log is not None and flush_output:
+            raw_ps_log.flush()
+        write_seconds = time.perf_counter() - write_start
+        if pinfoset:
+            # all the samples of a poll share its tick
+            pinfoset[0].tick.extra['poll_interval'] = "%.3f" % scheduler.interval
+            if cpu_tracker is not None:
+                cpu_tracker.update(pinfoset, sampler.cpu_times, pinfoset[0].tick.monotime)
+            if metrics_tracker is not None:
+                read_start = time.perf_counter()
+                metrics_tracker.update(pinfoset,
+                        getattr(sampler, "cpu_times", None),
+                        pinfoset[0].tick.monotime)
+                if timings is not None:
+                    timings["read"] = timings.get("read", 0.0) + time.perf_counter() - read_start
+        if thread_tracker is not None:
+            read_start = time.perf_counter()
+            threads = thread_tracker.update([sample.pid for sample in pinfoset],
+                    pinfoset[0].tick.monotime if pinfoset else time.monotonic())
+            if timings is not None:
+                timings["read"] = timings.get("read", 0.0) + time.perf_counter() - read_start
+        scheduler.observe(pinfoset)
+        if peak_tracker is not None:
+            peak_tracker.update([sample.pid for sample in pinfoset])
+        if records_func is not None:
+            records_func(pinfoset)
+        if process_tree is not None and pinfoset:
+            output_set = pinfoset + [aggregate_records(pinfoset,
+                    "tree:%s(%d)" % (process_tree.root_pid, len(pinfoset)))]
+        elif group_total and pinfoset:
+            output_set = pinfoset + [aggregate_records(pinfoset, "group(%d)" % len(pinfoset))]
+        else:
+            output_set = pinfoset
+        write_start = time.perf_counter()
+        if top_events_output is not None and top_selector.events:
+            if pinfoset:
+                tick = pinfoset[0].tick
+            else:
+                tick = PollTick(datetime.datetime.now(), time.monotonic())
+            write_top_events(top_events_output,
+                    top_selector.events,
+                    tick,
+                    top_selector.value_text,
+                    separator=output_separator)
+            if flush_output:
+                top_events_output.flush()
+        for sample in output_set:
+            result = formatter.format(sample)
+            if syrupy_output is not None:
+                syrupy_output.write(result + "\n")
+                if flush_output:
+                    syrupy_output.flush()
+        if thread_tracker is not None and pinfoset:
+            write_thread_samples(thread_output, threads, pinfoset[0].tick, separator=output_separator)
+            if flush_output:
+                thread_output.flush()
+        if binary_output is not None:
+            binary_output.write_records(output_set)
+            if flush_output:
+                binary_output.flush()
+        if self_metrics is not None:
+            timings["write"] += write_seconds + time.perf_counter() - write_start
+            self_metrics.end_poll(timings, scheduler)
+        if quit_poll_func is not None and quit_poll_func():
+            quit = True
+        elif len(pinfoset) == 0 and quit_if_none:
+            quit = True
+        else:
+            scheduler.wait()
+    if own_sampler:
+        sampler.close()
+    if thread_tracker is not None:
+        thread_tracker.close()
+    return scheduler
+
+def profile_fleet(hosts,
+        pid=None,
+        command_pattern=None,
+        top_mem=None,
+        top_metric="vsz",
+        top_hysteresis=0.0,
+        top_events_output=None,
+        syrupy_output=None,
+        raw_ps_log=None,
+        poll_interval=1,
+        ssh_command="ssh {host}",
+        host_timeout=10,
+        quit_if_none=False,
+        show_command=False,
+        output_separator="  ",
+        align=False,
+        headers=True,
+        flush_output=False,
+        debug_level=0):
+    """
+    Like `profile_process()`, but polls each of the remote hosts in
+    `hosts` concurrently, through a persistent session with each one (see
+    `AsyncRemoteSampler`), and writes the results for all of them to
+    `syrupy_output`, with an additional "HOST" column. A host that fails
+    to respond within `host_timeout` seconds is skipped for that poll
+    (and reconnected to on the next one), without holding up the others.
+    With `top_mem`, the top processes are selected on each host
+    separately, and the processes entering and leaving the set of each
+    host are logged to `top_events_output`, if given, with an additional
+    "HOST" column.
+    """
+    if pid is None and command_pattern is None and top_mem is None:
+        raise Exception("Must provide PID, command pattern or memory top")
+    return asyncio.run(_profile_fleet(hosts,
+            pid=pid,
+            command_pattern=command_pattern,
+            top_mem=top_mem,
+            top_metric=top_metric,
+            top_hysteresis=top_hysteresis,
+            top_events_output=top_events_output,
+            syrupy_output=syrupy_output,
+            raw_ps_log=raw_ps_log,
+            poll_interval=poll_interval,
+            ssh_command=ssh_command,
+            host_timeout=host_timeout,
+            quit_if_none=quit_if_none,
+            show_command=show_command,
+            output_separator=output_separator,
+            align=align,
+            headers=headers,
+            flush_output=flush_output,
+            debug_level=debug_level))
+
+async def _poll_host(sampler, host_timeout, raw):
+    try:
+        return await asyncio.wait_for(sampler.sample(raw=raw), host_timeout)
+    except asyncio.TimeoutError:
+        sys.stderr.write("SYRUPY: Timed out sampling remote host '%s'\n" % sampler.ssh_id)
+        await sampler.close()
+    except IOError as e:
+        sys.stderr.write("SYRUPY: %s\n" % e)
+    return None
 
-    if show_command:
-        col_headers.append("COMMAND")
+async def _profile_fleet(hosts,
+        pid,
+        command_pattern,
+        top_mem,
+        top_metric,
+        top_hysteresis,
+        top_events_output,
+        syrupy_output,
+        raw_ps_log,
+        poll_interval,
+        ssh_command,
+        host_timeout,
+        quit_if_none,
+        show_command,
+        output_separator,
+        align,
+        headers,
+        flush_output,
+        debug_level):
+    result_fields, col_headers = output_format(align=align,
+            show_command=show_command,
+            extra_columns=[("host", "HOST")],
+            debug_level=debug_level)
+    formatter = SampleFormatter(result_fields, output_separator)
 
     if headers:
         if syrupy_output is not None:
@@ -289,34 +2808,84 @@ def profile_process(pid=None,
             if flush_output:
                 syrupy_output.flush()
 
-    quit = False
-    while not quit:
-        pinfoset = poll_process(pid=pid,
-                                command_pattern=command_pattern,
-                                ssh_id=ssh_id,
-                                has_ssh=has_ssh,
-                                raw_ps_log=raw_ps_log,
-                                debug_level=debug_level)
-
-        if top_mem is not None:
-            pinfoset = sorted(pinfoset, key=lambda v: int(v['vsz']), reverse=True)[:top_mem]
-
-        if debug_level > 4:
-            sys.stderr.write(str(pinfoset) + "\n")
-        if raw_ps_log is not None and flush_output:
-            raw_ps_log.flush()
-        for pinfo in pinfoset:
-            result = output_separator.join(result_fields) % pinfo
-            if syrupy_output is not None:
-                syrupy_output.write(result + "\n")
-                if flush_output:
-                    syrupy_output.flush()
-        if quit_poll_func is not None and quit_poll_func():
-            quit = True
-        elif len(pinfoset) == 0 and quit_if_none:
-            quit = True
-        else:
-            time.sleep(poll_interval)
+    scheduler = FixedRateScheduler(poll_interval)
+    samplers = [AsyncRemoteSampler(host,
+            ssh_command=ssh_command,
+            max_retries=0,
+            debug_level=debug_level) for host in hosts]
+    if pid is not None or command_pattern is not None:
+        matchers = dict((host, ProcessMatcher(pid, command_pattern)) for host in hosts)
+    else:
+        matchers = dict((host, None) for host in hosts)
+    if top_mem is not None:
+        for host in hosts:
+            matchers[host] = TopSelector(top_mem,
+                    metric=top_metric,
+                    hysteresis=top_hysteresis,
+                    matcher=matchers[host])
+        if top_events_output is not None and headers:
+            top_events_output.write(output_separator.join(top_events_header(top_metric, with_host=True)) + "\n")
+    try:
+        quit = False
+        while not quit:
+            poll_time = datetime.datetime.now()
+            poll_monotime = time.monotonic()
+            tick = PollTick(poll_time, poll_monotime)
+            delta_raw_log = isinstance(raw_ps_log, DeltaRawLogWriter)
+            results = await asyncio.gather(*[_poll_host(sampler,
+                    host_timeout,
+                    raw_ps_log is not None and not delta_raw_log) for sampler in samplers])
+            pinfoset = []
+            raw_rows = []
+            num_responses = 0
+            for sampler, result in zip(samplers, results):
+                if result is None:
+                    continue
+                num_responses += 1
+                rows, raw_text = result
+                if delta_raw_log:
+                    raw_rows.extend([sampler.ssh_id] + row for row in rows)
+                elif raw_ps_log is not None:
+                    for row in raw_text.split("\n"):
+                        raw_ps_log.write("%s %s\n" % (sampler.ssh_id, row))
+                host_pinfoset = select_records(rows,
+                        poll_time,
+                        poll_monotime,
+                        ignore_self=False,
+                        matcher=matchers[sampler.ssh_id],
+                        tick=tick,
+                        debug_level=debug_level)
+                for sample in host_pinfoset:
+                    sample['host'] = sampler.ssh_id
+                pinfoset.extend(host_pinfoset)
+                top_selector = matchers[sampler.ssh_id]
+                if top_events_output is not None and top_selector.events:
+                    write_top_events(top_events_output,
+                            top_selector.events,
+                            tick,
+                            top_selector.value_text,
+                            separator=output_separator,
+                            host=sampler.ssh_id)
+            if top_events_output is not None and flush_output:
+                top_events_output.flush()
+            if delta_raw_log:
+                raw_ps_log.write_rows(raw_rows)
+            if raw_ps_log is not None and flush_output:
+                raw_ps_log.flush()
+            for sample in pinfoset:
+                result = formatter.format(sample)
+                if syrupy_output is not None:
+                    syrupy_output.write(result + "\n")
+            if syrupy_output is not None and flush_output:
+                syrupy_output.flush()
+            if len(pinfoset) == 0 and num_responses > 0 and quit_if_none:
+                quit = True
+            else:
+                await asyncio.sleep(scheduler.delay())
+    finally:
+        for sampler in samplers:
+            await sampler.close()
+    return scheduler
 
 def communicate(p, commands=None):
     if commands is not None:
@@ -339,25 +2908,74 @@ def profile_command(command,
         align=False,
         headers=True,
         flush_output=False,
+        sampler_name="auto",
+        track_tree=False,
+        scheduler=None,
+        peak_tracker=None,
+        binary_output=None,
+        self_metrics=None,
+        metrics=None,
+        smaps_interval=10.0,
+        thread_output=None,
         debug_level=0):
     """
     Executes command `command`, redirecting its output stream to `command_stdout`
     and error stream to `command_stderr`. Polls the resulting process every
     `poll_interval` seconds, and writes the memory/cpu usage information to
-    `syrupy_output`.
+    `syrupy_output`. The process is sampled using the backend named by
+    `sampler_name` (see `create_sampler()`). If `track_tree` is True, all
+    processes descended from the resulting process are polled as well.
+    Polls are paced by `scheduler` (see `profile_process()`), which is
+    woken to poll right away when the resulting process exits. If
+    `peak_tracker` is given, it tracks the peak memory usage of the polled
+    processes, and receives the resource usage of the resulting process
+    once it has terminated (see `PeakTracker`). If `binary_output` is
+    given, the results are written to it as well (see `BinaryLogWriter`).
+    If `self_metrics` is given, it measures the overhead of each poll (see
+    `SelfMetrics`). The `PROCESS_METRICS` named in `metrics`, if given,
+    are reported as well, those read from `smaps_rollup` every
+    `smaps_interval` seconds. If `thread_output` is given, the threads of
+    the polled processes are written to it (see `ThreadTracker`).
     """
+    def reap():
+        # we reap the process ourselves, rather than through `proc.poll()`,
+        # to get hold of its resource usage
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid == 0:
+            return False
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if peak_tracker is not None:
+            peak_tracker.record_rusage(status, rusage)
+        return True
+    def wake_on_exit():
+        # waits for the process to exit without reaping it, which is left
+        # to `reap()`
+        try:
+            os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        except OSError:
+            pass
+        scheduler.wakeup.set()
     try:
+        if scheduler is None:
+            scheduler = FixedRateScheduler(poll_interval)
         start_time = datetime.datetime.now()
+        if peak_tracker is not None:
+            peak_tracker.record_spawn()
         proc = subprocess.Popen(command,
                 shell=False,
                 stdout=command_stdout,
                 stderr=command_stderr,
                 env=os.environ)
+        if hasattr(os, "waitid"):
+            threading.Thread(target=wake_on_exit, name="syrupy-wait", daemon=True).start()
+        sampler = create_sampler(sampler_name,
+                pids=[proc.pid] if not track_tree else None,
+                debug_level=debug_level)
         profile_process(pid=proc.pid,
                 syrupy_output=syrupy_output,
                 raw_ps_log=raw_ps_log,
                 poll_interval=poll_interval,
-                quit_poll_func=proc.poll,
+                quit_poll_func=reap,
                 quit_if_none=True,
                 quit_at_time=None,
                 show_command=show_command,
@@ -365,7 +2983,17 @@ def profile_command(command,
                 align=align,
                 headers=headers,
                 flush_output=flush_output,
+                sampler=sampler,
+                track_tree=track_tree,
+                scheduler=scheduler,
+                peak_tracker=peak_tracker,
+                binary_output=binary_output,
+                self_metrics=self_metrics,
+                metrics=metrics,
+                smaps_interval=smaps_interval,
+                thread_output=thread_output,
                 debug_level=debug_level)
+        sampler.close()
         end_time = datetime.datetime.now()
         return start_time, end_time
     except Exception as e:
@@ -373,6 +3001,260 @@ def profile_command(command,
         raise e
         sys.exit(1)
 
+class Phase(object):
+    """
+    The resource usage of the profiled processes over a phase of the
+    program named `name`, from `start` to `end` (readings of the monotonic
+    clock): the times of the polls taken during the phase (`times`), the
+    combined RSS, virtual memory size (in kB) and CPU utilization (in
+    percent) of the processes on each (`rss`, `vsz` and `cpu`, all
+    arrays), their peak and mean RSS (`peak_rss` and `mean_rss`), and the
+    CPU time used (`cpu_seconds`). The values are None until the phase
+    has ended.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.end = None
+        self.times = None
+        self.rss = None
+        self.vsz = None
+        self.cpu = None
+        self.peak_rss = None
+        self.mean_rss = None
+        self.cpu_seconds = None
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+    def summary(self):
+        """
+        Returns the summary of the phase, as a list of `(key, value)`
+        tuples (as written to the run summary).
+        """
+        return [("phase", self.name),
+                ("duration", self.duration),
+                ("samples", len(self.times) if self.times is not None else 0),
+                ("peak_rss_kb", self.peak_rss),
+                ("mean_rss_kb", self.mean_rss),
+                ("cpu_seconds", self.cpu_seconds)]
+
+    def __repr__(self):
+        return "Phase(%s)" % ", ".join("%s=%r" % entry for entry in self.summary())
+
+class Profiler(object):
+    """
+    Profiles the running Python program itself (and, if `children` is
+    True, all the processes descended from it), polling it every
+    `poll_interval` seconds from a background thread, for use as a
+    library rather than through the command line::
+
+        profiler = syrupy.Profiler(poll_interval=0.5)
+        profiler.start()
+        with profiler.phase("load") as phase:
+            load()
+        print(phase.peak_rss, phase.cpu_seconds)
+        profiler.stop()
+
+    The combined usage of the processes on each poll is kept in memory,
+    as arrays (`times`, `rss`, `vsz` and `cpu`; see `Phase`), and can
+    also be written to the usual logs, `syrupy_output`, `binary_output`
+    and `raw_ps_log` (see `profile_process()`). The process table is
+    sampled using the backend named by `sampler_name` (see
+    `create_sampler()`).
+
+    A poll is taken at the beginning and end of every phase, so that even
+    a phase shorter than `poll_interval` is sampled. The CPU time of a
+    phase is measured exactly, from the resource usage of the program
+    (which includes that of child processes only once they have been
+    waited for), rather than from the samples.
+    """
+
+    def __init__(self,
+            poll_interval=1.0,
+            children=False,
+            sampler_name="auto",
+            syrupy_output=None,
+            binary_output=None,
+            raw_ps_log=None,
+            show_command=False,
+            output_separator="  ",
+            align=False,
+            headers=True,
+            debug_level=0):
+        self.poll_interval = poll_interval
+        self.children = children
+        self.sampler_name = sampler_name
+        self.syrupy_output = syrupy_output
+        self.binary_output = binary_output
+        self.raw_ps_log = raw_ps_log
+        self.show_command = show_command
+        self.output_separator = output_separator
+        self.align = align
+        self.headers = headers
+        self.debug_level = debug_level
+        self.times = array.array("d")
+        self.rss = array.array("q")
+        self.vsz = array.array("q")
+        self.cpu = array.array("d")
+        self.last_poll_time = None
+        self.updated = threading.Condition()
+        self.scheduler = None
+        self.thread = None
+        self.stopping = False
+        self.error = None
+
+    def start(self):
+        """
+        Starts polling, in a background thread.
+        """
+        if self.thread is not None:
+            return
+        pid = os.getpid()
+        sampler = create_sampler(self.sampler_name,
+                pids=[pid] if not self.children else None,
+                debug_level=self.debug_level)
+        self.stopping = False
+        self.scheduler = FixedRateScheduler(self.poll_interval)
+        self.thread = threading.Thread(target=self.run,
+                args=(pid, sampler),
+                name="syrupy-profiler",
+                daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops polling, once the poll in progress (if any) is done.
+        """
+        if self.thread is None:
+            return
+        self.stopping = True
+        self.scheduler.wakeup.set()
+        self.thread.join()
+        self.thread = None
+        if self.error is not None:
+            raise self.error
+
+    def run(self, pid, sampler):
+        try:
+            profile_process(pid=pid,
+                    syrupy_output=self.syrupy_output,
+                    raw_ps_log=self.raw_ps_log,
+                    quit_poll_func=lambda: self.stopping,
+                    show_command=self.show_command,
+                    output_separator=self.output_separator,
+                    align=self.align,
+                    headers=self.headers,
+                    sampler=sampler,
+                    track_tree=self.children,
+                    scheduler=self.scheduler,
+                    binary_output=self.binary_output,
+                    records_func=self.record,
+                    ignore_self=False,
+                    debug_level=self.debug_level)
+        except Exception as e:
+            self.error = e
+        finally:
+            sampler.close()
+            with self.updated:
+                self.updated.notify_all()
+
+    def record(self, records):
+        with self.updated:
+            if records:
+                self.times.append(records[0].tick.monotime)
+                self.rss.append(sum(sample.rss for sample in records))
+                self.vsz.append(sum(sample.vsz for sample in records))
+                self.cpu.append(sum(sample.cpu for sample in records))
+                self.last_poll_time = records[0].tick.monotime
+            else:
+                self.last_poll_time = time.monotonic()
+            self.updated.notify_all()
+
+    def poll_now(self):
+        """
+        Takes a poll right away, and waits for it to be done (unless the
+        profiler is not running).
+        """
+        requested = time.monotonic()
+        with self.updated:
+            while self.thread is not None and self.thread.is_alive() and not self.stopping \
+                    and (self.last_poll_time is None or self.last_poll_time < requested):
+                self.scheduler.wakeup.set()
+                self.updated.wait(self.poll_interval)
+
+    def cpu_time(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_time = usage.ru_utime + usage.ru_stime
+        if self.children:
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu_time += usage.ru_utime + usage.ru_stime
+        return cpu_time
+
+    @contextlib.contextmanager
+    def phase(self, name=None):
+        """
+        Profiles the code run in the body of a `with` statement as a
+        phase named `name`, giving the `Phase` whose values are filled in
+        once the phase is over.
+        """
+        phase = Phase(name)
+        phase.start = time.monotonic()
+        start_cpu_time = self.cpu_time()
+        self.poll_now()
+        try:
+            yield phase
+        finally:
+            self.poll_now()
+            phase.cpu_seconds = self.cpu_time() - start_cpu_time
+            phase.end = time.monotonic()
+            self.fill_phase(phase)
+
+    def fill_phase(self, phase):
+        with self.updated:
+            first = bisect.bisect_left(self.times, phase.start)
+            last = bisect.bisect_right(self.times, phase.end)
+            phase.times = self.times[first:last]
+            phase.rss = self.rss[first:last]
+            phase.vsz = self.vsz[first:last]
+            phase.cpu = self.cpu[first:last]
+        if phase.rss:
+            phase.peak_rss = max(phase.rss)
+            phase.mean_rss = sum(phase.rss) / float(len(phase.rss))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+@contextlib.contextmanager
+def profile(name=None, **kwargs):
+    """
+    Profiles the code run in the body of a `with` statement, as a phase
+    named `name`, polling it from a background thread for as long as it
+    runs, and gives the `Phase` whose values are filled in once it is
+    over::
+
+        with syrupy.profile("load", poll_interval=0.1) as phase:
+            load()
+        print(phase.peak_rss, phase.mean_rss, phase.cpu_seconds)
+
+    The keyword arguments are passed on to `Profiler`.
+    """
+    profiler = Profiler(**kwargs)
+    profiler.start()
+    try:
+        with profiler.phase(name) as phase:
+            yield phase
+    finally:
+        profiler.stop()
+
 def open_file(fpath, mode='r', replace=False, exit_on_fail=True):
     """
     Does idiot-checked file opening.
@@ -429,6 +3311,329 @@ will be passed to COMMAND.
 _program_author = 'Jeet Sukumaran'
 _program_copyright = 'Copyright (C) 2009 Jeet Sukumaran.'
 
+def save_run_summary(opts, base_title, entries):
+    """
+    Writes the run summary (see `write_run_summary()`) to
+    "<base_title>.ps.summary" or, if Syrupy output is going to standard
+    output, reports it to standard error.
+    """
+    if not entries:
+        return
+    if opts.syrupy_in_front:
+        if not opts.quiet:
+            for key, value in entries:
+                sys.stderr.write("SYRUPY: %s: %s\n" % (key, value))
+    else:
+        fname = base_title + ".ps.summary"
+        if not opts.quiet:
+            sys.stderr.write("SYRUPY: Writing run summary to '%s'\n" % fname)
+        summary_output = open_file(fname, "w", replace=opts.replace)
+        write_run_summary(summary_output, entries)
+        summary_output.close()
+
+def create_scheduler(opts):
+    """
+    Returns the poll scheduler requested by the command-line options.
+    """
+    if opts.burst_interval is not None:
+        return AdaptiveScheduler(opts.poll_interval,
+                opts.burst_interval,
+                rss_threshold=opts.burst_rss_threshold,
+                cpu_threshold=opts.burst_cpu_threshold)
+    return FixedRateScheduler(opts.poll_interval)
+
+def log_writer(opts, dest, drop_when_full=False):
+    """
+    Returns `dest` (a file), or, if requested by the command-line options,
+    a `BackgroundWriter` writing to it.
+    """
+    if not opts.write_behind:
+        return dest
+    return BackgroundWriter(dest,
+            flush_interval=0 if opts.flush_output else opts.flush_interval,
+            flush_size=int(opts.flush_size * 1024),
+            queue_size=opts.write_queue_size,
+            drop_when_full=drop_when_full)
+
+def exit_on_signal(signum, frame):
+    """
+    Signal handler that exits (running the clean-up handlers) rather than
+    dying outright.
+    """
+    sys.exit(128 + signum)
+
+# Metrics gathered by the benchmark suite: key (in the baseline file),
+# column header and format
+BENCHMARK_METRICS = [
+    ("peak_rss_kb", "PEAK_RSS", "%.0f"),
+    ("cpu_seconds", "CPU_S", "%.3f"),
+    ("wall_seconds", "WALL_S", "%.3f"),
+]
+
+def parse_benchmark_spec(src):
+    """
+    Returns the benchmarks specified in `src` (an open file) as a list of
+    `(name, repetitions, command)` tuples, from lines of the form
+    "NAME REPETITIONS COMMAND [COMMAND-OPTIONS] [COMMAND-ARGS]" (split as
+    by a shell). Blank lines and lines starting with '#' are skipped.
+    """
+    benchmarks = []
+    names = set()
+    for line_num, line in enumerate(src, 1):
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        try:
+            fields = shlex.split(line)
+        except ValueError as e:
+            raise ValueError("line %d: %s" % (line_num, e))
+        if len(fields) < 3 or not fields[1].isdigit() or int(fields[1]) < 1:
+            raise ValueError("line %d: expecting 'NAME REPETITIONS COMMAND [COMMAND-ARGS]'" % line_num)
+        if fields[0] in names:
+            raise ValueError("line %d: duplicate benchmark name '%s'" % (line_num, fields[0]))
+        names.add(fields[0])
+        benchmarks.append((fields[0], int(fields[1]), fields[2:]))
+    return benchmarks
+
+def median_interval(values, confidence=0.95):
+    """
+    Returns a tuple, `(median, lower, upper)`, giving the median of
+    `values` and a distribution-free confidence interval for it: the
+    narrowest pair of order statistics of `values` that contains the
+    median with a probability of at least `confidence` (or, if there are
+    too few values for any pair to, the smallest and largest values).
+    """
+    values = sorted(values)
+    n = len(values)
+    if n % 2:
+        median = values[n // 2]
+    else:
+        median = (values[n // 2 - 1] + values[n // 2]) / 2.0
+    # the `rank`-th smallest and largest values bracket the median with
+    # probability 1 - 2 * P(B < rank), where B ~ Binomial(n, 1/2)
+    rank = 1
+    tail = 0
+    while rank < (n + 1) // 2:
+        tail += math.comb(n, rank)
+        if 1 - 2.0 * tail / 2 ** n < confidence:
+            break
+        rank += 1
+    return median, values[rank - 1], values[n - rank]
+
+def run_benchmark(opts, command, command_stdout, command_stderr):
+    """
+    Runs `command` once, profiled as requested by the command-line
+    options, and returns a tuple, `(exit_status, metrics)`, where
+    `metrics` maps the keys of `BENCHMARK_METRICS` to the values measured.
+    """
+    peak_tracker = PeakTracker()
+    profile_command(command=command,
+            command_stdout=command_stdout,
+            command_stderr=command_stderr,
+            syrupy_output=None,
+            poll_interval=opts.poll_interval,
+            sampler_name=opts.sampler,
+            track_tree=opts.track_tree,
+            scheduler=create_scheduler(opts),
+            peak_tracker=peak_tracker,
+            debug_level=opts.debug)
+    peak_tracker.close()
+    return peak_tracker.exit_status, {
+        "peak_rss_kb": peak_tracker.peak_rss(),
+        "cpu_seconds": peak_tracker.ru_utime + peak_tracker.ru_stime,
+        "wall_seconds": peak_tracker.wall_seconds,
+    }
+
+def make_synthetic_process_table(root, num_processes):
+    """
+    Creates a synthetic `/proc` filesystem under directory `root`, with
+    `num_processes` processes, that the "proc" backend can sample (see
+    `ProcSampler`), and returns their PIDs. The processes are also
+    written out in `ps` layout, to "<root>/ps.txt".
+    """
+    with open(os.path.join(root, "uptime"), "w") as dest:
+        dest.write("86400.00 172800.00\n")
+    with open(os.path.join(root, "meminfo"), "w") as dest:
+        dest.write("MemTotal:       16384000 kB\n")
+    pids = [str(1000 + idx) for idx in range(num_processes)]
+    for idx, pid in enumerate(pids):
+        pid_dir = os.path.join(root, pid)
+        os.mkdir(pid_dir)
+        # fields of 'stat' following the command name: state, ppid, ...,
+        # utime (12th), stime (13th), ..., starttime (20th), ...
+        stat_fields = ["S", "1"] + ["0"] * 48
+        stat_fields[11] = str(idx * 7 % 5000)
+        stat_fields[12] = str(idx * 3 % 1000)
+        stat_fields[19] = str(idx * 100)
+        with open(os.path.join(pid_dir, "stat"), "w") as dest:
+            dest.write("%s (worker-%d) %s\n" % (pid, idx, " ".join(stat_fields)))
+        with open(os.path.join(pid_dir, "statm"), "w") as dest:
+            dest.write("%d %d 500 100 0 2000 0\n" % (20000 + idx, 1000 + idx % 4000))
+        with open(os.path.join(pid_dir, "cmdline"), "wb") as dest:
+            dest.write(b"/usr/bin/python3\0worker.py\0--id\0" + pid.encode("ascii") + b"\0")
+    rows, raw_text = ProcSampler(proc_root=root).sample(raw=True)
+    with open(os.path.join(root, "ps.txt"), "w") as dest:
+        dest.write(raw_text + "\n")
+    return pids
+
+def benchmark_samplers(sizes, repetitions=21, quiet=False):
+    """
+    Measures the time taken by each of the sampler backends to sample
+    synthetic process tables (see `make_synthetic_process_table()`) of
+    each of the sizes in `sizes`: "proc" and "proc-pid" (sampling a
+    single process) read the synthetic `/proc` filesystem, while "ps" and
+    "agent" (through a local session) run a stand-in for `ps` that writes
+    out the synthetic table. Returns a list of `(sampler, size, stages)`
+    tuples, where `stages` maps "total" and each stage of a sample (see
+    `SAMPLE_STAGES`) to the `(median, lower, upper)` of its duration in
+    seconds, over `repetitions` samples (see `median_interval()`).
+    """
+    results = []
+    saved_path = os.environ.get("PATH", "")
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix="syrupy-bench-")
+        try:
+            pids = make_synthetic_process_table(root, size)
+            bin_dir = os.path.join(root, "bin")
+            os.mkdir(bin_dir)
+            ps_fpath = os.path.join(bin_dir, "ps")
+            with open(ps_fpath, "w") as dest:
+                dest.write("#! /bin/sh\nexec cat %s\n" % shlex.quote(os.path.join(root, "ps.txt")))
+            os.chmod(ps_fpath, 0o755)
+            os.environ["PATH"] = bin_dir + os.pathsep + saved_path
+            samplers = [ProcSampler(proc_root=root),
+                    ProcPidSampler(pids[:1], proc_root=root),
+                    PsSampler(),
+                    RemoteSampler("localhost", ssh_command="sh -c", remote_python=sys.executable)]
+            for sampler in samplers:
+                if not quiet:
+                    sys.stderr.write("SYRUPY: Benchmarking sampler '%s' on %d processes\n" % (sampler.name, size))
+                totals = []
+                stage_times = dict((stage, []) for stage in SAMPLE_STAGES[:-1])
+                # the first sample, which may open files or sessions, is
+                # not counted
+                sampler.sample()
+                for _ in range(repetitions):
+                    start = time.perf_counter()
+                    rows, raw_text = sampler.sample()
+                    totals.append(time.perf_counter() - start)
+                    for stage in stage_times:
+                        stage_times[stage].append(sampler.timings[stage])
+                sampler.close()
+                stages = {"total": median_interval(totals)}
+                for stage in stage_times:
+                    stages[stage] = median_interval(stage_times[stage])
+                results.append((sampler.name, size, stages))
+        finally:
+            os.environ["PATH"] = saved_path
+            shutil.rmtree(root)
+    return results
+
+def run_benchmark_suite(opts):
+    """
+    Runs the benchmarks specified in the file given by the '--benchmark'
+    option (see `parse_benchmark_spec()`), each the given number of times,
+    and reports the median (with a 95% confidence interval) of each of
+    the `BENCHMARK_METRICS` to standard output. If a baseline file is
+    given, the medians are compared with those recorded in it, and, with
+    '--save-baseline', recorded in it in turn. Returns the exit status:
+    1 if any benchmark failed or any median exceeds its baseline by more
+    than the tolerance, and 0 otherwise.
+    """
+    spec = open_file(opts.benchmark, "r")
+    try:
+        benchmarks = parse_benchmark_spec(spec)
+    except ValueError as e:
+        sys.stderr.write("SYRUPY: %s: %s\n" % (opts.benchmark, e))
+        sys.exit(1)
+    finally:
+        spec.close()
+
+    baseline = {"benchmarks": {}}
+    if opts.baseline is not None and os.path.exists(opts.baseline):
+        try:
+            with open(opts.baseline, "r") as src:
+                baseline = json.load(src)
+        except (IOError, ValueError) as e:
+            sys.stderr.write("SYRUPY: Failed to read baseline '%s': %s\n" % (opts.baseline, e))
+            sys.exit(1)
+
+    if opts.command_in_front:
+        command_stdout = sys.stdout
+        command_stderr = sys.stderr
+    else:
+        command_stdout = open(os.devnull, "w")
+        command_stderr = open(os.devnull, "w")
+
+    failures = 0
+    regressions = 0
+    report = [["BENCHMARK", "METRIC", "RUNS", "MEDIAN", "LOWER", "UPPER", "BASELINE", "CHANGE", "STATUS"]]
+    for name, repetitions, command in benchmarks:
+        runs = []
+        for run_idx in range(repetitions):
+            if not opts.quiet:
+                sys.stderr.write("SYRUPY: Running benchmark '%s' (%d of %d): %s\n"
+                        % (name, run_idx + 1, repetitions, " ".join(command)))
+            try:
+                exit_status, metrics = run_benchmark(opts, command, command_stdout, command_stderr)
+            except OSError as e:
+                sys.stderr.write("SYRUPY: %s\n" % e)
+                sys.exit(1)
+            if exit_status != 0:
+                sys.stderr.write("SYRUPY: Benchmark '%s' exited with status %d\n" % (name, exit_status))
+                failures += 1
+                break
+            runs.append(metrics)
+        if len(runs) < repetitions:
+            continue
+        base_entry = baseline["benchmarks"].get(name, {})
+        entry = {"command": command, "runs": repetitions}
+        for metric, header, value_format in BENCHMARK_METRICS:
+            median, lower, upper = median_interval([m[metric] for m in runs])
+            entry[metric] = {"median": median, "lower": lower, "upper": upper}
+            row = [name, metric, str(repetitions),
+                    value_format % median, value_format % lower, value_format % upper]
+            if metric in base_entry:
+                base_median = base_entry[metric]["median"]
+                row.append(value_format % base_median)
+                if base_median > 0:
+                    row.append("%+.1f%%" % ((median - base_median) * 100.0 / base_median))
+                else:
+                    row.append("-")
+                if median > base_median * (1 + opts.tolerance / 100.0):
+                    row.append("REGRESSED")
+                    regressions += 1
+                else:
+                    row.append("ok")
+            else:
+                row.extend(["-", "-", "new"])
+            report.append(row)
+        baseline["benchmarks"][name] = entry
+
+    if not opts.command_in_front:
+        command_stdout.close()
+        command_stderr.close()
+
+    widths = [max(len(row[idx]) for row in report) for idx in range(len(report[0]))]
+    for row in report:
+        sys.stdout.write("  ".join(field.ljust(width) if idx < 2 else field.rjust(width)
+                for idx, (field, width) in enumerate(zip(row, widths))).rstrip() + "\n")
+    sys.stdout.flush()
+
+    if opts.save_baseline and failures == 0:
+        tmp_fpath = opts.baseline + ".tmp"
+        with open(tmp_fpath, "w") as dest:
+            json.dump(baseline, dest, indent=2, sort_keys=True)
+            dest.write("\n")
+        os.replace(tmp_fpath, opts.baseline)
+        if not opts.quiet:
+            sys.stderr.write("SYRUPY: Saved baseline to '%s'\n" % opts.baseline)
+
+    if failures:
+        sys.stderr.write("SYRUPY: %d benchmark(s) failed\n" % failures)
+    if regressions:
+        sys.stderr.write("SYRUPY: %d metric(s) regressed by more than %s%%\n" % (regressions, opts.tolerance))
+    return 1 if failures or regressions else 0
+
 def main():
     """
     Main CLI handler.
@@ -492,13 +3697,13 @@ being tracked by itself.
     parser.add_option_group(process_opts)
 
     process_opts.add_option('-p', '--poll-pid', '--pid',
-            action='store',
+            action='append',
             dest='poll_pid',
             default=None,
             metavar='PID',
             type=int,
             help='ignore COMMAND if given, and poll external process with ' \
-                +'specified PID')
+                +'specified PID (may be given more than once, to poll several processes)')
 
     process_opts.add_option('-s', '--ssh',
             action='store',
@@ -508,21 +3713,101 @@ being tracked by itself.
             type=str,
             help='use SSH to remote view PS with syrupy')
 
+    process_opts.add_option('--hosts',
+            action='store',
+            dest='hosts',
+            default=None,
+            metavar='HOST[,HOST[,...]]',
+            help='poll external processes on all the given remote hosts concurrently, ' \
+                +'using SSH, and log them together with an additional "HOST" column')
+
+    process_opts.add_option('--host-file',
+            action='store',
+            dest='host_file',
+            default=None,
+            metavar='FILE',
+            help="as '--hosts', but read the host names from FILE, one per line")
+
+    process_opts.add_option('--host-timeout',
+            action='store',
+            dest='host_timeout',
+            default=10,
+            metavar='#.##',
+            type=float,
+            help="with '--hosts' or '--host-file', skip a host for a poll if it does not " \
+                +"respond within this many seconds (default=%default)")
+
+    process_opts.add_option('--ssh-command',
+            action='store',
+            dest='ssh_command',
+            default='ssh {host}',
+            metavar='COMMAND',
+            help='command used to connect to the host given by \'--ssh\', with "{host}" ' \
+                +'standing for the host name (default="%default")')
+
     process_opts.add_option('-m', '--poll-top-memory', '--mem',
             action='store',
             dest='poll_mem',
             default=None,
             metavar='MEM',
             type=int,
-            help='ignore COMMAND if given and poll top MEM processes by memory usage')
+            help="ignore COMMAND if given and poll top MEM processes by memory usage " \
+                +"(or as ranked by '--top-by')")
 
-    process_opts.add_option('-c', '--poll-command',
+    process_opts.add_option('--top-by',
+            action='store',
+            dest='top_metric',
+            default='vsz',
+            choices=sorted(TOP_METRICS),
+            metavar='METRIC',
+            help="metric by which to rank the top processes polled with '-m': " \
+                +"%s (default=%%default); 'pss' (read every '--smaps-interval' seconds) " % ", ".join("'%s'" % m for m in sorted(TOP_METRICS)) \
+                +"and 'io' (kB read and written per second) require a local /proc file system (Linux)")
+
+    process_opts.add_option('--top-hysteresis',
             action='store',
+            dest='top_hysteresis',
+            default=0.0,
+            type=float,
+            metavar='FRACTION',
+            help="with '-m', a process stays among the top processes for as long as it is " \
+                +"within FRACTION of the value needed to rank among them, so that processes " \
+                +"with similar values do not keep swapping places (e.g., 0.1; default=%default, " \
+                +"i.e., the list is simply the top processes on every poll)")
+
+    process_opts.add_option('-c', '--poll-command',
+            action='append',
             dest='poll_command',
             default=None,
             metavar='REG-EXP',
             help='ignore COMMAND if given, and poll external process with ' \
-                +'command matching specified regular expression pattern')
+                +'command matching specified regular expression pattern (may be given more ' \
+                +'than once, to poll processes matching any of the patterns)')
+
+    process_opts.add_option('--tree',
+            action='store_true',
+            dest='track_tree',
+            default=False,
+            help='also poll all descendants (children, grandchildren, etc.) of the process ' \
+                +'resulting from COMMAND or specified by PID, and report their combined ' \
+                +'usage in an additional "TOTAL" row on each poll')
+
+    process_opts.add_option('--threads',
+            action='store_true',
+            dest='threads',
+            default=False,
+            help='also sample every thread of the process resulting from COMMAND or specified ' \
+                +'by PID (and, with "--tree", of its descendants), writing the name and the CPU ' \
+                +'utilization over each polling interval of each thread to "<TITLE>.threads.log" ' \
+                +'(Linux only)')
+
+    process_opts.add_option('--total',
+            action='store_true',
+            dest='group_total',
+            default=False,
+            help='report the combined usage of all the processes polled with "-p", "-c" or "-m" ' \
+                +'in an additional "TOTAL" row on each poll (with "--metrics=pss", its PSS counts ' \
+                +'memory shared between them only once)')
 
     polling_opts = OptionGroup(parser, 'Polling Regime')
     parser.add_option_group(polling_opts)
@@ -535,6 +3820,66 @@ being tracked by itself.
             type=float,
             help='polling interval in seconds (default=%default)')
 
+    polling_opts.add_option('--sampler',
+            action='store',
+            dest='sampler',
+            default='auto',
+            choices=SAMPLERS,
+            metavar='SAMPLER',
+            help="process table sampling backend: 'proc' (read /proc directly; Linux only), " \
+                +"'ps' (call ps; works on any POSIX system and with '--ssh', connecting anew for every sample), " \
+                +"'agent' (call ps on the '--ssh' host through a single persistent session) or " \
+                +"'auto' ('agent' with '--ssh', otherwise 'proc' if available; default)")
+
+    polling_opts.add_option('--metrics',
+            action='store',
+            dest='metrics',
+            default=None,
+            metavar='METRIC[,METRIC...]',
+            help="also sample these metrics of each process, in additional columns (Linux only): " \
+                +"'io' (bytes read and written), 'faults' (minor and major page faults), " \
+                +"'ctxsw' (voluntary and involuntary context switches), 'threads' (number of threads) " \
+                +"'fds' (number of open file descriptors) and 'pss' (proportional and unique set size, " \
+                +"and proportional swap); counts are given as rates per second (see '--explain')")
+
+    polling_opts.add_option('--smaps-interval',
+            action='store',
+            dest='smaps_interval',
+            default=10.0,
+            metavar='#.##',
+            type=float,
+            help="with '--metrics=pss', read the (expensive) memory map summaries of the processes " \
+                +"only every this many seconds, repeating the last values in between (default=%default)")
+
+
+    polling_opts.add_option('--burst-interval',
+            action='store',
+            dest='burst_interval',
+            default=None,
+            metavar='#.##',
+            type=float,
+            help='poll adaptively: switch to polling at this (shorter) interval in seconds ' \
+                +'whenever the memory or CPU usage of a process changes quickly, and ' \
+                +'gradually return to the regular interval once it settles; the interval ' \
+                +'that produced each sample is given in an additional "INTERVAL" column')
+
+    polling_opts.add_option('--burst-rss-threshold',
+            action='store',
+            dest='burst_rss_threshold',
+            default=0.05,
+            metavar='#.##',
+            type=float,
+            help="with '--burst-interval', the change in RSS between polls, as a fraction " \
+                +"of its previous value, that triggers a burst (default=%default)")
+
+    polling_opts.add_option('--burst-cpu-threshold',
+            action='store',
+            dest='burst_cpu_threshold',
+            default=10.0,
+            metavar='#.##',
+            type=float,
+            help="with '--burst-interval', the change in CPU utilization over the polling interval " \
+                +"between polls, in percentage points, that triggers a burst (default=%default)")
 
     run_output_opts = OptionGroup(parser, 'Output Modes', """\
 By default, Syrupy redirects the standard output and standard error of COMMAND, as well
@@ -571,12 +3916,93 @@ standard output and standard error ('-C'), or suppress all COMMAND output altoge
             default=False,
             help='force flushing of stream buffers after every write')
 
+    run_output_opts.add_option('--self-metrics',
+            action='store_true',
+            dest='self_metrics',
+            default=False,
+            help="log the overhead of Syrupy itself on every poll (the time taken by each " \
+                +"stage of the poll, the polling jitter, and Syrupy's own RSS and CPU time) " \
+                +"to '<TITLE>.self.log'")
+
+    run_output_opts.add_option('--write-behind',
+            action='store_true',
+            dest='write_behind',
+            default=False,
+            help='write the logs from a background thread, in batches, so that slow ' \
+                +'writes do not delay sampling')
+
+    run_output_opts.add_option('--flush-interval',
+            action='store',
+            dest='flush_interval',
+            default=2.0,
+            type=float,
+            metavar='#.##',
+            help="with '--write-behind', longest time (in seconds) for which written " \
+                +"data is held back before being flushed to the log files (default=%default)")
+
+    run_output_opts.add_option('--flush-size',
+            action='store',
+            dest='flush_size',
+            default=256,
+            type=float,
+            metavar='KB',
+            help="with '--write-behind', amount of data (in kilobytes) written " \
+                +"after which the log files are flushed (default=%default)")
+
+    run_output_opts.add_option('--write-queue-size',
+            action='store',
+            dest='write_queue_size',
+            default=10000,
+            type=int,
+            metavar='#',
+            help="with '--write-behind', number of writes that can wait to be written; " \
+                +"when the queue is full, lines of the text logs are dropped (and counted), " \
+                +"while writes to the other logs wait for room (default=%default)")
+
+    run_output_opts.add_option('--log-format',
+            action='store',
+            dest='log_format',
+            default='text',
+            choices=['text', 'binary'],
+            metavar='FORMAT',
+            help="format of the process resource usage log: 'text' (written to " \
+                +"'<TITLE>.ps.log'; default) or 'binary' (a compact binary format, written to " \
+                +"'<TITLE>.ps.bin', which can be analyzed and converted to text with syrupy-peak.py)")
+
     run_output_opts.add_option('--no-raw-process-log',
             action='store_true',
             dest='suppress_raw_process_log',
             default=False,
             help='suppress writing of raw results from process sampling')
 
+    run_output_opts.add_option('--raw-log-format',
+            action='store',
+            dest='raw_log_format',
+            default='text',
+            choices=['text', 'delta'],
+            metavar='FORMAT',
+            help="format of the raw process log: 'text' (the full process table on every " \
+                +"poll, written to '<TITLE>.ps.raw'; default) or 'delta' (only the changes " \
+                +"since the previous poll, compressed, written to '<TITLE>.ps.raw.gz' or " \
+                +"similar, which can be decoded with syrupy-peak.py)")
+
+    run_output_opts.add_option('--raw-log-compression',
+            action='store',
+            dest='raw_log_compression',
+            default='gzip',
+            choices=sorted(RAW_LOG_COMPRESSION),
+            metavar='METHOD',
+            help="compression of the 'delta' raw process log: 'gzip' (default), 'zlib' or 'lzma'")
+
+    run_output_opts.add_option('--raw-log-keyframe-interval',
+            action='store',
+            dest='raw_log_keyframe_interval',
+            default=100,
+            type=int,
+            metavar='#',
+            help="number of polls between full snapshots (keyframes) in the 'delta' " \
+                +"raw process log (default=%default)")
+
     formatting_opts = OptionGroup(parser, 'Output Formatting')
     parser.add_option_group(formatting_opts)
 
@@ -605,6 +4031,51 @@ standard output and standard error ('-C'), or suppress all COMMAND output altoge
             default=True,
             help='do not output column headers' )
 
+    benchmark_opts = OptionGroup(parser, 'Benchmarking', """\
+Run a suite of commands repeatedly, instead of profiling a single
+command or process, and report the median peak RSS, CPU time and
+wall-clock time of each (with 95% confidence intervals), comparing them
+with a baseline.""")
+    parser.add_option_group(benchmark_opts)
+
+    benchmark_opts.add_option('--benchmark',
+            action='store',
+            dest='benchmark',
+            default=None,
+            metavar='SPEC',
+            help="run the benchmarks listed in file SPEC, one per line, as " \
+                +"'NAME REPETITIONS COMMAND [COMMAND-ARGS]'")
+
+    benchmark_opts.add_option('--baseline',
+            action='store',
+            dest='baseline',
+            default=None,
+            metavar='FILE',
+            help='compare the results of the benchmarks with those recorded in FILE')
+
+    benchmark_opts.add_option('--save-baseline',
+            action='store_true',
+            dest='save_baseline',
+            default=False,
+            help="record the results of the benchmarks in the '--baseline' file")
+
+    benchmark_opts.add_option('--tolerance',
+            action='store',
+            dest='tolerance',
+            default=10.0,
+            type=float,
+            metavar='PERCENT',
+            help='largest increase of a median over its baseline that is not a ' \
+                +'regression (default=%default)')
+
+    benchmark_opts.add_option('--benchmark-samplers',
+            action='store',
+            dest='benchmark_samplers',
+            default=None,
+            metavar='SIZES',
+            help="measure the time taken by each sampler backend to sample synthetic process " \
+                +"tables of the given sizes (numbers of processes, separated by commas), and exit")
+
     # we need to do this to prevent options meant for COMMAND
     # being consumed by Syrupy
     parser.disable_interspersed_args()
@@ -618,56 +4089,301 @@ standard output and standard error ('-C'), or suppress all COMMAND output altoge
     if len(args) == 0 \
         and opts.poll_pid is None \
         and opts.poll_command is None \
-        and opts.poll_mem is None:
+        and opts.poll_mem is None \
+        and opts.hosts is None \
+        and opts.host_file is None \
+        and opts.benchmark is None \
+        and opts.benchmark_samplers is None:
         parser.print_usage()
         sys.exit(1)
 
+    if opts.benchmark_samplers is not None:
+        try:
+            sizes = [int(size) for size in opts.benchmark_samplers.split(",")]
+        except ValueError:
+            sizes = []
+        if not sizes or min(sizes) < 1:
+            sys.stderr.write("SYRUPY: '--benchmark-samplers' expects numbers of processes, " \
+                    "separated by commas\n")
+            sys.exit(1)
+        report = [["SAMPLER", "PROCESSES", "MEDIAN_MS", "LOWER_MS", "UPPER_MS"]
+                + ["%s_MS" % stage.upper() for stage in SAMPLE_STAGES[:-1]]]
+        for name, size, stages in benchmark_samplers(sizes, quiet=opts.quiet):
+            report.append([name, str(size)]
+                    + ["%.3f" % (value * 1000) for value in stages["total"]]
+                    + ["%.3f" % (stages[stage][0] * 1000) for stage in SAMPLE_STAGES[:-1]])
+        widths = [max(len(row[idx]) for row in report) for idx in range(len(report[0]))]
+        for row in report:
+            sys.stdout.write("  ".join(field.ljust(width) if idx == 0 else field.rjust(width)
+                    for idx, (field, width) in enumerate(zip(row, widths))).rstrip() + "\n")
+        sys.exit(0)
+
+    if opts.benchmark is not None:
+        if opts.save_baseline and opts.baseline is None:
+            sys.stderr.write("SYRUPY: '--save-baseline' requires '--baseline'\n")
+            sys.exit(1)
+        if opts.tolerance < 0:
+            sys.stderr.write("SYRUPY: '--tolerance' cannot be negative\n")
+            sys.exit(1)
+        sys.exit(run_benchmark_suite(opts))
+
+    if TOP_METRICS[opts.top_metric][0] is None and (opts.ssh is not None or opts.hosts is not None \
+            or opts.host_file is not None or not os.path.exists("/proc/self/stat")):
+        sys.stderr.write("SYRUPY: '--top-by=%s' requires a local /proc file system (Linux), " \
+                "and cannot be used with '--ssh', '--hosts' or '--host-file'\n" % opts.top_metric)
+        sys.exit(1)
+
+    if opts.top_hysteresis < 0:
+        sys.stderr.write("SYRUPY: '--top-hysteresis' cannot be negative\n")
+        sys.exit(1)
+
+    if opts.metrics is not None:
+        metrics = [name.strip() for name in opts.metrics.split(",") if name.strip()]
+        unknown = [name for name in metrics if name not in PROCESS_METRICS]
+        if unknown or not metrics:
+            sys.stderr.write("SYRUPY: '--metrics' expects a list of metrics (%s), separated by commas\n"
+                    % ", ".join(sorted(PROCESS_METRICS)))
+            sys.exit(1)
+        if opts.ssh is not None or opts.hosts is not None or opts.host_file is not None \
+                or not os.path.exists("/proc/self/stat"):
+            sys.stderr.write("SYRUPY: '--metrics' requires a local /proc file system (Linux), " \
+                    "and cannot be used with '--ssh', '--hosts' or '--host-file'\n")
+            sys.exit(1)
+    else:
+        metrics = None
+    if opts.group_total and (opts.hosts is not None or opts.host_file is not None \
+            or (opts.poll_pid is None and opts.poll_command is None and opts.poll_mem is None)):
+        sys.stderr.write("SYRUPY: '--total' requires '-p', '-c' or '-m', and cannot be used with " \
+                "'--hosts' or '--host-file'\n")
+        sys.exit(1)
+    if opts.smaps_interval <= 0:
+        sys.stderr.write("SYRUPY: '--smaps-interval' must be positive\n")
+        sys.exit(1)
+
+    for pattern in opts.poll_command or []:
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            sys.stderr.write("SYRUPY: invalid command pattern '%s': %s\n" % (pattern, e))
+            sys.exit(1)
+
     if opts.title is None and len(args) > 0:
         base_title = os.path.splitext(os.path.basename(args[0]))[0]
     else:
         base_title = opts.title
 
-    if opts.syrupy_in_front:
-        syrupy_output = sys.stdout
+    if opts.write_behind:
+        if opts.flush_interval < 0 or opts.flush_size < 0 or opts.write_queue_size < 1:
+            sys.stderr.write("SYRUPY: '--flush-interval' and '--flush-size' cannot be negative, " \
+                    "and '--write-queue-size' must be at least 1\n")
+            sys.exit(1)
+        # drain the queued writes when terminated
+        signal.signal(signal.SIGTERM, exit_on_signal)
+
+    binary_output = None
+    if opts.log_format == 'binary':
+        if opts.syrupy_in_front or opts.hosts is not None or opts.host_file is not None:
+            sys.stderr.write("SYRUPY: '--log-format=binary' cannot be used with '-S', '--hosts' or '--host-file'\n")
+            sys.exit(1)
+        syrupy_output = None
+        fname = base_title + ".ps.bin"
+        if not opts.quiet:
+            sys.stderr.write("SYRUPY: Writing process resource usage samples to '%s'\n" % fname)
+        binary_output = BinaryLogWriter(log_writer(opts, open_file(fname, "wb", replace=opts.replace)))
+    elif opts.syrupy_in_front:
+        syrupy_output = log_writer(opts, sys.stdout, drop_when_full=True)
     else:
         fname = base_title + ".ps.log"
         if not opts.quiet:
             sys.stderr.write("SYRUPY: Writing process resource usage samples to '%s'\n" % fname)
-        syrupy_output = open_file(fname, "w", replace=opts.replace)
+        syrupy_output = log_writer(opts, open_file(fname, "w", replace=opts.replace), drop_when_full=True)
 
     if opts.suppress_raw_process_log:
         raw_ps_log = None
+    elif opts.raw_log_format == 'delta':
+        if opts.raw_log_keyframe_interval < 1:
+            sys.stderr.write("SYRUPY: '--raw-log-keyframe-interval' must be at least 1\n")
+            sys.exit(1)
+        fname = base_title + ".ps.raw" + RAW_LOG_COMPRESSION[opts.raw_log_compression][0]
+        if not opts.quiet:
+            sys.stderr.write("SYRUPY: Writing raw process resource usage logs to '%s'\n" % fname)
+        raw_ps_log = DeltaRawLogWriter(log_writer(opts, open_file(fname, "wb", replace=opts.replace)),
+                index=log_writer(opts, open_file(fname + ".idx", "w", replace=opts.replace)),
+                compression=opts.raw_log_compression,
+                keyframe_interval=opts.raw_log_keyframe_interval,
+                key_fields=2 if opts.hosts is not None or opts.host_file is not None else 1)
     else:
         fname = base_title + ".ps.raw"
         if not opts.quiet:
             sys.stderr.write("SYRUPY: Writing raw process resource usage logs to '%s'\n" % fname)
-        raw_ps_log = open_file(base_title + ".ps.raw", "w", replace=opts.replace)
+        raw_ps_log = log_writer(opts, open_file(base_title + ".ps.raw", "w", replace=opts.replace),
+                drop_when_full=True)
 
-    if opts.poll_pid is not None or opts.poll_command is not None or opts.poll_mem is not None:
+    if opts.threads:
+        if opts.poll_command is not None or opts.poll_mem is not None \
+                or opts.hosts is not None or opts.host_file is not None or opts.ssh is not None:
+            sys.stderr.write("SYRUPY: '--threads' requires '-p' or COMMAND, and cannot be used with " \
+                    "'-c', '-m', '--ssh', '--hosts' or '--host-file'\n")
+            sys.exit(1)
+        if not os.path.exists("/proc/self/task"):
+            sys.stderr.write("SYRUPY: '--threads' requires a /proc file system (Linux)\n")
+            sys.exit(1)
+        fname = base_title + ".threads.log"
         if not opts.quiet:
-            if opts.poll_pid is not None:
-                sys.stderr.write("SYRUPY: sampling process %d\n" % opts.poll_pid)
-            elif opts.poll_mem is not None:
-                sys.stderr.write("SYRUPY: sampling top %d processes by memory usage\n" % opts.poll_mem)
-            else:
-                sys.stderr.write("SYRUPY: sampling process with command pattern '%s'\n" % opts.poll_command)
-        profile_process(pid=opts.poll_pid,
+            sys.stderr.write("SYRUPY: Writing thread resource usage samples to '%s'\n" % fname)
+        thread_output = log_writer(opts, open_file(fname, "w", replace=opts.replace))
+    else:
+        thread_output = None
+
+    if opts.self_metrics:
+        if opts.hosts is not None or opts.host_file is not None:
+            sys.stderr.write("SYRUPY: '--self-metrics' cannot be used with '--hosts' or '--host-file'\n")
+            sys.exit(1)
+        fname = base_title + ".self.log"
+        if not opts.quiet:
+            sys.stderr.write("SYRUPY: Writing Syrupy overhead measurements to '%s'\n" % fname)
+        self_metrics = SelfMetrics(log_writer(opts, open_file(fname, "w", replace=opts.replace)),
+                separator=opts.separator,
+                headers=opts.headers)
+    else:
+        self_metrics = SelfMetrics()
+
+    if opts.ssh is None and os.path.exists("/proc/self/status"):
+        peak_tracker = PeakTracker()
+    else:
+        peak_tracker = None
+
+    hosts = []
+    if opts.hosts is not None:
+        hosts.extend(h.strip() for h in opts.hosts.split(",") if h.strip())
+    if opts.host_file is not None:
+        host_file = open_file(opts.host_file, "r")
+        hosts.extend(h.strip() for h in host_file if h.strip() and not h.startswith("#"))
+        host_file.close()
+
+    top_events_output = None
+    if opts.poll_mem is not None:
+        fname = base_title + ".top.log"
+        if not opts.quiet:
+            sys.stderr.write("SYRUPY: Writing changes to the top processes to '%s'\n" % fname)
+        top_events_output = log_writer(opts, open_file(fname, "w", replace=opts.replace))
+
+    if hosts:
+        if opts.poll_pid is None and opts.poll_command is None and opts.poll_mem is None:
+            sys.stderr.write("SYRUPY: '--hosts' and '--host-file' require '-p', '-c' or '-m'\n")
+            sys.exit(1)
+        if opts.ssh is not None or opts.track_tree or opts.burst_interval is not None:
+            sys.stderr.write("SYRUPY: '--hosts' and '--host-file' cannot be used with '--ssh', '--tree' " \
+                    "or '--burst-interval'\n")
+            sys.exit(1)
+        if not opts.quiet:
+            sys.stderr.write("SYRUPY: sampling %d remote hosts\n" % len(hosts))
+        scheduler = profile_fleet(hosts,
+                pid=opts.poll_pid,
                 command_pattern=opts.poll_command,
                 top_mem=opts.poll_mem,
+                top_metric=opts.top_metric,
+                top_hysteresis=opts.top_hysteresis,
+                top_events_output=top_events_output,
                 syrupy_output=syrupy_output,
                 raw_ps_log=raw_ps_log,
                 poll_interval=opts.poll_interval,
-                quit_poll_func=None,
-                ssh_id=opts.ssh,
-                has_ssh=True if opts.ssh else False,
+                ssh_command=opts.ssh_command,
+                host_timeout=opts.host_timeout,
                 quit_if_none=True if opts.poll_pid else False,
-                quit_at_time=None,
                 show_command=opts.show_command,
                 output_separator=opts.separator,
                 align=opts.align,
                 headers=opts.headers,
                 flush_output=opts.flush_output,
                 debug_level=opts.debug)
+        if raw_ps_log is not None:
+            raw_ps_log.close()
+        if top_events_output is not None:
+            top_events_output.close()
+        if not opts.quiet and scheduler.missed_ticks:
+            sys.stderr.write("SYRUPY: Missed polls: %d of %d\n" % (scheduler.missed_ticks,
+                    scheduler.ticks + scheduler.missed_ticks))
+    elif opts.poll_pid is not None or opts.poll_command is not None or opts.poll_mem is not None:
+        if opts.track_tree and (opts.poll_pid is None or len(opts.poll_pid) != 1):
+            sys.stderr.write("SYRUPY: '--tree' requires a single PID ('-p') or COMMAND\n")
+            sys.exit(1)
+        try:
+            sampler = create_sampler(opts.sampler,
+                    ssh_id=opts.ssh,
+                    ssh_command=opts.ssh_command,
+                    pids=opts.poll_pid if not opts.track_tree else None,
+                    debug_level=opts.debug)
+        except (ValueError, IOError, OSError) as e:
+            sys.stderr.write("SYRUPY: %s\n" % e)
+            sys.exit(1)
+        if not opts.quiet:
+            if opts.poll_pid is not None and len(opts.poll_pid) == 1:
+                sys.stderr.write("SYRUPY: sampling process %d\n" % opts.poll_pid[0])
+            elif opts.poll_pid is not None:
+                sys.stderr.write("SYRUPY: sampling processes %s\n" % ", ".join(str(p) for p in opts.poll_pid))
+            elif opts.poll_mem is not None:
+                sys.stderr.write("SYRUPY: sampling top %d processes by %s\n" % (opts.poll_mem, opts.top_metric))
+            else:
+                sys.stderr.write("SYRUPY: sampling process with command pattern %s\n"
+                        % " or ".join("'%s'" % c for c in opts.poll_command))
+        scheduler = create_scheduler(opts)
+        try:
+            profile_process(pid=opts.poll_pid,
+                    command_pattern=opts.poll_command,
+                    top_mem=opts.poll_mem,
+                    top_metric=opts.top_metric,
+                    top_hysteresis=opts.top_hysteresis,
+                    top_events_output=top_events_output,
+                    syrupy_output=syrupy_output,
+                    raw_ps_log=raw_ps_log,
+                    poll_interval=opts.poll_interval,
+                    quit_poll_func=None,
+                    ssh_id=opts.ssh,
+                    has_ssh=True if opts.ssh else False,
+                    quit_if_none=True if opts.poll_pid else False,
+                    quit_at_time=None,
+                    show_command=opts.show_command,
+                    output_separator=opts.separator,
+                    align=opts.align,
+                    headers=opts.headers,
+                    flush_output=opts.flush_output,
+                    sampler=sampler,
+                    track_tree=opts.track_tree,
+                    scheduler=scheduler,
+                    peak_tracker=peak_tracker,
+                    binary_output=binary_output,
+                    self_metrics=self_metrics,
+                    metrics=metrics,
+                    smaps_interval=opts.smaps_interval,
+                    group_total=opts.group_total,
+                    thread_output=thread_output,
+                    debug_level=opts.debug)
+        except IOError as e:
+            sys.stderr.write("SYRUPY: %s\n" % e)
+            sys.exit(1)
+        finally:
+            sampler.close()
+            if binary_output is not None:
+                binary_output.close()
+            if raw_ps_log is not None:
+                raw_ps_log.close()
+            if top_events_output is not None:
+                top_events_output.close()
+            if thread_output is not None:
+                thread_output.close()
+            self_metrics.close()
+            if self_metrics.dest is not None:
+                self_metrics.dest.close()
+        if not opts.quiet and scheduler.missed_ticks:
+            sys.stderr.write("SYRUPY: Missed polls: %d of %d\n" % (scheduler.missed_ticks,
+                    scheduler.ticks + scheduler.missed_ticks))
+        if not opts.quiet:
+            for line in self_metrics.report():
+                sys.stderr.write(line + "\n")
+        if peak_tracker is not None:
+            peak_tracker.close()
+            save_run_summary(opts, base_title, peak_tracker.summary() + self_metrics.summary())
     else:
         command = args
         if not opts.quiet:
@@ -689,6 +4405,7 @@ standard output and standard error ('-C'), or suppress all COMMAND output altoge
             if not opts.quiet:
                 sys.stderr.write("SYRUPY: Redirecting command error stream to '%s'\n" % cerr)
             command_stderr = open_file(cerr, 'w', replace=opts.replace)
+        scheduler = create_scheduler(opts)
         start_time, end_time = profile_command(command=command,
                 command_stdout=command_stdout,
                 command_stderr=command_stderr,
@@ -700,7 +4417,32 @@ standard output and standard error ('-C'), or suppress all COMMAND output altoge
                 align=opts.align,
                 headers=opts.headers,
                 flush_output=opts.flush_output,
+                sampler_name=opts.sampler,
+                track_tree=opts.track_tree,
+                scheduler=scheduler,
+                peak_tracker=peak_tracker,
+                binary_output=binary_output,
+                self_metrics=self_metrics,
+                metrics=metrics,
+                smaps_interval=opts.smaps_interval,
+                thread_output=thread_output,
                 debug_level=opts.debug)
+        if binary_output is not None:
+            binary_output.close()
+        if raw_ps_log is not None:
+            raw_ps_log.close()
+        if thread_output is not None:
+            thread_output.close()
+        self_metrics.close()
+        if self_metrics.dest is not None:
+            self_metrics.dest.close()
+        if peak_tracker is not None:
+            peak_tracker.close()
+            save_run_summary(opts, base_title, [
+                    ("command", " ".join(command)),
+                    ("start_time", start_time.isoformat(' ')),
+                    ("end_time", end_time.isoformat(' ')),
+                    ] + peak_tracker.summary() + self_metrics.summary())
 
         if not opts.quiet:
                 final_run_report = []
@@ -710,6 +4452,10 @@ standard output and standard error ('-C'), or suppress all COMMAND output altoge
                 hours, mins, secs = str(end_time-start_time).split(":")
                 run_time = "SYRUPY: Total run time: %s hour(s), %s minute(s), %s second(s)" % (hours, mins, secs)
                 final_run_report.append(run_time)
+                if scheduler.missed_ticks:
+                    final_run_report.append("SYRUPY: Missed polls: %d of %d" % (scheduler.missed_ticks,
+                            scheduler.ticks + scheduler.missed_ticks))
+                final_run_report.extend(self_metrics.report())
                 report = "\n".join(final_run_report) + "\n"
                 sys.stderr.write(report)
 
@@ -41,7 +41,8 @@ setup(name='Syrupy',
 System resource usage profiler""",
       license='GPL 3+',
       packages=[],
-      package_dir={},
+      py_modules=['syrupy'],
+      package_dir={'': 'scripts'},
       package_data={},
       scripts=['scripts/syrupy.py', 'scripts/syrupy-peak.py'],
       include_package_data=True,